@@ -1,16 +1,29 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-import geopandas as gpd
+import hashlib
+from history import HISTORY_BINARY, HistoryFile, is_history_file, write_history
 import json
+import numpy as np
 import os
 import re
-from typing import Any, Literal
+from snapshot import SnapshotFormatError, read_snapshot
+from store import DAY, ObservationStore
+from typing import Any, Literal, Sequence
 
 # Constants
 DATA_DIR = './data'
+HISTORY_FILE = f'{DATA_DIR}/history.json'
 INFO = 'info'
 LOG_DIR = './script/log'
 NONE = 'none'
+NULL = -1
+MAX_COUNT = np.iinfo(np.uint16).max
+SLOTS = 144
+SNAPSHOT_NAME = re.compile(r'^(\d+)-(\d+)-(\d+)-(\d+) \((\d{4}-\d{2}-\d{2})\)')
+STATS_FILE = f'{DATA_DIR}/history-stats.json'
+UNSET = -2
 VERBOSE = 'verbose'
 WEEKDAY = {1: 'Monday', 2: 'Tuesday', 3: 'Wednesday', 4: 'Thursday', 5: 'Friday', 6: 'Saturday', 7: 'Sunday'}
 
@@ -19,45 +32,152 @@ __log_level__: Literal[0, 1, 2] = 2
 
 # Classes
 class LotsHistory:
-    history: dict[str, dict[int, list[int | None]]] = {}
+    '''
+    The occupancy history of the parking lots, stored as a lots × 7 × 144 int8 cube.
+    '''
+
+    cube: np.ndarray
+    '''
+    The occupancy of each lot (row), day of week (1 = Monday at index 0) and 10-minute slot. `NULL` means no data.
+    '''
+
+    ids: list[str]
+    '''
+    The id of the lot in each row.
+    '''
+
+    index: dict[str, int]
+    '''
+    The dictionary of lot id to row.
+    '''
+
+    fill: int
+    '''
+    The value of the cells never written. Partial histories use `UNSET`, so a written `NULL` can still be told apart.
+    '''
+
+    def __init__(self: 'LotsHistory', capacity: int = 1024, fill: int = NULL) -> None:
+        self.cube = np.full((capacity, 7, SLOTS), fill, dtype=np.int8)
+        self.fill = fill
+        self.ids = []
+        self.index = {}
 
     def add_history(self: 'LotsHistory', id: str, day_of_week: int, hour: int, minute: int, occupied: bool) -> None:
-        if (id in self.history.keys()):
-            lot = self.history[id]
-            if (day_of_week in lot.keys()):
-                day_data = lot[day_of_week]
-                if (len(day_data) == 144):
-                    day_data[int(hour * 6 + minute / 10)] = int(occupied)
-                    return
-                else:
-                    day_data = [None] * 144
-            else:
-                lot[day_of_week] = [None] * 144
-        else:
-            self.add_new_lot(id)
-        
-        # Retry until the record is fixed.
-        self.add_history(id, day_of_week, hour, minute, occupied)
+        self.cube[self.add_new_lot(id), day_of_week - 1, hour * 6 + minute // 10] = int(occupied)
+
+    def add_new_lot(self: 'LotsHistory', id: str) -> int:
+        '''
+        Get the row of the lot, adding an empty row if the lot is new.
+        '''
+        row = self.index.get(id)
+        if (row is None):
+            row = len(self.ids)
+            if (row == len(self.cube)):
+                # Double the capacity, so adding lots stays amortized O(1).
+                grown = np.full((max(1, 2 * row), 7, SLOTS), self.fill, dtype=np.int8)
+                grown[:row] = self.cube
+                self.cube = grown
+            self.ids.append(id)
+            self.index[id] = row
+        return row
+
+    def add_observations(self: 'LotsHistory', ids: Sequence[str | None], lots: np.ndarray, timestamps: np.ndarray, states: np.ndarray) -> None:
+        '''
+        Fold raw observations into the cube with one vectorized group-by on (lot, weekday, slot), where the latest observation wins.
+
+        Parameters
+        ----------
+        ids : Sequence[str | None]
+            The id of each lot index. Observations of a `None` id are skipped.
+        lots : np.ndarray
+            The lot index of each observation.
+        timestamps : np.ndarray
+            The time of each observation in seconds since the epoch.
+        states : np.ndarray
+            The state of each observation, with `-1` for unknown.
+        '''
+        rows = np.fromiter((-1 if id is None else self.add_new_lot(id) for id in ids), dtype=np.int64, count=len(ids))[lots]
+        valid = rows >= 0
+        rows, timestamps, states = rows[valid], timestamps[valid], states[valid]
+        weekdays = (timestamps // DAY + 3) % 7  # 1970-01-01 was a Thursday.
+        slots = (timestamps % DAY) // 600
+        keys = (rows * 7 + weekdays) * SLOTS + slots
+        # The latest observation of each cell is the first of the reversed keys.
+        order = np.argsort(timestamps, kind='stable')[::-1]
+        _, first = np.unique(keys[order], return_index=True)
+        latest = order[first]
+        self.cube[rows[latest], weekdays[latest], slots[latest]] = states[latest].astype(np.int8)
+
+    def add_snapshot(self: 'LotsHistory', ids: Sequence[Any], occupied: Sequence[Any], day_of_week: int, slot: int) -> None:
+        '''
+        Write a whole snapshot into one slot with a single scatter.
+
+        Parameters
+        ----------
+        ids : Sequence[Any]
+            The id of each lot. Lots without an id are skipped.
+        occupied : Sequence[Any]
+            Whether each lot is occupied. `None` or NaN is stored as no data.
+        day_of_week : int
+            The day of week, from 1 (Monday) to 7 (Sunday).
+        slot : int
+            The 10-minute slot of the day, from 0 to 143.
+        '''
+        values = np.asarray(occupied, dtype=float)
+        rows = np.fromiter((-1 if not isinstance(id, str) else self.add_new_lot(id) for id in ids), dtype=np.int64, count=len(values))
+        valid = rows >= 0
+        self.cube[rows[valid], day_of_week - 1, slot] = np.where(np.isnan(values), NULL, values)[valid].astype(np.int8)
+
+    def update(self: 'LotsHistory', other: 'LotsHistory') -> None:
+        '''
+        Overwrite this history with every cell written in the other (partial) history.
+        '''
+        rows = np.fromiter((self.add_new_lot(id) for id in other.ids), dtype=np.int64, count=len(other.ids))
+        cube = other.cube[:len(other.ids)]
+        target = self.cube[rows]
+        np.copyto(target, cube, where=(cube != UNSET) if other.fill == UNSET else True)
+        self.cube[rows] = target
+
+    def to_dict(self: 'LotsHistory') -> dict[str, dict[int, list[int | None]]]:
+        '''
+        Convert the cube to the nested dictionary stored in `history.json`.
+        '''
+        cube = self.cube[:len(self.ids)]
+        values = cube.astype(object)
+        values[cube == NULL] = None
+        return {id: {d + 1: values[row, d].tolist() for d in range(7)} for row, id in enumerate(self.ids)}
 
-    def add_new_lot(self: 'LotsHistory', id: str) -> None:
-        if (id in self.history.keys()):
-            return
-        else:
-            # Creates 7 entries for the dictionary, where each of them is a str - list[int|None] pair.
-            self.history[id] = {k: [None] * 144 for k in range(1, 8)}
-    
     def to_file(self: 'LotsHistory', path: str) -> None:
-        JsonHelper.dump(self.history, path, indent=2)
+        '''
+        Write `history.json`, or the binary history of `history.py` if the path ends with `.bin`.
+        '''
+        if (path.endswith('.bin')):
+            write_history(path, self.ids, self.cube[:len(self.ids)])
+        else:
+            JsonHelper.dump(self.to_dict(), path, indent=2)
             
     def __len__(self: 'LotsHistory') -> int:
-        return len(self.history)
+        return len(self.ids)
     
     @classmethod
     def load_file(cls, path: str) -> 'LotsHistory':
+        if (is_history_file(path)):
+            binary = HistoryFile(path)
+            obj = cls(max(1, len(binary)))
+            obj.ids = list(binary.ids)
+            obj.index = dict(binary.index)
+            obj.cube[:len(binary)] = binary.to_cube()
+            return obj
         with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        obj = cls()
-        obj.history = {k: {int(d): v for d, v in inner.items()} for k, inner in data.items()}
+            data: dict[str, dict[str, list[int | None]]] = json.load(f)
+        if (any(isinstance(v, dict) for inner in list(data.values())[:1] for v in inner.values())):
+            raise ValueError(f'`{path}` holds occupancy statistics, not a history.')
+        obj = cls(max(1, len(data)))
+        for id, inner in data.items():
+            row = obj.add_new_lot(id)
+            for d, v in inner.items():
+                values = np.asarray(v, dtype=float)
+                obj.cube[row, int(d) - 1, :len(values)] = np.where(np.isnan(values), NULL, values)[:SLOTS]
         return obj
 
 class JsonHelper:
@@ -99,49 +219,390 @@ class JsonHelper:
         with open(path, "w", encoding="utf-8") as f:
             f.write(s)
 
+class OccupancyStats:
+    '''
+    The occupancy statistics of the parking lots over many weeks, stored as two lots × 7 × 144 uint16 cubes of counts.
+    Unlike `LotsHistory`, every reading is kept as a sample, so the occupancy rate of a slot is `occupied / observed`.
+    Counts saturate at 65535 instead of wrapping around.
+    '''
+
+    observed: np.ndarray
+    '''
+    The number of known readings of each lot (row), day of week (1 = Monday at index 0) and 10-minute slot.
+    '''
+
+    occupied: np.ndarray
+    '''
+    The number of those readings where the lot was occupied.
+    '''
+
+    ids: list[str]
+    '''
+    The id of the lot in each row.
+    '''
+
+    index: dict[str, int]
+    '''
+    The dictionary of lot id to row.
+    '''
+
+    seen: np.ndarray
+    '''
+    The last 10-minute slot since the epoch each lot was counted in. A lot reached by several groups in the same
+    slot is only counted once. This is not saved, so it only applies within a run.
+    '''
+
+    def __init__(self: 'OccupancyStats', capacity: int = 1024) -> None:
+        self.observed = np.zeros((capacity, 7, SLOTS), dtype=np.uint16)
+        self.occupied = np.zeros((capacity, 7, SLOTS), dtype=np.uint16)
+        self.seen = np.full(capacity, -1, dtype=np.int64)
+        self.ids = []
+        self.index = {}
+
+    def add_counts(self: 'OccupancyStats', rows: np.ndarray, observed: np.ndarray, occupied: np.ndarray) -> None:
+        '''
+        Add the count cubes to the rows, saturating at `MAX_COUNT`.
+        '''
+        self.observed[rows] = np.minimum(self.observed[rows].astype(np.uint32) + observed, MAX_COUNT)
+        self.occupied[rows] = np.minimum(self.occupied[rows].astype(np.uint32) + occupied, MAX_COUNT)
+
+    def add_new_lot(self: 'OccupancyStats', id: str) -> int:
+        '''
+        Get the row of the lot, adding an empty row if the lot is new.
+        '''
+        row = self.index.get(id)
+        if (row is None):
+            row = len(self.ids)
+            if (row == len(self.observed)):
+                # Double the capacity, so adding lots stays amortized O(1).
+                capacity = max(1, 2 * row)
+                for name, fill in (('observed', 0), ('occupied', 0), ('seen', -1)):
+                    old = getattr(self, name)
+                    grown = np.full((capacity, *old.shape[1:]), fill, dtype=old.dtype)
+                    grown[:row] = old
+                    setattr(self, name, grown)
+            self.ids.append(id)
+            self.index[id] = row
+        return row
+
+    def add_observations(self: 'OccupancyStats', ids: Sequence[str | None], lots: np.ndarray, timestamps: np.ndarray, states: np.ndarray) -> None:
+        '''
+        Count raw observations with one vectorized bincount over (lot, weekday, slot).
+        Repeated readings of a lot in the same 10-minute slot of the same day count once, with the latest one winning.
+
+        Parameters
+        ----------
+        ids : Sequence[str | None]
+            The id of each lot index. Observations of a `None` id are skipped.
+        lots : np.ndarray
+            The lot index of each observation.
+        timestamps : np.ndarray
+            The time of each observation in seconds since the epoch.
+        states : np.ndarray
+            The state of each observation, with `-1` for unknown.
+        '''
+        rows = np.fromiter((-1 if id is None else self.add_new_lot(id) for id in ids), dtype=np.int64, count=len(ids))[lots]
+        valid = (rows >= 0) & (states >= 0)
+        rows, timestamps, states = rows[valid], timestamps[valid], states[valid]
+        # Keep the latest reading of each lot in each slot since the epoch.
+        instances = timestamps // 600
+        order = np.lexsort((-timestamps, instances, rows))
+        keep = order[np.r_[True, (np.diff(rows[order]) != 0) | (np.diff(instances[order]) != 0)]] if len(order) > 0 else order
+        rows, instances, states = rows[keep], instances[keep], states[keep]
+        weekdays = (instances * 600 // DAY + 3) % 7  # 1970-01-01 was a Thursday.
+        slots = instances % (DAY // 600)
+        keys = (rows * 7 + weekdays) * SLOTS + slots
+        size = len(self.ids) * 7 * SLOTS
+        shape = (len(self.ids), 7, SLOTS)
+        self.add_counts(np.arange(len(self.ids)),
+                        np.bincount(keys, minlength=size).reshape(shape),
+                        np.bincount(keys, weights=(states > 0), minlength=size).astype(np.int64).reshape(shape))
+        if (len(rows) > 0):
+            np.maximum.at(self.seen, rows, instances)
+
+    def add_snapshot(self: 'OccupancyStats', ids: Sequence[Any], occupied: Sequence[Any], day_of_week: int, slot: int, timestamp: datetime | None = None) -> None:
+        '''
+        Count a whole snapshot as one sample of the slot with a single scatter.
+
+        Parameters
+        ----------
+        ids : Sequence[Any]
+            The id of each lot. Lots without an id are skipped, and so are repeated ids after the first.
+        occupied : Sequence[Any]
+            Whether each lot is occupied. `None` or NaN is not counted.
+        day_of_week : int
+            The day of week, from 1 (Monday) to 7 (Sunday).
+        slot : int
+            The 10-minute slot of the day, from 0 to 143.
+        timestamp : datetime, optional
+            The time of the snapshot. Lots already counted in the same slot of the same day are skipped.
+        '''
+        values = np.asarray(occupied, dtype=float)
+        rows = np.fromiter((-1 if not isinstance(id, str) else self.add_new_lot(id) for id in ids), dtype=np.int64, count=len(values))
+        valid = (rows >= 0) & ~np.isnan(values)
+        rows, values = rows[valid], values[valid]
+        rows, first = np.unique(rows, return_index=True)
+        values = values[first]
+        if (timestamp is not None):
+            instance = int((timestamp - datetime(1970, 1, 1)).total_seconds()) // 600
+            fresh = self.seen[rows] != instance
+            rows, values = rows[fresh], values[fresh]
+            self.seen[rows] = instance
+        cells = (rows, day_of_week - 1, slot)
+        self.observed[cells] = np.minimum(self.observed[cells].astype(np.uint32) + 1, MAX_COUNT)
+        self.occupied[cells] = np.minimum(self.occupied[cells].astype(np.uint32) + (values > 0), MAX_COUNT)
+
+    def update(self: 'OccupancyStats', other: 'OccupancyStats') -> None:
+        '''
+        Add the counts of the other (partial) statistics. The order of the merges doesn't matter.
+        '''
+        rows = np.fromiter((self.add_new_lot(id) for id in other.ids), dtype=np.int64, count=len(other.ids))
+        self.add_counts(rows, other.observed[:len(other.ids)], other.occupied[:len(other.ids)])
+        self.seen[rows] = np.maximum(self.seen[rows], other.seen[:len(other.ids)])
+
+    def get_rates(self: 'OccupancyStats') -> np.ndarray:
+        '''
+        Get the occupancy rate of each cell, with NaN for the cells never observed.
+        '''
+        observed = self.observed[:len(self.ids)].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(observed > 0, self.occupied[:len(self.ids)] / observed, np.nan)
+
+    def to_dict(self: 'OccupancyStats') -> dict[str, dict[int, dict[str, list[int | float | None]]]]:
+        '''
+        Convert the counts to the nested dictionary stored in `history-stats.json`.
+        Each day has the sample count `n`, the `occupied` count and the occupancy `rate` of every slot.
+        '''
+        rates = np.round(self.get_rates(), 4).astype(object)
+        rates[np.isnan(self.get_rates())] = None
+        observed = self.observed[:len(self.ids)].tolist()
+        occupied = self.occupied[:len(self.ids)].tolist()
+        return {id: {d + 1: {'n': observed[row][d], 'occupied': occupied[row][d], 'rate': rates[row, d].tolist()} for d in range(7)}
+                for row, id in enumerate(self.ids)}
+
+    def to_file(self: 'OccupancyStats', path: str) -> None:
+        JsonHelper.dump(self.to_dict(), path, indent=2)
+
+    def __len__(self: 'OccupancyStats') -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load_file(cls, path: str) -> 'OccupancyStats':
+        if (is_history_file(path)):
+            raise ValueError(f'`{path}` is a binary history, not occupancy statistics.')
+        with open(path, 'r', encoding='utf-8') as f:
+            data: dict[str, dict[str, dict[str, list[Any]]]] = json.load(f)
+        if (any(not isinstance(v, dict) for inner in list(data.values())[:1] for v in inner.values())):
+            raise ValueError(f'`{path}` holds a history, not occupancy statistics.')
+        obj = cls(max(1, len(data)))
+        for id, inner in data.items():
+            row = obj.add_new_lot(id)
+            for d, v in inner.items():
+                obj.observed[row, int(d) - 1, :len(v['n'])] = np.asarray(v['n'], dtype=np.uint16)[:SLOTS]
+                obj.occupied[row, int(d) - 1, :len(v['occupied'])] = np.asarray(v['occupied'], dtype=np.uint16)[:SLOTS]
+        return obj
+
+class SnapshotManifest:
+    '''
+    The record of the snapshots already folded into a history file.
+    '''
+
+    entries: dict[str, dict[str, Any]]
+    '''
+    The dictionary of snapshot file name to its size, mtime and SHA-256 content hash.
+    '''
+
+    def __init__(self: 'SnapshotManifest') -> None:
+        self.entries = {}
+
+    def is_ingested(self: 'SnapshotManifest', path: str) -> bool:
+        '''
+        Check whether the snapshot was ingested and hasn't changed since.
+        The content is only hashed when the size matches but the mtime doesn't.
+        '''
+        entry = self.entries.get(os.path.basename(path))
+        if (entry is None):
+            return False
+        stat = os.stat(path)
+        if (stat.st_size != entry['size']):
+            return False
+        elif (stat.st_mtime == entry['mtime']):
+            return True
+        elif (SnapshotManifest.hash(path) == entry['hash']):
+            entry['mtime'] = stat.st_mtime
+            return True
+        else:
+            return False
+
+    def record(self: 'SnapshotManifest', path: str) -> None:
+        '''
+        Record the snapshot as ingested.
+        '''
+        stat = os.stat(path)
+        self.entries[os.path.basename(path)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': SnapshotManifest.hash(path)}
+
+    def to_file(self: 'SnapshotManifest', path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(dict(sorted(self.entries.items())), f, ensure_ascii=False, indent=2)
+
+    def __len__(self: 'SnapshotManifest') -> int:
+        return len(self.entries)
+
+    @classmethod
+    def load_file(cls, path: str) -> 'SnapshotManifest':
+        obj = cls()
+        if (os.path.exists(path)):
+            with open(path, 'r', encoding='utf-8') as f:
+                obj.entries = json.load(f)
+        return obj
+
+    @staticmethod
+    def get_path(history_path: str) -> str:
+        '''
+        Get the path of the manifest that belongs to the history file. Each output format has its own manifest,
+        e.g. `history.manifest.json` for `history.json` and `history.bin.manifest.json` for `history.bin`,
+        so snapshots ingested into one are not skipped for the other.
+        '''
+        root, ext = os.path.splitext(history_path)
+        # JSON histories keep the original name, so their existing manifests still apply.
+        return root + '.manifest.json' if ext == '.json' else history_path + '.manifest.json'
+
+    @staticmethod
+    def hash(path: str) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+@dataclass
+class SnapshotFile:
+    '''
+    The snapshot file and the slot it belongs to.
+    '''
+
+    path: str
+    '''
+    The file name in `DATA_DIR`.
+    '''
+
+    day_of_week: int
+    group: int
+    hour: int
+    minute: int
+
+    timestamp: datetime | None
+    '''
+    The time in the file name, or `None` if the file name has no date.
+    '''
+
 # Methods
-def get_history(history: LotsHistory) -> None:
-    file_count = 0
+def get_history(history: LotsHistory | OccupancyStats, manifest: SnapshotManifest | None = None, workers: int = 1, store_path: str | None = None) -> None:
+    '''
+    Ingest the snapshots in `DATA_DIR` into the history, in the order of their timestamps.
+
+    Parameters
+    ----------
+    history : LotsHistory | OccupancyStats
+        The history or statistics to write into.
+    manifest : SnapshotManifest, optional
+        The manifest of the snapshots already ingested, which is updated with the new ones.
+    workers : int, default 1
+        The number of processes parsing the snapshots. Each parses a contiguous run of snapshots into
+        a partial history, and the partials are applied in order, so later snapshots still win.
+        Partial statistics are simply added up.
+    store_path : str, optional
+        The observation store to also append every reading to.
+    '''
+    files, skip_count = get_snapshot_files(manifest)
+    read: list[str] = []
+
+    if (workers <= 1) or (len(files) <= 1):
+        read = read_snapshots(files, history, store_path)
+    else:
+        chunk_count = min(len(files), workers * 4)
+        chunks = [files[len(files) * i // chunk_count:len(files) * (i + 1) // chunk_count] for i in range(chunk_count)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            stats = [isinstance(history, OccupancyStats)] * chunk_count
+            for partial, partial_read in executor.map(read_partial, chunks, [store_path] * chunk_count, stats):
+                history.update(partial)
+                read.extend(partial_read)
+
+    if (manifest is not None):
+        for path_str in read:
+            manifest.record(os.path.join(DATA_DIR, path_str))
+    if (skip_count > 0):
+        log(f'Skipped {skip_count} files that were already ingested.', get_log_level(NONE))
+    log(f'Finished processing {len(files)} files. There are {len(history)} parking lots in the records.', get_log_level(NONE))
+
+def get_history_from_store(history: LotsHistory | OccupancyStats, store_path: str) -> None:
+    '''
+    Build the history or statistics from every observation in the store instead of parsing the snapshots.
+    '''
+    with ObservationStore(store_path) as store:
+        timestamps, lots, states = store.scan()
+        history.add_observations(store.get_ids(), lots, timestamps, states)
+    log(f'Finished folding {len(timestamps)} observations. There are {len(history)} parking lots in the records.', get_log_level(NONE))
+
+def get_log_level(level: Literal['info', 'none', 'verbose']) -> Literal[0, 1, 2]:
+    match level:
+        case 'info':
+            return 1
+        case 'none':
+            return 2
+        case 'verbose':
+            return 0
+        case _:
+            return 0
+
+def get_snapshot_files(manifest: SnapshotManifest | None = None) -> tuple[list[SnapshotFile], int]:
+    '''
+    List the snapshots in `DATA_DIR` that are not in the manifest, sorted by their timestamps.
+
+    Returns
+    -------
+    files : list[SnapshotFile]
+        The snapshots to ingest.
+    skip_count : int
+        The number of snapshots skipped because the manifest lists them.
+    '''
+    files: list[SnapshotFile] = []
+    skip_count = 0
 
     for path_str in os.listdir(DATA_DIR):
-        if (path_str.split('.')[-1] != 'geojson'):
+        if (path_str.split('.')[-1] not in ('geojson', 'snap')):
+            continue
+        elif (manifest is not None) and (manifest.is_ingested(os.path.join(DATA_DIR, path_str))):
+            skip_count += 1
             continue
         else:
             file_name = path_str.split('.')[0]
             time_components = file_name.split(' ')[0].split('-')
             if (len(time_components) != 4):
                 continue
-            day_of_week: int = 1
-            group: int = 0
-            hour: int = 0
-            minute: int = 0
-            file_count += 1
             try:
-                day_of_week = int(time_components[0])
-                hour = int(time_components[1])
-                minute = 10 * (int(time_components[2]) // 10)
                 group_match = re.search(r'(?<=\()\d+?(?=\))', file_name)
-                if (group_match is not None):
-                    group = int(group_match[0])
-                read_file(path_str, day_of_week, hour, minute, history)
+                files.append(SnapshotFile(path_str,
+                                          int(time_components[0]),
+                                          0 if group_match is None else int(group_match[0]),
+                                          int(time_components[1]),
+                                          10 * (int(time_components[2]) // 10),
+                                          get_snapshot_time(path_str)))
             except Exception as ex:
                 log(f'An error occured when identifying `{path_str}`...', get_log_level(NONE))
                 log(ex, get_log_level(NONE))
-            finally:
-                log(f'Successfully identified: G{group} | {WEEKDAY[day_of_week]} {hour:02}:{minute:02}', get_log_level(VERBOSE))
-    
-    log(f'Finished processing {file_count} files. There are {len(history)} parking lots in the records.', get_log_level(NONE))
 
-def get_log_level(level: Literal['info', 'none', 'verbose']) -> Literal[0, 1, 2]:
-    match level:
-        case 'info':
-            return 1
-        case 'none':
-            return 2
-        case 'verbose':
-            return 0
-        case _:
-            return 0
+    files.sort(key=lambda f: (f.timestamp or datetime.min, f.path))
+    return files, skip_count
+
+def get_snapshot_time(path: str) -> datetime | None:
+    '''
+    Get the time in the snapshot file name, e.g. `1-08-40-12 (2025-09-01)(2).geojson`.
+    '''
+    match = SNAPSHOT_NAME.match(os.path.basename(path))
+    if (match is None):
+        return None
+    try:
+        return datetime.strptime(f'{match[5]} {match[2]}:{match[3]}:{match[4]}', '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
 
 def log(msg: Any, level: Literal[0, 1, 2]) -> None:
     # if (level >= __log_level__):
@@ -153,20 +614,111 @@ def log(msg: Any, level: Literal[0, 1, 2]) -> None:
         with open(log_path, 'a', encoding='utf-8') as f:
             f.write(msg_str + '\n')
 
-def main(log_level: Literal['info', 'none', 'verbose'], load_file: str | None = None) -> None:
+def main(log_level: Literal['info', 'none', 'verbose'], load_file: str | None = None, rebuild: bool = False, workers: int = 1, store: str | None = None, from_store: bool = False, stats: bool = False, merge: list[str] | None = None, binary: bool = False) -> None:
     __log_level__ = get_log_level(log_level)
-    history = LotsHistory()
+    kind = OccupancyStats if stats else LotsHistory
+    output = STATS_FILE if stats else HISTORY_BINARY if binary else HISTORY_FILE
+    history = kind()
+    if (from_store):
+        if (store is None):
+            log('The observation store is not specified.', get_log_level(NONE))
+            return
+        get_history_from_store(history, store)
+        history.to_file(output)
+        # The store doesn't know which snapshots it came from, so the old manifest no longer describes the output.
+        SnapshotManifest().to_file(SnapshotManifest.get_path(output))
+        if (stats):
+            log(f'The manifest of `{output}` was reset. Loading it with -l would count every snapshot again, so rebuild it with --from-store instead.', get_log_level(NONE))
+        else:
+            log(f'The manifest of `{output}` was reset, so the next run with -l ingests every snapshot again.', get_log_level(NONE))
+        log('Finished processing.', get_log_level(NONE))
+        return
+
+    manifest = SnapshotManifest()
     if (load_file is not None):
-        history = LotsHistory.load_file(load_file)
-    get_history(history)
-    history.to_file(f'{DATA_DIR}/history.json')
+        try:
+            history = kind.load_file(load_file)
+        except ValueError as ex:
+            log(ex, get_log_level(NONE))
+            return
+        if (not rebuild):
+            manifest = SnapshotManifest.load_file(SnapshotManifest.get_path(load_file))
+    get_history(history, manifest, workers, store)
+    if (isinstance(history, OccupancyStats)):
+        for path in merge or []:
+            history.update(OccupancyStats.load_file(path))
+            log(f'Merged the statistics in `{path}`.', get_log_level(NONE))
+    history.to_file(output)
+    manifest.to_file(SnapshotManifest.get_path(output))
     log('Finished processing.', get_log_level(NONE))
 
-def read_file(path: str, day_of_week: int, hour: int, minute: int, history: LotsHistory) -> None:
-    gdf = gpd.read_file(f'{DATA_DIR}/{path}')
-    if (('id' in gdf.columns) & ('occupied' in gdf.columns)):
-        for (i, row) in gdf.iterrows():
-            history.add_history(row['id'], day_of_week, hour, minute, row['occupied'])
+def read_file(path: str, day_of_week: int, hour: int, minute: int, history: LotsHistory | OccupancyStats, store: ObservationStore | None = None) -> None:
+    columns: dict[str, Any]
+    try:
+        columns = read_snapshot(f'{DATA_DIR}/{path}', ('id', 'occupied', 'timestamp'))
+    except SnapshotFormatError:
+        # Fall back to GeoPandas for files not written by the crawler.
+        import geopandas as gpd
+        gdf = gpd.read_file(f'{DATA_DIR}/{path}')
+        if (('id' not in gdf.columns) | ('occupied' not in gdf.columns)):
+            return
+        columns = {k: gdf[k].to_numpy() for k in ('id', 'occupied', 'timestamp') if k in gdf.columns}
+    if (isinstance(history, OccupancyStats)):
+        history.add_snapshot(columns['id'], columns['occupied'], day_of_week, hour * 6 + minute // 10, get_snapshot_time(path))
+    else:
+        history.add_snapshot(columns['id'], columns['occupied'], day_of_week, hour * 6 + minute // 10)
+
+    if (store is not None):
+        # Readings without their own time take the time in the file name.
+        fallback = get_snapshot_time(path)
+        timestamps = columns.get('timestamp', np.full(len(columns['id']), None))
+        timestamps = [t if t is not None else fallback.isoformat() if fallback is not None else None for t in timestamps]
+        known = np.array([t is not None for t in timestamps], dtype=bool)
+        if (known.any()):
+            store.append(np.asarray(columns['id'], dtype=object)[known],
+                         np.asarray(columns['occupied'], dtype=object)[known],
+                         [t for t in timestamps if t is not None])
+
+def read_partial(files: list[SnapshotFile], store_path: str | None = None, stats: bool = False) -> tuple[LotsHistory | OccupancyStats, list[str]]:
+    '''
+    Read the snapshots into a new partial history, or partial statistics if `stats` is set. This runs in the
+    worker processes, each appending to the observation store through its own connection.
+    '''
+    partial: LotsHistory | OccupancyStats
+    if (stats):
+        partial = OccupancyStats()
+        read = read_snapshots(files, partial, store_path)
+        partial.observed = partial.observed[:len(partial)]
+        partial.occupied = partial.occupied[:len(partial)]
+        partial.seen = partial.seen[:len(partial)]
+    else:
+        partial = LotsHistory(fill=UNSET)
+        read = read_snapshots(files, partial, store_path)
+        partial.cube = partial.cube[:len(partial)]
+    return partial, read
+
+def read_snapshots(files: list[SnapshotFile], history: LotsHistory | OccupancyStats, store_path: str | None = None) -> list[str]:
+    '''
+    Read the snapshots into the history in order.
+
+    Returns
+    -------
+    read : list[str]
+        The file names read successfully.
+    '''
+    read: list[str] = []
+    store = None if store_path is None else ObservationStore(store_path)
+    for file in files:
+        try:
+            read_file(file.path, file.day_of_week, file.hour, file.minute, history, store)
+            read.append(file.path)
+            log(f'Successfully identified: G{file.group} | {WEEKDAY[file.day_of_week]} {file.hour:02}:{file.minute:02}', get_log_level(VERBOSE))
+        except Exception as ex:
+            log(f'An error occured when identifying `{file.path}`...', get_log_level(NONE))
+            log(ex, get_log_level(NONE))
+    if (store is not None):
+        store.close()
+    return read
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Aggregate GeoJSON files into one JSON.')
@@ -179,7 +731,53 @@ if __name__ == '__main__':
         '--load-file', '-l',
         type=str,
         default=None,
-        help='Loads history file.'
+        help='Loads history file. Only the snapshots not listed in its manifest are ingested.'
+    )
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='Ignore the manifest and ingest every snapshot.'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=1,
+        help='The number of processes parsing the snapshots.'
+    )
+    parser.add_argument(
+        '--store', '-s',
+        type=str,
+        default=None,
+        help='The SQLite observation store to also append every reading to.'
+    )
+    parser.add_argument(
+        '--from-store',
+        action='store_true',
+        help='Build history.json from the observation store instead of the snapshots.'
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Accumulate multi-week occupancy counts and rates into history-stats.json instead of history.json.'
+    )
+    parser.add_argument(
+        '--merge', '-m',
+        type=str,
+        nargs='*',
+        default=None,
+        help='With --stats, also add the counts of these statistics files.'
+    )
+    parser.add_argument(
+        '--binary', '-b',
+        action='store_true',
+        help='Write the memory-mappable history.bin instead of history.json. Use history.py to convert between them.'
     )
     args = parser.parse_args()
-    main('verbose' if args.verbose else 'info', args.load_file)
\ No newline at end of file
+    if (args.binary) and (args.stats):
+        parser.error('--binary does not work with --stats.')
+    if (args.from_store) and ((args.load_file is not None) or (args.rebuild)):
+        parser.error('--load-file and --rebuild do not work with --from-store, which always builds the output from the whole store.')
+    if (args.stats) and (args.rebuild) and (args.load_file is not None):
+        # Ingesting every snapshot again on top of the loaded counts would count each of them twice.
+        parser.error('--rebuild does not work with --stats and --load-file. Rebuild the statistics without --load-file.')
+    main('verbose' if args.verbose else 'info', args.load_file, args.rebuild, args.workers, args.store, args.from_store, args.stats, args.merge, args.binary)
\ No newline at end of file
@@ -0,0 +1,418 @@
+import aggregate
+from aggregate import LotsHistory
+import argparse
+from contextlib import redirect_stdout
+from crawler import GeometryCache, LotCollection, get_probe_coords, parse_lot_info, search_geometry
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import extract
+import gc
+from history import HistoryFile
+import json
+import numpy as np
+import os
+import platform
+from replay import ParkingAPI
+import shapely
+import statistics
+import sys
+import tempfile
+from time import perf_counter, sleep
+from typing import Any, Callable, Optional
+
+# Constants
+BASELINE = './data/benchmark-baseline.json'
+CONFIRM = 2
+CONFIRM_PAUSE = 2
+'''
+A benchmark that looks regressed is timed again in up to `CONFIRM` more rounds, each after a pause of this many seconds,
+so a burst of load on the machine doesn't fail the check.
+'''
+LOG_DIR = './script/log'
+MAX_REPEAT = 50
+MIN_SECONDS = 0.5
+'''
+Fast benchmarks are timed more than `repeat` times, until they have run for this many seconds or `MAX_REPEAT` times.
+'''
+MIN_SLOWDOWN = 0.001
+'''
+The smallest slowdown in seconds reported as a regression, so timer noise on fast benchmarks doesn't fail the check.
+'''
+OUTPUT = './data/benchmark.json'
+REPEAT = 3
+ROADS = ('中山北路', '仁愛路', '信義路', '南京東路', '和平東路', '敦化南路', '民生東路', '忠孝東路', '復興南路', '羅斯福路')
+SIZES = {'small': {'lots': 200, 'days': 1},
+         'medium': {'lots': 1000, 'days': 2},
+         'large': {'lots': 2500, 'days': 7}}
+'''
+The number of lots and days of 10-minute snapshots of each data size. One week of `large` is about 2 GB.
+'''
+SLOT = 600
+START = datetime(2025, 9, 1)
+THRESHOLD = 0.2
+
+# Classes
+@dataclass
+class Dataset:
+    '''
+    The synthetic data of one size.
+    '''
+
+    directory: str
+    '''
+    The directory of the snapshots, which stands in for `DATA_DIR`.
+    '''
+
+    features: list[dict[str, Any]]
+    '''
+    The lot catalog in the format of `realtime-lot.geojson`.
+    '''
+
+    payloads: list[bytes]
+    '''
+    The API response of every probe of the crawler's lattice.
+    '''
+
+    snapshots: int
+    '''
+    The number of snapshot files.
+    '''
+
+# Methods
+def compare(results: dict[str, Any], baseline: dict[str, Any], threshold: float = THRESHOLD) -> list[str]:
+    '''
+    Compare the fastest times with the baseline, and log the change of every benchmark both have. The fastest run
+    is the least disturbed by the rest of the machine, so it's steadier than the median over a few runs.
+
+    Returns
+    -------
+    regressions: list[str]
+        The benchmarks that regressed according to `is_regressed`, as `size/name`.
+    '''
+    regressions: list[str] = []
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            base = baseline.get(size, {}).get(name)
+            if (base is None) or (base.get('min', base['median']) <= 0):
+                continue
+            fastest = base.get('min', base['median'])
+            change = result['min'] / fastest - 1
+            regressed = is_regressed(result, base, threshold)
+            if (regressed):
+                regressions.append(f'{size}/{name}')
+            state = 'REGRESSED' if regressed else 'improved' if change < -threshold else 'ok'
+            log(f'{size:<7} {name:<19} {fastest * 1000:10.1f} → {result["min"] * 1000:10.1f} ms ({change:+.1%}, {state})')
+    return regressions
+
+def generate(directory: str, lot_count: int, days: int, seed: int = 0) -> Dataset:
+    '''
+    Generate realistic synthetic data: lots inside `SEARCH_BOUND` on real road names, `days` of 10-minute snapshots
+    in the format of `LotCollection.to_geojson_file`, and the API payloads of the crawler's lattice.
+    Each lot has its own occupancy rate and turnover, and a sweep misses about 1% of the lots.
+    '''
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = search_geometry.bounds
+    centers = np.zeros((0, 2))
+    while (len(centers) < lot_count):
+        candidates = rng.uniform((minx, miny), (maxx, maxy), (lot_count * 2, 2))
+        centers = np.vstack([centers, candidates[shapely.contains_xy(search_geometry, candidates[:, 0], candidates[:, 1])]])
+    centers = centers[:lot_count]
+
+    # A lot is a 5.5 m × 2.5 m rectangle along a random bearing.
+    angle = rng.uniform(0, np.pi, lot_count)
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1], [-1, -1]]) * (2.75e-5, 1.25e-5)
+    rotated = np.einsum('ij,njk->nik', corners, np.stack([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]]).transpose(2, 0, 1))
+    features = []
+    for i, ((x, y), ring) in enumerate(zip(centers, rotated)):
+        road = f'{ROADS[rng.integers(len(ROADS))]}{rng.integers(1, 6)}段'
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'Polygon', 'coordinates': [(ring + (x, y)).round(8).tolist()]},
+                         'properties': {'id': f'{road}_{1000 + i}',
+                                        'name': road,
+                                        'service': '週一至週六 08:00~20:00' if rng.random() < 0.8 else '每日 00:00~24:00',
+                                        'toll': int(rng.choice([20, 30, 40, 50]))}})
+
+    os.makedirs(directory, exist_ok=True)
+    rates = rng.beta(2, 2, lot_count)
+    turnover = rng.uniform(0.02, 0.3, lot_count)
+    occupied = rng.random(lot_count) < rates
+    snapshots = days * 24 * 6
+    for k in range(snapshots):
+        slot = START + timedelta(seconds=k * SLOT)
+        changed = rng.random(lot_count) < turnover
+        occupied = np.where(changed, rng.random(lot_count) < rates, occupied)
+        seen = rng.random(lot_count) >= 0.01
+        saved = slot + timedelta(seconds=int(rng.integers(120, 420)))
+        lot_features = [{'type': 'Feature',
+                         'geometry': features[i]['geometry'],
+                         'properties': {'id': features[i]['properties']['id'],
+                                        'name': features[i]['properties']['name'],
+                                        'service': features[i]['properties']['service'],
+                                        'timestamp': (slot + timedelta(seconds=int(s))).isoformat(),
+                                        'toll': features[i]['properties']['toll'],
+                                        'occupied': bool(occupied[i])}}
+                        for i, s in zip(np.flatnonzero(seen).tolist(), rng.integers(0, 300, lot_count).tolist())]
+        with open(os.path.join(directory, saved.strftime('%u-%H-%M-%S (%Y-%m-%d)') + '.geojson'), 'w', encoding='utf-8') as f:
+            json.dump({'type': 'FeatureCollection', 'features': lot_features, 'timestamp': slot.isoformat()}, f, ensure_ascii=False, indent=2)
+
+    api = ParkingAPI(features, seed=seed)
+    payloads = []
+    for lon, lat in get_probe_coords(0):
+        found = api.get_lots(lon, lat)
+        payloads.append(b'[' + b','.join([api.records[i][int(api.random.random() < rates[i])] for i in found.tolist()]) + b']')
+    return Dataset(directory, features, payloads, snapshots)
+
+def get_benchmarks(data: Dataset, workspace: str) -> dict[str, Callable[[], int]]:
+    '''
+    Prepare the benchmarks of one data size. Each returns the number of items it processed.
+    '''
+    records = [json.loads(payload) for payload in data.payloads]
+    collections: list[LotCollection] = []
+    cache = GeometryCache()
+    for probe in records:
+        cache.parse(probe)
+        lots = LotCollection(datetime.now())
+        for record in probe:
+            lots.append(parse_lot_info(record, lots.timestamp, cache))
+        collections.append(lots)
+    merged = LotCollection(datetime.now(), intern=True)
+    for lots in collections:
+        merged.merge(lots, inplace=True)
+
+    def parse() -> int:
+        # As a probe does: decode the payload, look the shapes up in the warm cache, and parse every record.
+        count = 0
+        for payload in data.payloads:
+            probe = json.loads(payload)
+            cache.parse(probe)
+            timestamp = datetime.now()
+            for record in probe:
+                parse_lot_info(record, timestamp, cache)
+            count += len(probe)
+        return count
+
+    def merge() -> int:
+        lots = LotCollection(datetime.now(), intern=True)
+        for sub_lots in collections:
+            lots.merge(sub_lots, inplace=True)
+        return sum(len(x.lots) for x in collections)
+
+    def to_geojson_file() -> int:
+        merged.to_geojson_file(os.path.join(workspace, 'sweep.geojson'))
+        return len(merged.lots)
+
+    def get_history() -> int:
+        aggregate.get_history(LotsHistory())
+        return data.snapshots
+
+    history = LotsHistory()
+    def dump_history() -> int:
+        history.to_file(os.path.join(workspace, 'history.json'))
+        return len(history)
+
+    def dump_history_binary() -> int:
+        history.to_file(os.path.join(workspace, 'history.bin'))
+        return len(history)
+
+    def load_history() -> int:
+        return len(LotsHistory.load_file(os.path.join(workspace, 'history.json')))
+
+    def load_history_binary() -> int:
+        # Open the mapped file and read one lot, as the consumers looking up single lots do.
+        binary = HistoryFile(os.path.join(workspace, 'history.bin'))
+        if (len(binary) > 0):
+            binary.get(binary.ids[-1])
+        return len(binary)
+
+    def get_static_data() -> int:
+        extract.get_static_data()
+        return data.snapshots
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        aggregate.get_history(history)
+    dump_history()
+    dump_history_binary()
+    return {'parse_lot_info': parse,
+            'merge': merge,
+            'to_geojson_file': to_geojson_file,
+            'get_history': get_history,
+            'history_dump': dump_history,
+            'history_dump_binary': dump_history_binary,
+            'history_load': load_history,
+            'history_load_binary': load_history_binary,
+            'get_static_data': get_static_data}
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'benchmark.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def main(sizes: list[str], names: Optional[list[str]] = None, repeat: int = REPEAT, seed: int = 0, workspace: Optional[str] = None,
+         baseline: str = BASELINE, save_baseline: bool = False, threshold: float = THRESHOLD, output: Optional[str] = OUTPUT) -> bool:
+    '''
+    Run the benchmarks and compare them with the baseline.
+
+    Returns
+    -------
+    passed: bool
+        `False` if any benchmark regressed by more than `threshold`.
+    '''
+    results: dict[str, dict[str, dict[str, Any]]] = {}
+    reference: Optional[dict[str, Any]] = None
+    if (not save_baseline) and (os.path.exists(baseline)):
+        with open(baseline, 'r', encoding='utf-8') as f:
+            reference = json.load(f)
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as temp:
+        root = temp if workspace is None else workspace
+        for size in sizes:
+            lot_count, days = SIZES[size]['lots'], SIZES[size]['days']
+            directory = os.path.join(root, f'{size}-{lot_count}-{days}-{seed}')
+            start = perf_counter()
+            data = generate(directory, lot_count, days, seed)
+            log(f'Generated {size}: {lot_count} lots, {data.snapshots} snapshots and {len(data.payloads)} payloads in {perf_counter() - start:.1f} seconds.')
+
+            # The stages read `DATA_DIR` and log to `LOG_DIR` when called, so they're pointed at the synthetic data.
+            aggregate.DATA_DIR = extract.DATA_DIR = directory
+            aggregate.LOG_DIR = extract.LOG_DIR = os.path.join(root, 'log')
+            benchmarks = get_benchmarks(data, root)
+            results[size] = {}
+            for name, function in benchmarks.items():
+                if (names is not None) and (name not in names):
+                    continue
+                times, count = measure(function, repeat)
+                base = None if reference is None else reference['results'].get(size, {}).get(name)
+                for _ in range(CONFIRM):
+                    if (base is None) or (not is_regressed(summarize(times), base, threshold)):
+                        break
+                    sleep(CONFIRM_PAUSE)
+                    times += measure(function, repeat)[0]
+                median = statistics.median(times)
+                results[size][name] = {**summarize(times), 'runs': len(times), 'items': count,
+                                       'per_second': round(count / median, 1) if median > 0 else None}
+                log(f'{size:<7} {name:<19} {median * 1000:10.1f} ms (min {min(times) * 1000:.1f} ms, {count / median:,.0f} items/s)')
+
+    report = {'created': datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'machine': platform.platform(),
+              'repeat': repeat,
+              'seed': seed,
+              'sizes': {size: SIZES[size] for size in sizes},
+              'results': results}
+    if (output is not None):
+        write_report(output, report)
+        log(f'The results were saved to `{output}`.')
+
+    passed = True
+    if (save_baseline):
+        write_report(baseline, report)
+        log(f'The results were saved as the baseline `{baseline}`.')
+    elif (reference is not None):
+        log(f'Comparing with the baseline of {reference["created"]} (threshold {threshold:.0%}).')
+        regressions = compare(results, reference['results'], threshold)
+        if (regressions):
+            log(f'{len(regressions)} benchmarks regressed: {", ".join(regressions)}.')
+            passed = False
+    else:
+        log(f'There is no baseline at `{baseline}`. Save one with --save-baseline.')
+    return passed
+
+def is_regressed(result: dict[str, Any], base: dict[str, Any], threshold: float = THRESHOLD) -> bool:
+    '''
+    Check whether the fastest run is more than `threshold` slower than that of the baseline, by more than
+    `MIN_SLOWDOWN` and the spread between the median and the fastest run of both.
+    '''
+    fastest = base.get('min', base['median'])
+    if (fastest <= 0):
+        return False
+    noise = max(MIN_SLOWDOWN, (base['median'] - fastest) + (result['median'] - result['min']))
+    return (result['min'] / fastest - 1 > threshold) and (result['min'] - fastest > noise)
+
+def measure(function: Callable[[], int], repeat: int) -> tuple[list[float], int]:
+    '''
+    Time the function `repeat` times after a warm-up run, with the garbage collected before each run
+    and the pipeline's console logging silenced. Fast functions are timed again until they have run for
+    `MIN_SECONDS`, up to `MAX_REPEAT` times.
+    '''
+    times: list[float] = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        count = function()
+        while (len(times) < repeat) or ((sum(times) < MIN_SECONDS) and (len(times) < MAX_REPEAT)):
+            gc.collect()
+            start = perf_counter()
+            function()
+            times.append(perf_counter() - start)
+    return times, count
+
+def summarize(times: list[float]) -> dict[str, float]:
+    return {'median': round(statistics.median(times), 6), 'min': round(min(times), 6)}
+
+def write_report(path: str, report: dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data and compare them with a baseline.')
+    parser.add_argument(
+        '--sizes', '-z',
+        type=str,
+        nargs='+',
+        choices=list(SIZES),
+        default=['small', 'medium'],
+        help='The data sizes to benchmark.'
+    )
+    parser.add_argument(
+        '--benchmarks', '-k',
+        type=str,
+        nargs='+',
+        choices=['parse_lot_info', 'merge', 'to_geojson_file', 'get_history', 'history_dump', 'history_dump_binary', 'history_load', 'history_load_binary', 'get_static_data'],
+        default=None,
+        help='The benchmarks to run. All of them by default.'
+    )
+    parser.add_argument(
+        '--repeat', '-r',
+        type=int,
+        default=REPEAT,
+        help='The number of timed runs of each benchmark, after one warm-up run.'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The seed of the synthetic data.'
+    )
+    parser.add_argument(
+        '--workspace', '-w',
+        type=str,
+        default=None,
+        help='The directory to generate the data in and keep it. A temporary directory is used and removed by default.'
+    )
+    parser.add_argument(
+        '--baseline', '-b',
+        type=str,
+        default=BASELINE,
+        help='The baseline to compare with.'
+    )
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Save the results as the new baseline instead of comparing.'
+    )
+    parser.add_argument(
+        '--threshold', '-t',
+        type=float,
+        default=THRESHOLD,
+        help='The slowdown of the median time that counts as a regression.'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=OUTPUT,
+        help='The path to the results.'
+    )
+    args = parser.parse_args()
+    sys.exit(0 if main(args.sizes, args.benchmarks, args.repeat, args.seed, args.workspace, args.baseline, args.save_baseline, args.threshold, args.output) else 1)
@@ -0,0 +1,499 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import crawler
+from crawler import (METRICS_DIR, PROBE_PLAN, RETRY_ROUNDS, SLOT, SPACING, LotCollection, SessionPool, TokenBucket, get_backoff, get_breaker,
+                     get_group_coords, get_parking_status_at, get_probe_coords, get_slot, load_probe_plan, save_lots, wait_for_slot)
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import json
+import logging
+from loadtest import get_free_port, wait_ready
+from math import ceil
+import os
+import random
+import requests
+import shutil
+from snapshot import CATALOG_DIR, LotCatalog
+import socket
+import subprocess
+import sys
+from time import perf_counter, sleep, time
+from typing import Any, Iterator, Optional
+
+# Constants
+CLAIM_TIMEOUT = 120
+LOG_DIR = './script/log'
+POLL = 0.5
+QUEUE_DIR = './data/queue'
+STATES = ('pending', 'claimed', 'results', 'failed')
+
+# Variables
+role = 'cluster'
+'''
+The role of this process in the log, e.g. `coordinator` or `worker host-1234`.
+'''
+
+# Classes
+@dataclass
+class Probe:
+    '''
+    A probe published to the queue.
+    '''
+
+    name: str
+    '''
+    The file name of the probe, `<index>.json`.
+    '''
+
+    lon: float
+    lat: float
+    group: int
+
+    attempt: int = 0
+    '''
+    The number of times the probe has failed and been requeued.
+    '''
+
+    @property
+    def stem(self: 'Probe') -> str:
+        return self.name.split('.')[0]
+
+@dataclass
+class SlotInfo:
+    '''
+    A slot published to the queue.
+    '''
+
+    id: str
+    slot: datetime
+    deadline: datetime
+    total: int
+
+class ProbeQueue:
+    '''
+    The file-based queue of the probes of each slot, in a directory that the coordinator and the workers share,
+    possibly over a network file system. Every state change is an atomic rename, so a probe is claimed by exactly
+    one worker and a result is never read half-written. Each slot is a directory:
+
+    * `slot.json`—the slot, its deadline and the number of probes
+    * `pending/`—the probes waiting for a worker. A requeued probe is not due before its modification time
+    * `claimed/`—the probes being fetched, named `<index>.<worker>.json`, with the time of the claim as their modification time
+    * `results/`—the partial collection of each finished probe
+    * `failed/`—the probes given up after `RETRY_ROUNDS` retries
+    '''
+
+    root: str
+    '''
+    The shared directory.
+    '''
+
+    def __init__(self: 'ProbeQueue', root: str = QUEUE_DIR) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def claim(self: 'ProbeQueue', info: SlotInfo, worker: str) -> Iterator[Probe]:
+        '''
+        Claim the due pending probes of the slot one by one, in random order so that workers rarely race for the same
+        file, until there are none left or the deadline has passed. Probes requeued in the meantime are picked up
+        once the others are claimed and their backoff is over.
+        '''
+        directory = self.get_path(info)
+        while True:
+            names = []
+            try:
+                now = time()
+                for entry in os.scandir(os.path.join(directory, 'pending')):
+                    if (not entry.name.startswith('.')) and (entry.stat().st_mtime <= now):
+                        names.append(entry.name)
+            except FileNotFoundError:
+                return
+            if (not names):
+                return
+            random.shuffle(names)
+            for name in names:
+                if (datetime.now() >= info.deadline):
+                    return
+                source = os.path.join(directory, 'pending', name)
+                path = os.path.join(directory, 'claimed', f'{name.split(".")[0]}.{worker}.json')
+                try:
+                    # The rename keeps the modification time, so stamp the claim before it. Otherwise `reclaim`
+                    # could see a fresh claim as stale in between.
+                    os.utime(source)
+                    os.rename(source, path)
+                    with open(path, 'r', encoding='utf-8') as f:
+                        yield Probe(name, **json.load(f))
+                except (FileNotFoundError, ValueError):
+                    continue
+
+    def collect(self: 'ProbeQueue', info: SlotInfo) -> LotCollection:
+        '''
+        Merge the partial collections of the slot. The probes without a result are counted as abandoned.
+        '''
+        directory = os.path.join(self.get_path(info), 'results')
+        lots = LotCollection(info.slot, intern=True)
+        workers: set[str] = set()
+        for name in os.listdir(directory):
+            if (name.startswith('.')):
+                continue
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                partial = json.load(f)
+            lots.merge(LotCollection.from_dict(partial), inplace=True)
+            workers.add(partial['worker'])
+            if (partial['attempt'] == 0):
+                lots.stats.succeeded += 1
+            else:
+                lots.stats.recovered += 1
+        lots.stats.abandoned = info.total - lots.stats.succeeded - lots.stats.recovered
+        lots.timestamp = info.slot
+        log(f'Merged the results of {len(workers)} workers: {", ".join(sorted(workers))}.')
+        return lots
+
+    def complete(self: 'ProbeQueue', info: SlotInfo, probe: Probe, worker: str, lots: Optional[LotCollection]) -> bool:
+        '''
+        Publish the result of a claimed probe, or requeue it if it failed and has retries left. A requeued probe
+        is due after a jittered exponential backoff, or once the circuit breaker of this worker closes.
+
+        Returns
+        -------
+        result: bool
+            `False` if the slot was already closed by the coordinator.
+        '''
+        directory = self.get_path(info)
+        try:
+            if (lots is not None):
+                self.write(info, os.path.join('results', probe.name),
+                           {'lon': probe.lon, 'lat': probe.lat, 'group': probe.group, 'attempt': probe.attempt, 'worker': worker, **lots.to_dict()})
+            else:
+                state = 'pending' if probe.attempt < RETRY_ROUNDS else 'failed'
+                due = time() + max(get_backoff(probe.attempt), get_breaker(crawler.URL).remaining) if state == 'pending' else None
+                self.write(info, os.path.join(state, probe.name), {'lon': probe.lon, 'lat': probe.lat, 'group': probe.group, 'attempt': probe.attempt + 1}, due)
+            os.remove(os.path.join(directory, 'claimed', f'{probe.stem}.{worker}.json'))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def count(self: 'ProbeQueue', info: SlotInfo) -> dict[str, int]:
+        directory = self.get_path(info)
+        return {state: sum(not name.startswith('.') for name in os.listdir(os.path.join(directory, state))) for state in STATES}
+
+    def get_path(self: 'ProbeQueue', info: SlotInfo) -> str:
+        return os.path.join(self.root, info.id)
+
+    def get_slots(self: 'ProbeQueue') -> list[SlotInfo]:
+        '''
+        Get the open slots, oldest first.
+        '''
+        slots = []
+        for name in sorted(os.listdir(self.root)):
+            if (name.startswith('.')):
+                continue
+            try:
+                with open(os.path.join(self.root, name, 'slot.json'), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                continue
+            slots.append(SlotInfo(name, datetime.fromisoformat(data['slot']), datetime.fromisoformat(data['deadline']), data['total']))
+        return slots
+
+    def publish(self: 'ProbeQueue', slot: datetime, deadline: datetime, probes: list[tuple[float, float, int]]) -> SlotInfo:
+        '''
+        Publish the probes of a slot. The slot is built in a hidden directory and renamed into place,
+        so workers never see it half-written.
+
+        Parameter
+        -------
+        probes: list[tuple[float, float, int]]
+            The longitude, latitude and group of each probe. Workers claim them in random order.
+        '''
+        info = SlotInfo(slot.strftime('%Y%m%d-%H%M%S'), slot, deadline, len(probes))
+        staging = os.path.join(self.root, f'.{info.id}.tmp')
+        shutil.rmtree(staging, ignore_errors=True)
+        for state in STATES:
+            os.makedirs(os.path.join(staging, state))
+        width = len(str(max(len(probes) - 1, 0)))
+        for i, (lon, lat, group) in enumerate(probes):
+            with open(os.path.join(staging, 'pending', f'{i:0{width}}.json'), 'w', encoding='utf-8') as f:
+                json.dump({'lon': lon, 'lat': lat, 'group': group}, f)
+        with open(os.path.join(staging, 'slot.json'), 'w', encoding='utf-8') as f:
+            json.dump({'slot': slot.isoformat(), 'deadline': deadline.isoformat(), 'total': len(probes)}, f)
+        self.remove(info)
+        os.rename(staging, self.get_path(info))
+        return info
+
+    def reclaim(self: 'ProbeQueue', info: SlotInfo, timeout: float = CLAIM_TIMEOUT) -> int:
+        '''
+        Move the probes claimed more than `timeout` seconds ago back to pending, in case their worker died.
+        The modification time of a claimed probe is the time it was claimed.
+
+        Returns
+        -------
+        count: int
+            The number of probes moved back.
+        '''
+        directory = self.get_path(info)
+        count = 0
+        now = datetime.now().timestamp()
+        for entry in os.scandir(os.path.join(directory, 'claimed')):
+            try:
+                if (now - entry.stat().st_mtime > timeout):
+                    os.rename(entry.path, os.path.join(directory, 'pending', f'{entry.name.split(".")[0]}.json'))
+                    count += 1
+            except FileNotFoundError:
+                continue
+        return count
+
+    def remove(self: 'ProbeQueue', info: SlotInfo) -> None:
+        '''
+        Close the slot. It's renamed first, so the workers see it disappear at once.
+        '''
+        path = self.get_path(info)
+        if (os.path.exists(path)):
+            closed = os.path.join(self.root, f'.{info.id}.closed')
+            shutil.rmtree(closed, ignore_errors=True)
+            os.rename(path, closed)
+            shutil.rmtree(closed, ignore_errors=True)
+
+    def write(self: 'ProbeQueue', info: SlotInfo, name: str, data: dict[str, Any], mtime: Optional[float] = None) -> None:
+        '''
+        Write a file of the slot atomically, through a hidden file in the slot directory. The modification time,
+        if given, is set before the file appears.
+        '''
+        directory = self.get_path(info)
+        temp = os.path.join(directory, f'.{os.path.basename(name)}.{os.getpid()}.{id(data)}.tmp')
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        if (mtime is not None):
+            os.utime(temp, (mtime, mtime))
+        os.replace(temp, os.path.join(directory, name))
+
+# Methods
+def coordinate(queue: ProbeQueue, groups: list[int], max_runs: Optional[int] = None, quorum: float = 1, metrics_dir: str = METRICS_DIR) -> None:
+    '''
+    Publish the probes of every slot, and merge the results into one snapshot once every probe has finished,
+    a `quorum` share of them has a result, or the deadline of the slot has passed.
+    '''
+    g = groups[0] if len(groups) == 1 else 0
+    owners = {coord: group for group in groups for coord in get_probe_coords(group)}
+    count = 0
+    slot = get_slot(datetime.now())
+    deadline = datetime.now() + timedelta(seconds=SLOT)
+    try:
+        while True:
+            start = perf_counter()
+            info = queue.publish(slot, deadline, [(lon, lat, owners[(lon, lat)]) for lon, lat in get_group_coords(groups)])
+            log(f'Published {info.total} probes for the slot at {slot:%H:%M}, due at {deadline:%H:%M:%S}.')
+            while True:
+                sleep(POLL)
+                reclaimed = queue.reclaim(info)
+                if (reclaimed):
+                    log(f'Requeued {reclaimed} probes whose workers stopped responding.', level=logging.WARNING)
+                counts = queue.count(info)
+                if (counts['results'] + counts['failed'] >= info.total):
+                    reason = 'every probe finished'
+                elif (counts['results'] >= ceil(quorum * info.total)):
+                    reason = f'the quorum of {quorum:.0%} was reached'
+                elif (datetime.now() >= deadline):
+                    reason = 'the deadline passed'
+                else:
+                    continue
+                break
+
+            lots = queue.collect(info)
+            queue.remove(info)
+            elapsed = perf_counter() - start
+            crawler.metrics.observe_sweep(g, slot, elapsed, info.total, len(lots.lots), lots.stats)
+            log(f'Merging the slot at {slot:%H:%M} as {reason} after {elapsed:.1f} seconds: {lots.stats.succeeded} succeeded, '
+                f'{lots.stats.recovered} recovered, {lots.stats.abandoned} abandoned, {len(lots.lots)} parking lots.')
+            save_lots(lots, g, slot)
+            crawler.metrics.write(metrics_dir, g)
+
+            count += 1
+            if (max_runs) and (count >= max_runs):
+                log('Reached maximum runs. Exiting...')
+                break
+            slot = wait_for_slot(slot if count > 1 else get_slot(datetime.now()), g)
+            deadline = slot + timedelta(seconds=SLOT)
+    except KeyboardInterrupt:
+        log('Terminated by user (Ctrl+C). Exiting gracefully...')
+
+def fetch(queue: ProbeQueue, info: SlotInfo, probe: Probe, worker: str, s: requests.Session) -> None:
+    try:
+        lots = get_parking_status_at(s, probe.lon, probe.lat, probe.group, probe.attempt)
+    except Exception as ex:
+        log(f'Failed at ({probe.lon}, {probe.lat}) [Attempt {probe.attempt + 1}]: {ex}', level=logging.WARNING)
+        lots = None
+    queue.complete(info, probe, worker, lots)
+
+def local(workers: int, base: Optional[str], max_runs: int, groups: list[int], quorum: float, concurrency: int, spacing: float,
+          queue_dir: str, server_args: Optional[list[str]] = None) -> None:
+    '''
+    Run a coordinator and several worker processes on this machine, against a stand-in of the API
+    started by `replay.py` unless `base` is given.
+    '''
+    processes: list[subprocess.Popen] = []
+    try:
+        if (base is None):
+            port = get_free_port()
+            server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'replay.py'), '--port', str(port), *(server_args or [])],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            processes.append(server)
+            base = f'http://127.0.0.1:{port}'
+            wait_ready(base, server)
+        for i in range(workers):
+            processes.append(subprocess.Popen([sys.executable, __file__, 'worker', '--queue', queue_dir, '--url', base, '--id', f'local-{i + 1}',
+                                               '--concurrency', str(concurrency), '--spacing', str(spacing)]))
+        log(f'Started {workers} workers against {base}.')
+        coordinate(ProbeQueue(queue_dir), groups, max_runs, quorum)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+def log(msg: Any, group: int = 0, level: int = logging.INFO) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] [{role}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'cluster.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def work(queue: ProbeQueue, worker: str, concurrency: int = 1, metrics_dir: str = METRICS_DIR) -> None:
+    '''
+    Claim and fetch the probes of the oldest open slot, through one session, until stopped.
+    The slot is polled until the coordinator closes it, so probes requeued by other workers are picked up too.
+    '''
+    pool = SessionPool(concurrency, path=None)
+    crawler.session_pool = pool
+    current: Optional[str] = None
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            while True:
+                slots = [info for info in queue.get_slots() if datetime.now() < info.deadline]
+                if (not slots):
+                    sleep(POLL)
+                    continue
+                info = slots[0]
+                if (info.id != current):
+                    if (current is not None):
+                        crawler.metrics.write(metrics_dir, name=f'worker_{worker}')
+                    if (not pool.ensure()):
+                        sleep(POLL)
+                        continue
+                    current = info.id
+                claimed = 0
+                in_flight: set[Future] = set()
+                for probe in queue.claim(info, worker):
+                    if (len(in_flight) >= concurrency):
+                        _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    in_flight.add(executor.submit(fetch, queue, info, probe, worker, pool.session))
+                    claimed += 1
+                wait(in_flight)
+                if (claimed):
+                    log(f'Fetched {claimed} probes of the slot at {info.slot:%H:%M}.')
+                else:
+                    sleep(POLL)
+    except KeyboardInterrupt:
+        log('Terminated by user (Ctrl+C). Exiting gracefully...')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl with a coordinator and several workers sharing a queue directory.')
+    parser.add_argument(
+        'mode',
+        choices=['coordinator', 'worker', 'local'],
+        help='`coordinator` publishes the probes of each slot and merges the results, `worker` fetches them, '
+             'and `local` runs a coordinator and several workers on this machine against a stand-in of the API.'
+    )
+    parser.add_argument(
+        '--queue', '-q',
+        type=str,
+        default=QUEUE_DIR,
+        help='The queue directory shared by the coordinator and the workers.'
+    )
+    parser.add_argument(
+        '--group', '-g',
+        type=int,
+        nargs='+',
+        default=[0],
+        help='The codes of predefined regions, as in crawler.py. (coordinator)'
+    )
+    parser.add_argument(
+        '--plan', '-p',
+        type=str,
+        default=PROBE_PLAN,
+        help='The probe plan produced by planner.py. (coordinator)'
+    )
+    parser.add_argument(
+        '--run', '-r',
+        type=int,
+        default=1,
+        help='The number of slots. Leave it 0 to loop forever. (coordinator)'
+    )
+    parser.add_argument(
+        '--quorum',
+        type=float,
+        default=1,
+        help='The share of probes with a result that is enough to merge the slot before every probe has finished. (coordinator)'
+    )
+    parser.add_argument(
+        '--format', '-f',
+        choices=['geojson', 'snapshot'],
+        default='geojson',
+        help='The output format, as in crawler.py. (coordinator)'
+    )
+    parser.add_argument(
+        '--metrics-dir', '-m',
+        type=str,
+        default=METRICS_DIR,
+        help='The directory of the Prometheus textfile and the JSON lines of every slot, or of every probe for a worker.'
+    )
+    parser.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=4,
+        help='The number of requests in flight at once in each worker. (worker)'
+    )
+    parser.add_argument(
+        '--spacing', '-s',
+        type=float,
+        default=SPACING,
+        help='The seconds between request starts of each worker. Leave it 0 for no floor. (worker)'
+    )
+    parser.add_argument(
+        '--url', '-u',
+        type=str,
+        default=None,
+        help='The base URL of the API, e.g. a running replay.py. Defaults to the real one. (worker)'
+    )
+    parser.add_argument(
+        '--id',
+        type=str,
+        default=f'{socket.gethostname()}-{os.getpid()}',
+        help='The name of the worker in the queue and the log. (worker)'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=4,
+        help='The number of worker processes. (local)'
+    )
+    args, server_args = parser.parse_known_args()
+    if (server_args) and (args.mode != 'local'):
+        parser.error(f'unrecognized arguments: {" ".join(server_args)}')
+
+    role = args.mode if args.mode != 'worker' else f'worker {args.id}'
+    crawler.log = log
+    if (args.url is not None) and (args.mode == 'worker'):
+        crawler.BASEURL = f'{args.url.rstrip("/")}/'
+        crawler.URL = f'{args.url.rstrip("/")}/w1/GetParks/{{long}}/{{lat}}/car/5'
+    crawler.limiter = TokenBucket(1 / args.spacing) if args.spacing > 0 else TokenBucket(1e9, 1e9)
+    crawler.probe_plan = load_probe_plan(args.plan)
+    if (args.format == 'snapshot'):
+        crawler.lot_catalog = LotCatalog.load(os.path.join('./data', CATALOG_DIR))
+
+    if (args.mode == 'coordinator'):
+        coordinate(ProbeQueue(args.queue), args.group, args.run, args.quorum, args.metrics_dir)
+    elif (args.mode == 'worker'):
+        work(ProbeQueue(args.queue), args.id, args.concurrency, args.metrics_dir)
+    else:
+        local(args.workers, args.url, args.run, args.group, args.quorum, args.concurrency, args.spacing, args.queue, server_args)
@@ -1,15 +1,41 @@
 import argparse
+from bisect import bisect_left
 from bs4 import BeautifulSoup, Tag
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from json import dump
+from hashlib import blake2b
+from history import HISTORY_BINARY, HistoryFile, is_history_file
+from json import dump, dumps, load
+import logging
+from logging.handlers import MemoryHandler
 import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import shapely
-from time import sleep
+from snapshot import CATALOG_DIR, LotCatalog, write_snapshot
+import sys
+import threading
+from time import monotonic, perf_counter, sleep, time
 from typing import Any, Optional
+from urllib.parse import urlparse
 
 # Constants
+ADAPTIVE_STATE = './data/cache/adaptive.json'
+BREAKER_COOLDOWN = 30
+BREAKER_THRESHOLD = 5
+CATALOG = './data/realtime-lot.geojson'
+HISTORY = './data/history.json'
+GEOMETRY_CACHE = './data/cache/geometry.json'
+LOG_BUFFER = 200
+LOG_DIR = './script/log'
+METRICS_DIR = './data/metrics'
+PROBE_PLAN = './data/probe-plan.json'
+RETRY_BASE = 2
+RETRY_CAP = 60
+RETRY_ROUNDS = 3
+SESSION_CACHE = './data/cache/session.json'
 BASEURL = 'https://itaipeiparking.pma.gov.taipei/'
 URL = 'https://itaipeiparking.pma.gov.taipei/w1/GetParks/{long}/{lat}/car/5'
 BASEHEADER = {'Accept': 'text/html;charset=UTF-8',
@@ -41,7 +67,13 @@ SEARCH_BOUND = 'POLYGON ((121.460502 25.121926, 121.463677 25.108015, 121.489634
 search_geometry = shapely.from_wkt(SEARCH_BOUND, on_invalid='ignore')
 assert isinstance(search_geometry, shapely.Polygon)
 
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOTS_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 200)
+PARSE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+SLOT = 600
 SPACING = 0.5
+TIMEOUT = 30
 XSTEP = 0.004
 YSTEP = 0.0035
 
@@ -90,35 +122,241 @@ class Lot:
     def __repr__(self: 'Lot') -> str:
         return f'Lot({self.id}, {self.occupied}, {self.service}, {self.toll})'
 
+@dataclass
+class SweepStats:
+    '''
+    The counters of how lots were upserted into a LotCollection, and of how the probes of the sweep ended.
+    '''
+
+    hits: int = 0
+    '''
+    The number of lots appended, including duplicates.
+    '''
+
+    duplicates: int = 0
+    '''
+    The number of appended lots whose id was already in the collection.
+    '''
+
+    succeeded: int = 0
+    '''
+    The number of probes that succeeded at the first attempt.
+    '''
+
+    recovered: int = 0
+    '''
+    The number of probes that failed at first and succeeded when requeued.
+    '''
+
+    abandoned: int = 0
+    '''
+    The number of probes that still failed after every retry round, or when the slot ran out.
+    '''
+
+    @property
+    def coverage(self: 'SweepStats') -> float:
+        '''
+        The share of probes that eventually succeeded.
+        '''
+        total = self.succeeded + self.recovered + self.abandoned
+        return (self.succeeded + self.recovered) / total if total else 0.0
+
+    @property
+    def overlap_ratio(self: 'SweepStats') -> float:
+        '''
+        The share of appended lots that were duplicates.
+        '''
+        return self.duplicates / self.hits if self.hits else 0.0
+
+    @property
+    def unique(self: 'SweepStats') -> int:
+        '''
+        The number of distinct lots appended.
+        '''
+        return self.hits - self.duplicates
+
+    def __repr__(self: 'SweepStats') -> str:
+        return f'SweepStats(unique={self.unique}, duplicates={self.duplicates}, overlap={self.overlap_ratio:.1%})'
+
+class GeometryCache:
+    '''
+    The persistent cache of parking lot shapes, keyed by `parkId` and the hash of its WKT string.
+    '''
+
+    entries: dict[str, tuple[Optional[str], shapely.Polygon | None]]
+    '''
+    The dictionary of `parkId` to the WKT hash and the parsed shape. Seeded entries have no hash until verified.
+    '''
+
+    dirty: bool
+    '''
+    Whether the cache has changed since it was loaded or saved.
+    '''
+
+    def __init__(self: 'GeometryCache') -> None:
+        self.entries = dict()
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def get(self: 'GeometryCache', park_id: Any, wkt: str) -> shapely.Polygon | None:
+        '''
+        Get the shape of the parking lot, parsing and caching the WKT on a miss.
+        '''
+        key = str(park_id)
+        entry = self.entries.get(key)
+        if (entry is None) or (entry[0] != GeometryCache.hash(wkt)):
+            self.parse([{'parkId': park_id, 'wkt': wkt}])
+            entry = self.entries[key]
+        return entry[1]
+
+    def parse(self: 'GeometryCache', records: list[Any]) -> None:
+        '''
+        Parse every uncached WKT in the API response with one vectorized call.
+
+        Parameter
+        -------
+        records: list[Any]
+            The JSON list returned by the API.
+        '''
+        misses: dict[str, tuple[str, str]] = dict()
+        for record in records:
+            if (not isinstance(record, dict)) or ('parkId' not in record) or ('wkt' not in record):
+                continue
+            key = str(record['parkId'])
+            wkt = str(record['wkt'])
+            digest = GeometryCache.hash(wkt)
+            entry = self.entries.get(key)
+            if (entry is None) or (entry[0] != digest):
+                misses[key] = (digest, wkt)
+        if (not misses):
+            return
+
+        geometries = shapely.from_wkt([wkt for _, wkt in misses.values()], on_invalid='ignore')
+        with self._lock:
+            for (key, (digest, _)), geometry in zip(misses.items(), geometries):
+                shape = geometry if isinstance(geometry, shapely.Polygon) else None
+                seed = self.entries.get(key)
+                if (seed is not None) and (seed[0] is None) and (shape is not None) and (seed[1] is not None):
+                    # Keep the seeded object, so the lot still holds one shared shape.
+                    if (shapely.equals_exact(seed[1], shape, tolerance=1e-9)):
+                        shape = seed[1]
+                self.entries[key] = (digest, shape)
+            self.dirty = True
+
+    def load(self: 'GeometryCache', path: str = GEOMETRY_CACHE, seed_path: str = CATALOG) -> None:
+        '''
+        Load the cache file, or seed the cache from the lot catalog if there is no cache file yet.
+
+        Parameter
+        -------
+        path: str, default GEOMETRY_CACHE
+            The path to the cache file.
+
+        seed_path: str, default CATALOG
+            The path to the lot catalog produced by `extract.py`.
+        '''
+        if (os.path.exists(path)):
+            with open(path, 'r', encoding='utf-8') as f:
+                data: dict[str, list[Optional[str]]] = load(f)
+            geometries = shapely.from_wkt([wkt for _, wkt in data.values()], on_invalid='ignore')
+            self.entries = {key: (digest, geometry if isinstance(geometry, shapely.Polygon) else None)
+                            for (key, (digest, _)), geometry in zip(data.items(), geometries)}
+            self.dirty = False
+        elif (os.path.exists(seed_path)):
+            with open(seed_path, 'r', encoding='utf-8') as f:
+                catalog = load(f)
+            for feature in catalog.get('features', []):
+                lot_id = (feature.get('properties') or {}).get('id')
+                if (not isinstance(lot_id, str)) or (feature.get('geometry') is None):
+                    continue
+                geometry = shapely.geometry.shape(feature['geometry'])
+                if (isinstance(geometry, shapely.Polygon)):
+                    self.entries[lot_id.rsplit('_', 1)[-1]] = (None, geometry)
+            self.dirty = True
+
+    def save(self: 'GeometryCache', path: str = GEOMETRY_CACHE) -> None:
+        '''
+        Write the cache back to the file if it has changed.
+        '''
+        if (not self.dirty):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            data = {key: [digest, None if shape is None else shape.wkt] for key, (digest, shape) in self.entries.items()}
+            self.dirty = False
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            dump(data, f, ensure_ascii=False)
+        os.replace(f'{path}.tmp', path)
+
+    def __len__(self: 'GeometryCache') -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def hash(wkt: str) -> str:
+        '''
+        Hash the WKT string into a short, stable digest.
+        '''
+        return blake2b(wkt.encode('utf-8'), digest_size=8).hexdigest()
+
 class LotCollection:
     '''
     The container of parking lots.
     '''
 
-    lots: dict[str, Lot] = dict()
+    lots: dict[str, Lot]
     '''
     The dictionary of parking lots, where the id is the key.
     '''
 
+    intern: bool
+    '''
+    Whether to intern the ids, so repeated ids from overlapping probes share one string.
+    '''
+
+    stats: SweepStats
+    '''
+    The counters of the upserts into this collection.
+    '''
+
+    missed: list[tuple[float, float]]
+    '''
+    The probes that gave no result in the sweep that produced this collection.
+    '''
+
+    stale: dict[str, float]
+    '''
+    The parking lots not refreshed in this collection, and the number of seconds since they were last observed.
+    '''
+
     timestamp: datetime
     '''
     The time when the result was obtained.
     '''
 
-    def __init__(self: 'LotCollection', t: datetime | None = None) -> None:
+    def __init__(self: 'LotCollection', t: datetime | None = None, intern: bool = False) -> None:
+        self.intern = intern
+        self.lots = dict()
+        self.missed = list()
+        self.stale = dict()
+        self.stats = SweepStats()
         self.timestamp = datetime.now() if t is None else t
     
     def append(self: 'LotCollection', lot: Lot) -> None:
         '''
-        Append a parking lot to the lot collection.
+        Append a parking lot to the lot collection in O(1).
         '''
         if (lot.id is None):
             return
+        if (self.intern):
+            lot.id = sys.intern(lot.id)
+        self.stats.hits += 1
         existing = self.lots.get(lot.id)
         if (existing is None):
             self.lots[lot.id] = lot
-        elif (lot.timestamp > existing.timestamp):
-            self.lots[lot.id] = lot
+        else:
+            self.stats.duplicates += 1
+            if (lot.timestamp > existing.timestamp):
+                self.lots[lot.id] = lot
     
     def merge(self: 'LotCollection', other: 'LotCollection', inplace: bool = False) -> 'LotCollection':
         '''
@@ -131,7 +369,7 @@ class LotCollection:
         other : LotCollection
             The other LotCollection to merge.
         inplace : bool, default False
-            If True, merge into the current collection and return self.
+            If True, merge into the current collection and return self. Only the lots of `other` are visited.
             If False, create and return a new LotCollection.
         '''
         if inplace:
@@ -142,17 +380,34 @@ class LotCollection:
 
             return self
         else:
-            merged = LotCollection()
-            merged.timestamp = max(self.timestamp, other.timestamp)
-
-            for lot in self.lots.values():
-                merged.append(lot)
+            merged = LotCollection(max(self.timestamp, other.timestamp), self.intern)
+            merged.lots = self.lots.copy()
 
             for lot in other.lots.values():
                 merged.append(lot)
 
             return merged
 
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'LotCollection':
+        '''
+        Restore a collection converted by `to_dict`, parsing the shapes with one vectorized call.
+        '''
+        lots = cls(datetime.fromisoformat(data['timestamp']))
+        rows = data['lots']
+        shapes = shapely.from_wkt([row[6] for row in rows], on_invalid='ignore')
+        for (lot_id, name, occupied, service, toll, timestamp, _), shape in zip(rows, shapes):
+            lots.append(Lot(lot_id, name, occupied, service, shape if isinstance(shape, shapely.Polygon) else None, datetime.fromisoformat(timestamp), toll))
+        return lots
+
+    def to_dict(self: 'LotCollection') -> dict[str, Any]:
+        '''
+        Convert the collection to a compact dictionary with the shapes as WKT, to pass it between processes.
+        '''
+        return {'timestamp': self.timestamp.isoformat(),
+                'lots': [[lot.id, lot.name, lot.occupied, lot.service, lot.toll, lot.timestamp.isoformat(), None if lot.shape is None else lot.shape.wkt]
+                         for lot in self.lots.values()]}
+
     def to_geojson_file(self: 'LotCollection', path: str) -> None:
         '''
         Convert the collection to a GeoJSON file.
@@ -181,137 +436,1116 @@ class LotCollection:
             }
             features.append(feature)
 
-        geojson = {'type': 'FeatureCollection',
-                   'features': features,
-                   'timestamp': self.timestamp.isoformat()}
+        geojson: dict[str, Any] = {'type': 'FeatureCollection',
+                                   'features': features,
+                                   'timestamp': self.timestamp.isoformat()}
+        if (self.stale):
+            geojson['stale'] = self.stale
         with open(path, 'w', encoding='utf-8') as f:
             dump(geojson, f, ensure_ascii=False, indent=2)
 
         return 
 
+    def to_snapshot_file(self: 'LotCollection', path: str, catalog: LotCatalog) -> None:
+        '''
+        Write the collection as a compact snapshot. The static attributes go to the catalog next to
+        the snapshot, which is only written when they change.
+
+        Parameter
+        -------
+        path: str
+            The path to the output file.
+
+        catalog: LotCatalog
+            The catalog to update. It's kept in memory between sweeps.
+        '''
+        lots = [lot for lot in self.lots.values() if lot.shape is not None]
+        wkts = shapely.to_wkt([lot.shape for lot in lots], rounding_precision=-1) if lots else []
+        records = [{'id': lot.id, 'name': lot.name, 'service': lot.service, 'toll': lot.toll, 'geometry': wkt}
+                   for lot, wkt in zip(lots, wkts)]
+        if (catalog.update(records)):
+            catalog.save(os.path.join(os.path.dirname(path), CATALOG_DIR))
+        write_snapshot(path, catalog, [lot.id for lot in lots], [lot.occupied for lot in lots], self.timestamp, self.stale)
+
+@dataclass
+class ProbeState:
+    '''
+    The observations of one probe point used by the adaptive scheduler.
+    '''
+
+    lots: list[str]
+    '''
+    The ids of the parking lots the probe returned last time.
+    '''
+
+    volatility: Optional[float] = None
+    '''
+    The estimated share of the probe's lots that change state per cycle, or `None` if unknown.
+    '''
+
+    last_cycle: Optional[int] = None
+    '''
+    The cycle in which the probe was last polled.
+    '''
+
+class ProbeScheduler:
+    '''
+    The scheduler that polls high-turnover probes every cycle and stable ones less often, within a request budget.
+    '''
+
+    budget: int
+    '''
+    The maximum number of probes polled per cycle.
+    '''
+
+    cycle: int
+    '''
+    The number of cycles scheduled so far.
+    '''
+
+    last_seen: dict[str, datetime]
+    '''
+    The time each parking lot was last observed.
+    '''
+
+    max_age: int
+    '''
+    The maximum number of cycles a probe can go unpolled. It may still be exceeded if the budget is too small.
+    '''
+
+    probes: dict[str, ProbeState]
+    '''
+    The state of each probe, keyed by its rounded coordinates.
+    '''
+
+    smoothing: float
+    '''
+    The weight of the newest observation in the exponential moving average of the volatility.
+    '''
+
+    states: dict[str, bool]
+    '''
+    The last observed occupancy of each parking lot.
+    '''
+
+    volatility: dict[str, float]
+    '''
+    The change rate of each parking lot per cycle estimated from `history.json`.
+    '''
+
+    def __init__(self: 'ProbeScheduler', budget: int, max_age: int = 6, smoothing: float = 0.3) -> None:
+        self.budget = budget
+        self.cycle = 0
+        self.last_seen = dict()
+        self.max_age = max_age
+        self.probes = dict()
+        self.smoothing = smoothing
+        self.states = dict()
+        self.volatility = dict()
+        self._lock = threading.Lock()
+
+    def get_stale(self: 'ProbeScheduler', since: datetime) -> dict[str, float]:
+        '''
+        Get the parking lots not observed since the given time.
+
+        Returns
+        -------
+        stale: dict[str, float]
+            The id of each stale parking lot and the number of seconds since it was last observed.
+        '''
+        return {lot_id: round((since - seen).total_seconds()) for lot_id, seen in self.last_seen.items() if seen < since}
+
+    def load(self: 'ProbeScheduler', path: str = ADAPTIVE_STATE, history_path: str = HISTORY) -> None:
+        '''
+        Load the scheduler state, and estimate the change rate of each parking lot from the aggregated history,
+        either `history.json` or the binary `history.bin`.
+        '''
+        if (os.path.exists(path)):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = load(f)
+            self.cycle = data['cycle']
+            self.last_seen = {k: datetime.fromisoformat(v) for k, v in data['last_seen'].items()}
+            self.probes = {k: ProbeState(**v) for k, v in data['probes'].items()}
+            self.states = data['states']
+
+        if (os.path.exists(history_path)) and (is_history_file(history_path)):
+            # Compare each slot with the next one across the whole week, as below, but on the unpacked cube.
+            binary = HistoryFile(history_path)
+            values = binary.to_cube().reshape(len(binary), -1)
+            known = (values[:, :-1] >= 0) & (values[:, 1:] >= 0)
+            pairs = known.sum(axis=1)
+            changes = (known & (values[:, :-1] != values[:, 1:])).sum(axis=1)
+            for lot_id, p, c in zip(binary.ids, pairs.tolist(), changes.tolist()):
+                if (p > 0):
+                    self.volatility[lot_id] = c / p
+        elif (os.path.exists(history_path)):
+            with open(history_path, 'r', encoding='utf-8') as f:
+                history: dict[str, dict[str, list[Optional[int]]]] = load(f)
+            for lot_id, days in history.items():
+                values = [v for d in sorted(days, key=int) for v in days[d]]
+                pairs = changes = 0
+                for a, b in zip(values, values[1:]):
+                    if (a is not None) and (b is not None):
+                        pairs += 1
+                        changes += a != b
+                if (pairs > 0):
+                    self.volatility[lot_id] = changes / pairs
+
+    def observe(self: 'ProbeScheduler', coord: tuple[float, float], lots: 'LotCollection') -> None:
+        '''
+        Record the result of a probe and update its volatility.
+        '''
+        key = ProbeScheduler.key(coord)
+        with self._lock:
+            probe = self.probes.setdefault(key, ProbeState([]))
+            elapsed = 1 if probe.last_cycle is None else max(1, self.cycle - probe.last_cycle)
+            compared = changed = 0
+            for lot in lots.lots.values():
+                assert lot.id is not None
+                previous = self.states.get(lot.id)
+                if (previous is not None):
+                    compared += 1
+                    changed += previous != lot.occupied
+                self.states[lot.id] = lot.occupied
+                self.last_seen[lot.id] = lot.timestamp
+            if (compared > 0):
+                rate = min(1.0, changed / compared / elapsed)
+                probe.volatility = rate if probe.volatility is None else (1 - self.smoothing) * probe.volatility + self.smoothing * rate
+            probe.lots = list(lots.lots.keys())
+            probe.last_cycle = self.cycle
+
+    def save(self: 'ProbeScheduler', path: str = ADAPTIVE_STATE) -> None:
+        '''
+        Write the scheduler state to the file.
+        '''
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            data = {'cycle': self.cycle,
+                    'last_seen': {k: v.isoformat() for k, v in self.last_seen.items()},
+                    'probes': {k: {'lots': v.lots, 'volatility': v.volatility, 'last_cycle': v.last_cycle} for k, v in self.probes.items()},
+                    'states': self.states}
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            dump(data, f, ensure_ascii=False)
+        os.replace(f'{path}.tmp', path)
+
+    def select(self: 'ProbeScheduler', coords: list[tuple[float, float]]) -> list[tuple[float, float]]:
+        '''
+        Start a new cycle and pick the probes to poll in it.
+        Probes that have never been polled or have reached `max_age` come first,
+        then the rest by the expected number of missed changes (volatility × age).
+        '''
+        self.cycle += 1
+
+        def _priority(coord: tuple[float, float]) -> tuple[bool, float]:
+            probe = self.probes.get(ProbeScheduler.key(coord))
+            if (probe is None) or (probe.last_cycle is None):
+                return (True, float('inf'))
+            age = self.cycle - probe.last_cycle
+            volatility = probe.volatility
+            if (volatility is None):
+                known = [self.volatility[lot_id] for lot_id in probe.lots if lot_id in self.volatility]
+                volatility = sum(known) / len(known) if known else 1.0
+            return (age >= self.max_age, volatility * age)
+
+        ranked = sorted(coords, key=_priority, reverse=True)
+        return ranked[:self.budget] if self.budget > 0 else ranked
+
+    @staticmethod
+    def key(coord: tuple[float, float]) -> str:
+        return f'{coord[0]:.6f},{coord[1]:.6f}'
+
+class CircuitBreaker:
+    '''
+    The thread-safe circuit breaker of a host. After `threshold` failures in a row it opens and turns requests
+    away for `cooldown` seconds, then lets a single trial request through: a success closes it again,
+    and a failure opens it for another cooldown.
+    '''
+
+    threshold: int
+    '''
+    The number of failures in a row that opens the breaker.
+    '''
+
+    cooldown: float
+    '''
+    The seconds the breaker stays open before the trial request.
+    '''
+
+    failures: int
+    '''
+    The number of failures in a row so far.
+    '''
+
+    opened: Optional[float]
+    '''
+    The monotonic time the breaker last opened, or `None` if it's closed.
+    '''
+
+    def __init__(self: 'CircuitBreaker', threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._condition = threading.Condition()
+        self._trial = False
+
+    @property
+    def remaining(self: 'CircuitBreaker') -> float:
+        '''
+        The seconds until the breaker lets a request through, or 0 if it's closed.
+        '''
+        opened = self.opened
+        return 0.0 if opened is None else max(0.0, opened + self.cooldown - monotonic())
+
+    def allow(self: 'CircuitBreaker') -> bool:
+        '''
+        Whether a request may be sent now. Once the cooldown is over, the first caller gets the trial,
+        and the others wait for its outcome instead of being turned away.
+        '''
+        with self._condition:
+            while True:
+                if (self.opened is None):
+                    return True
+                if (monotonic() - self.opened < self.cooldown):
+                    return False
+                if (not self._trial):
+                    self._trial = True
+                    return True
+                self._condition.wait()
+
+    def record(self: 'CircuitBreaker', ok: bool) -> bool:
+        '''
+        Record the outcome of a request.
+
+        Returns
+        -------
+        opened: bool
+            `True` if this failure opened the breaker.
+        '''
+        with self._condition:
+            self._trial = False
+            self._condition.notify_all()
+            if (ok):
+                self.failures = 0
+                self.opened = None
+                return False
+            self.failures += 1
+            if (self.opened is not None) or (self.failures >= self.threshold):
+                was_closed = self.opened is None
+                self.opened = monotonic()
+                return was_closed
+            return False
+
+class ProbeError(Exception):
+    '''
+    The error raised when a probe gets no usable response, so the sweep can requeue it.
+    '''
+
+class Histogram:
+    '''
+    The histogram of a Prometheus metric.
+    '''
+
+    buckets: tuple[float, ...]
+    '''
+    The upper bounds of the buckets, without `+Inf`.
+    '''
+
+    counts: list[int]
+    '''
+    The number of observations in each bucket and, last, above every bound. They're made cumulative on export.
+    '''
+
+    def __init__(self: 'Histogram', buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self: 'Histogram', value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_lines(self: 'Histogram', name: str, labels: str) -> list[str]:
+        lines = []
+        total = 0
+        for bound, count in zip([*map(str, self.buckets), '+Inf'], self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+@dataclass
+class ProbeRecord:
+    '''
+    The measurements of one attempt of a probe.
+    '''
+
+    lon: float
+    lat: float
+    group: int
+    start: float
+
+    requests: int = 0
+    '''
+    The number of requests sent, including the retry after a token refresh.
+    '''
+
+    statuses: list[Optional[int]] = field(default_factory=list)
+    '''
+    The status code of each request, or `None` if the request failed.
+    '''
+
+    bytes: int = 0
+    lots: int = 0
+    parse_seconds: float = 0.0
+
+    attempt: int = 0
+    '''
+    The retry round of the sweep the attempt was made in, or 0 for the first pass.
+    '''
+
+class CrawlerMetrics:
+    '''
+    The thread-safe metrics of the crawler: histograms and counters in the Prometheus sense, kept per group for
+    the life of the process, plus a JSON line for every probe and sweep not yet written.
+    '''
+
+    counters: dict[tuple[str, int, str], float]
+    '''
+    The value of each counter by metric, group and extra labels.
+    '''
+
+    gauges: dict[tuple[str, int], float]
+    '''
+    The value of each gauge by metric and group.
+    '''
+
+    histograms: dict[tuple[str, int], Histogram]
+    '''
+    The histogram of each metric and group.
+    '''
+
+    records: list[dict[str, Any]]
+    '''
+    The probes and sweeps observed since the JSON lines were last written.
+    '''
+
+    HELP = {'crawler_probe_duration_seconds': ('histogram', 'The time from the first request of a probe to its parsed result, including retries.'),
+            'crawler_request_duration_seconds': ('histogram', 'The time of each HTTP request, excluding the wait for the rate limiter.'),
+            'crawler_probe_lots': ('histogram', 'The number of parking lots returned by each probe.'),
+            'crawler_parse_duration_seconds': ('histogram', 'The time to decode and parse the response of a probe.'),
+            'crawler_responses_total': ('counter', 'The HTTP responses by status code. Requests that failed without a response count as `error`.'),
+            'crawler_retries_total': ('counter', 'The requests and probes sent again after a failure.'),
+            'crawler_response_bytes_total': ('counter', 'The decoded bytes of the responses.'),
+            'crawler_failed_probes_total': ('counter', 'The probe attempts that gave no result, including the ones recovered later.'),
+            'crawler_probes_total': ('counter', 'The probes by how they ended: `succeeded` at once, `recovered` when requeued, or `abandoned`.'),
+            'crawler_breaker_opens_total': ('counter', 'The times the circuit breaker of the API host opened.'),
+            'crawler_handshakes_total': ('counter', 'The handshakes that fetched a new CSRF token.'),
+            'crawler_token_rejections_total': ('counter', 'The handshakes caused by the API rejecting the CSRF token.'),
+            'crawler_sweeps_total': ('counter', 'The completed sweeps.'),
+            'crawler_sweep_overruns_total': ('counter', 'The sweeps that took longer than the slot.'),
+            'crawler_sweep_duration_seconds': ('gauge', 'The duration of the last sweep.'),
+            'crawler_sweep_slot_ratio': ('gauge', 'The duration of the last sweep as a share of the slot.'),
+            'crawler_sweep_overrun_seconds': ('gauge', 'How long the last sweep ran past the slot, or 0.'),
+            'crawler_sweep_probes': ('gauge', 'The number of probes in the last sweep.'),
+            'crawler_sweep_lots': ('gauge', 'The number of distinct parking lots collected in the last sweep.'),
+            'crawler_sweep_coverage_ratio': ('gauge', 'The share of probes in the last sweep that eventually succeeded.'),
+            'crawler_last_sweep_timestamp_seconds': ('gauge', 'The Unix time the last sweep ended.'),
+            'crawler_slot_overruns_total': ('counter', 'The cycles that ended after the next slot had begun, so the next cycle started late.'),
+            'crawler_skipped_slots_total': ('counter', 'The slots skipped entirely because a cycle ran through them.'),
+            'crawler_slot_overrun_seconds': ('gauge', 'How long the last cycle ran into the next slot, or 0.')}
+
+    def __init__(self: 'CrawlerMetrics') -> None:
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.records = list()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def begin_probe(self: 'CrawlerMetrics', lon: float, lat: float, group: int = 0, attempt: int = 0) -> ProbeRecord:
+        '''
+        Start measuring an attempt of a probe in this thread.
+        '''
+        probe = ProbeRecord(lon, lat, group, perf_counter(), attempt=attempt)
+        self._local.probe = probe
+        return probe
+
+    def end_probe(self: 'CrawlerMetrics', probe: ProbeRecord, ok: bool = True) -> None:
+        '''
+        Finish measuring the attempt.
+        '''
+        self._local.probe = None
+        seconds = perf_counter() - probe.start
+        with self._lock:
+            self.get_histogram('crawler_probe_duration_seconds', probe.group, LATENCY_BUCKETS).observe(seconds)
+            if (ok):
+                self.get_histogram('crawler_probe_lots', probe.group, LOTS_BUCKETS).observe(probe.lots)
+                self.get_histogram('crawler_parse_duration_seconds', probe.group, PARSE_BUCKETS).observe(probe.parse_seconds)
+            else:
+                self.add('crawler_failed_probes_total', probe.group)
+            self.records.append({'type': 'probe',
+                                 'time': datetime.now().isoformat(timespec='seconds'),
+                                 'group': probe.group,
+                                 'lon': probe.lon,
+                                 'lat': probe.lat,
+                                 'ok': ok,
+                                 'attempt': probe.attempt,
+                                 'seconds': round(seconds, 4),
+                                 'requests': probe.requests,
+                                 'statuses': probe.statuses,
+                                 'bytes': probe.bytes,
+                                 'lots': probe.lots,
+                                 'parse_seconds': round(probe.parse_seconds, 5)})
+
+    def observe_parse(self: 'CrawlerMetrics', probe: ProbeRecord, seconds: float, lots: int) -> None:
+        probe.parse_seconds += seconds
+        probe.lots = lots
+
+    def observe_request(self: 'CrawlerMetrics', group: int, seconds: float, status: Optional[int], size: int = 0) -> None:
+        '''
+        Record an HTTP request, and add it to the probe measured in this thread, if any.
+        '''
+        probe: Optional[ProbeRecord] = getattr(self._local, 'probe', None)
+        if (probe is not None):
+            probe.requests += 1
+            probe.statuses.append(status)
+            probe.bytes += size
+        with self._lock:
+            self.get_histogram('crawler_request_duration_seconds', group, LATENCY_BUCKETS).observe(seconds)
+            self.add('crawler_responses_total', group, f'status="{"error" if status is None else status}"')
+            self.add('crawler_response_bytes_total', group, value=size)
+
+    def observe_handshake(self: 'CrawlerMetrics', group: int = 0, rejected: bool = False) -> None:
+        with self._lock:
+            self.add('crawler_handshakes_total', group)
+            if (rejected):
+                self.add('crawler_token_rejections_total', group)
+
+    def observe_breaker(self: 'CrawlerMetrics', group: int = 0) -> None:
+        with self._lock:
+            self.add('crawler_breaker_opens_total', group)
+
+    def observe_retry(self: 'CrawlerMetrics', group: int = 0, count: int = 1) -> None:
+        with self._lock:
+            self.add('crawler_retries_total', group, value=count)
+
+    def observe_slot(self: 'CrawlerMetrics', group: int, slot: datetime, overrun: float, skipped: int = 0) -> None:
+        '''
+        Record how far the cycle of a slot ran into the following slots.
+        '''
+        with self._lock:
+            if (overrun > 0):
+                self.add('crawler_slot_overruns_total', group)
+            if (skipped > 0):
+                self.add('crawler_skipped_slots_total', group, value=skipped)
+            self.gauges[('crawler_slot_overrun_seconds', group)] = overrun
+            self.records.append({'type': 'slot',
+                                 'time': datetime.now().isoformat(timespec='seconds'),
+                                 'group': group,
+                                 'slot': slot.isoformat(timespec='seconds'),
+                                 'overrun_seconds': round(overrun, 3),
+                                 'skipped': skipped})
+
+    def observe_sweep(self: 'CrawlerMetrics', group: int, started: datetime, seconds: float, probes: int, lots: int, stats: SweepStats) -> None:
+        '''
+        Record a sweep and how it fits in the slot.
+        '''
+        overrun = max(0.0, seconds - SLOT)
+        with self._lock:
+            self.add('crawler_sweeps_total', group)
+            for outcome in ('succeeded', 'recovered', 'abandoned'):
+                self.add('crawler_probes_total', group, f'outcome="{outcome}"', getattr(stats, outcome))
+            if (overrun > 0):
+                self.add('crawler_sweep_overruns_total', group)
+            self.gauges[('crawler_sweep_duration_seconds', group)] = seconds
+            self.gauges[('crawler_sweep_slot_ratio', group)] = seconds / SLOT
+            self.gauges[('crawler_sweep_overrun_seconds', group)] = overrun
+            self.gauges[('crawler_sweep_probes', group)] = probes
+            self.gauges[('crawler_sweep_lots', group)] = lots
+            self.gauges[('crawler_sweep_coverage_ratio', group)] = stats.coverage
+            self.gauges[('crawler_last_sweep_timestamp_seconds', group)] = datetime.now().timestamp()
+            self.records.append({'type': 'sweep',
+                                 'time': datetime.now().isoformat(timespec='seconds'),
+                                 'group': group,
+                                 'started': started.isoformat(timespec='seconds'),
+                                 'seconds': round(seconds, 3),
+                                 'slot_ratio': round(seconds / SLOT, 4),
+                                 'overrun_seconds': round(overrun, 3),
+                                 'probes': probes,
+                                 'lots': lots,
+                                 'succeeded': stats.succeeded,
+                                 'recovered': stats.recovered,
+                                 'abandoned': stats.abandoned,
+                                 'hits': stats.hits,
+                                 'duplicates': stats.duplicates})
+
+    def add(self: 'CrawlerMetrics', name: str, group: int, labels: str = '', value: float = 1) -> None:
+        key = (name, group, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_histogram(self: 'CrawlerMetrics', name: str, group: int, buckets: tuple[float, ...]) -> Histogram:
+        histogram = self.histograms.get((name, group))
+        if (histogram is None):
+            histogram = self.histograms[(name, group)] = Histogram(buckets)
+        return histogram
+
+    def to_prometheus(self: 'CrawlerMetrics') -> str:
+        '''
+        Format the metrics in the Prometheus text exposition format.
+        '''
+        lines: list[str] = []
+        with self._lock:
+            for name, (kind, description) in CrawlerMetrics.HELP.items():
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                if (kind == 'histogram'):
+                    for (key, group), histogram in sorted(self.histograms.items()):
+                        if (key == name):
+                            lines.extend(histogram.to_lines(name, f'group="{group}"'))
+                elif (kind == 'counter'):
+                    for (key, group, labels), value in sorted(self.counters.items()):
+                        if (key == name):
+                            lines.append(f'{name}{{group="{group}"{"," + labels if labels else ""}}} {value:.15g}')
+                else:
+                    for (key, group), value in sorted(self.gauges.items()):
+                        if (key == name):
+                            lines.append(f'{name}{{group="{group}"}} {value:.15g}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self: 'CrawlerMetrics', directory: str = METRICS_DIR, group: int = 0, name: Optional[str] = None) -> None:
+        '''
+        Replace the Prometheus textfile atomically, so a collector never reads it half-written,
+        and append the new JSON lines. The files are named after the group unless `name` is given.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        if (name is None):
+            name = 'crawler' if group == 0 else f'crawler_g{group}'
+        path = os.path.join(directory, f'{name}.prom')
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(f'{path}.tmp', path)
+
+        with self._lock:
+            records, self.records = self.records, list()
+        if (records):
+            with open(os.path.join(directory, f'{name}.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(''.join(dumps(record, ensure_ascii=False) + '\n' for record in records))
+
+class TokenBucket:
+    '''
+    The thread-safe token bucket that limits how often requests are started.
+    '''
+
+    capacity: float
+    '''
+    The maximum number of tokens that can be saved up for a burst.
+    '''
+
+    rate: float
+    '''
+    The number of tokens refilled per second.
+    '''
+
+    def __init__(self: 'TokenBucket', rate: float, capacity: float = 1) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated = monotonic()
+
+    def acquire(self: 'TokenBucket') -> None:
+        '''
+        Block until a token is available, then consume it.
+        '''
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if (self._tokens >= 1):
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            sleep(delay)
+
+class SessionPool:
+    '''
+    The long-lived session shared by every probe and every cycle, and the lifecycle of its CSRF token.
+    The token is kept, across runs too, until the API rejects it or it outlives any token seen before.
+    '''
+
+    session: requests.Session
+    '''
+    The session whose keep-alive connections and cookies are reused.
+    '''
+
+    token: Optional[str]
+    '''
+    The CSRF token sent with every API call, or `None` before the first handshake.
+    '''
+
+    issued: Optional[float]
+    '''
+    The Unix time the token was fetched.
+    '''
+
+    generation: int
+    '''
+    The number of times the token has been replaced. A probe rejected under an older generation
+    just retries with the current token instead of starting another handshake.
+    '''
+
+    lifetimes: list[float]
+    '''
+    The ages in seconds at which the recent tokens were rejected.
+    '''
+
+    path: Optional[str]
+    '''
+    The path to persist the token and the cookies, or `None` to keep them in memory only.
+    '''
+
+    def __init__(self: 'SessionPool', concurrency: int = 1, path: Optional[str] = SESSION_CACHE, max_lifetimes: int = 20) -> None:
+        self.session = new_session(concurrency)
+        self.token = None
+        self.issued = None
+        self.generation = 0
+        self.lifetimes = list()
+        self.path = path
+        self.max_lifetimes = max_lifetimes
+        self._lock = threading.Lock()
+
+    @property
+    def age(self: 'SessionPool') -> Optional[float]:
+        return None if self.issued is None else time() - self.issued
+
+    @property
+    def lifetime(self: 'SessionPool') -> Optional[float]:
+        '''
+        The shortest age at which a token has been rejected, if any.
+        '''
+        return min(self.lifetimes) if self.lifetimes else None
+
+    def ensure(self: 'SessionPool', group: int = 0) -> bool:
+        '''
+        Make sure there is a token before a sweep: fetch one if there is none, or if the current one is already
+        older than a token the API has rejected.
+
+        Returns
+        -------
+        result: bool
+            `True` if there is a token to use, and `False` if the handshake failed.
+        '''
+        age, lifetime = self.age, self.lifetime
+        if (self.token is not None) and ((age is None) or (lifetime is None) or (age < lifetime)):
+            log(f'Reusing the CSRF token fetched {age or 0:.0f} seconds ago.', group)
+            return True
+        if (self.token is not None):
+            log(f'The CSRF token is {age:.0f} seconds old, past the shortest lifetime seen ({lifetime:.0f} seconds).', group)
+        return self.refresh(self.generation, group, rejected=False)
+
+    def refresh(self: 'SessionPool', generation: int, group: int = 0, rejected: bool = True) -> bool:
+        '''
+        Replace the token of the given generation. Only the first caller performs the handshake, while the others
+        wait for it and then use its token.
+
+        Parameter
+        -------
+        generation: int
+            The generation the caller's token belonged to.
+
+        rejected: bool, default True
+            Whether the API rejected the token, so its age is recorded as an observed lifetime.
+
+        Returns
+        -------
+        result: bool
+            `True` if there is a new token to retry with.
+        '''
+        with self._lock:
+            if (self.generation != generation):
+                return self.token is not None
+            if (rejected) and (self.issued is not None):
+                self.lifetimes = (self.lifetimes + [round(time() - self.issued, 1)])[-self.max_lifetimes:]
+                log(f'The API rejected the CSRF token after {self.lifetimes[-1]:.0f} seconds. Refreshing it...', group, logging.WARNING)
+            ok = handshake(self.session, group, verbose=True)
+            self.token = self.session.headers.get('X-CSRF-TOKEN') if ok else None
+            self.issued = time() if ok else None
+            # Move on even if it failed, so the probes waiting on this generation don't retry the handshake.
+            self.generation += 1
+            metrics.observe_handshake(group, rejected)
+            return ok
+
+    def load(self: 'SessionPool') -> None:
+        '''
+        Restore the token, its cookies and the observed lifetimes from the file, if any.
+        '''
+        if (self.path is None) or (not os.path.exists(self.path)):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = load(f)
+        self.lifetimes = data.get('lifetimes', [])
+        if (data.get('token') is not None):
+            self.token = data['token']
+            self.issued = data['issued']
+            self.session.headers.update(HEADER)
+            self.session.headers.update({'X-CSRF-TOKEN': self.token})
+            self.session.cookies.update(requests.utils.cookiejar_from_dict(data.get('cookies', {})))
+
+    def save(self: 'SessionPool') -> None:
+        '''
+        Write the token, its cookies and the observed lifetimes to the file.
+        '''
+        if (self.path is None):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            data = {'token': self.token,
+                    'issued': self.issued,
+                    'cookies': requests.utils.dict_from_cookiejar(self.session.cookies),
+                    'lifetimes': self.lifetimes}
+        with open(f'{self.path}.tmp', 'w', encoding='utf-8') as f:
+            dump(data, f, ensure_ascii=False)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    @staticmethod
+    def is_rejected(response: requests.Response) -> bool:
+        '''
+        Whether the API refused the token: a 400 or 403, or a successful response that is not a JSON list.
+        '''
+        if (response.status_code in (400, 403)):
+            return True
+        return (response.ok) and (not response.content.lstrip().startswith(b'['))
+
+# Variables
+breakers: dict[str, CircuitBreaker] = dict()
+'''
+The circuit breaker of each host.
+'''
+
+geometry_cache = GeometryCache()
+'''
+The shapes of the parking lots shared by every probe and every sweep.
+'''
+
+lot_catalog: Optional[LotCatalog] = None
+'''
+The catalog of the compact snapshots, if the compact format is enabled.
+'''
+
+metrics = CrawlerMetrics()
+'''
+The metrics of every probe and sweep, written to `METRICS_DIR` after each sweep.
+'''
+
+limiter = TokenBucket(1 / SPACING)
+'''
+The global limiter shared by every request, so that request starts are at least `SPACING` seconds apart.
+'''
+
+probe_plan: Optional[list[list[tuple[float, float]]]] = None
+'''
+The probe groups loaded from the plan produced by `planner.py`, if any.
+'''
+
+scheduler: Optional[ProbeScheduler] = None
+'''
+The adaptive scheduler, if the adaptive mode is enabled.
+'''
+
+session_pool: Optional[SessionPool] = None
+'''
+The session and CSRF token reused by every cycle, created by the first `save_data`.
+'''
+
 # Methods
 def get_bbox_info() -> tuple[float, float, int, int]:
     minx, miny, maxx, maxy = search_geometry.bounds
     return (minx, miny, int((maxx - minx) // XSTEP) + 1, int((maxy - miny) // YSTEP) + 1)
 
-def get_parking_status_around_taipei(s: requests.Session, group: int = 0, verbose: bool = True) -> LotCollection:
+def get_backoff(attempt: int) -> float:
+    '''
+    Get the delay before the retry after `attempt` earlier retries: half of the exponential delay capped
+    at `RETRY_CAP`, plus a random share of the other half so that retries don't fire in lockstep.
+    '''
+    delay = min(RETRY_CAP, RETRY_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def get_slot(t: datetime) -> datetime:
+    '''
+    Get the start of the `SLOT`-second slot that contains the time.
+    '''
+    midnight = t.replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight + timedelta(seconds=(t - midnight).total_seconds() // SLOT * SLOT)
+
+def get_breaker(url: str) -> CircuitBreaker:
+    host = urlparse(url).netloc
+    breaker = breakers.get(host)
+    if (breaker is None):
+        breaker = breakers.setdefault(host, CircuitBreaker())
+    return breaker
+
+def get_parking_status_around_taipei(s: requests.Session, group: int = 0, verbose: bool = True, concurrency: int = 1,
+                                     coords: Optional[list[tuple[float, float]]] = None, deadline: Optional[datetime] = None) -> LotCollection:
     '''
     Retrieve the parking lot status around Taipei.
+
+    Parameter
+    -------
+    s: requests.Session
+        The session that is going to call the API.
+
+    group: int, default 0
+        The code of predefined region.
+
+    verbose: bool, default True
+        Whether to enable the verbose logging.
+
+    concurrency: int, default 1
+        The number of probes in flight at once. The request start rate is still capped by `limiter`.
+
+    coords: list[tuple[float, float]], optional
+        The probes in the order to send them. Defaults to the probes of the group, picked by the scheduler if any.
+
+    deadline: datetime, optional
+        The time to stop starting probes. The probes not started by then are skipped and counted as abandoned.
+
+    Failed probes are requeued and retried together once the others are done, in up to `RETRY_ROUNDS` rounds
+    spaced by a jittered exponential backoff, as long as the slot has time left.
     '''
-    lots = LotCollection(datetime.now())
+    lots = LotCollection(datetime.now(), intern=True)
+    started = lots.timestamp
+    if (coords is None):
+        coords = get_probe_coords(group)
+        if (scheduler is not None):
+            total = len(coords)
+            coords = scheduler.select(coords)
+            log(f'Scheduled {len(coords)}/{total} probes in cycle {scheduler.cycle}.', group)
     count = 0
-    if (group == 0):
-        x0, y0, x_step_count, y_step_count = get_bbox_info()
-        for dx in range(x_step_count + 1):
-            for dy in range(y_step_count + 1):
-                point = shapely.Point(x0 + dx * XSTEP, y0 + dy * YSTEP)
-                if (search_geometry.contains(point)):
+    start = perf_counter()
+    pending = coords
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for attempt in range(RETRY_ROUNDS + 1):
+            if (attempt > 0):
+                delay = max(get_backoff(attempt - 1), get_breaker(URL).remaining)
+                if (datetime.now() + timedelta(seconds=delay) >= (deadline or started + timedelta(seconds=SLOT))):
+                    log(f'No time left in the slot to retry {len(pending)} failed probes.', group, logging.WARNING)
+                    break
+                log(f'Retrying {len(pending)} failed probes in {delay:.1f} seconds [Round {attempt}/{RETRY_ROUNDS}].', group)
+                sleep(delay)
+                metrics.observe_retry(group, len(pending))
+
+            failed: list[tuple[float, float]] = []
+            futures = {executor.submit(get_parking_status_at, s, px, py, group, attempt): (px, py) for px, py in pending}
+            expired = False
+            for future in as_completed(futures):
+                px, py = futures[future]
+                if (deadline is not None) and (not expired) and (datetime.now() >= deadline):
+                    expired = True
+                    skipped = sum(f.cancel() for f in futures)
+                    log(f'Reached the deadline and skipped {skipped} probes not started yet.', group, logging.WARNING)
+                if (future.cancelled()):
+                    failed.append((px, py))
+                    continue
+                if (verbose) and (attempt == 0):
                     count += 1
-                    if (verbose):
-                        log(f'Collecting... [{count}/1004]', group)
-                    
-                    try:
-                        sub_lots = get_parking_status_at(s, point.x, point.y)
-                        lots = lots.merge(sub_lots)
-                    except:
-                        log(f'Failed at ({point.x}, {point.y}).', group)
-
-                    sleep(SPACING)
-    else:
-        coords: list[tuple[float, float]]
-        match group:
-            case 1:
-                coords = GROUP_1
-            case 2:
-                coords = GROUP_2
-            case 3:
-                coords = GROUP_3
-            case 4:
-                coords = GROUP_4
-            case _:
-                coords = []
-        
-        for px, py in coords:
-            count += 1
-            if (verbose):
-                log(f'Collecting... [{count}/{len(coords)}]', group)
-            try:
-                sub_lots = get_parking_status_at(s, px, py)
-                lots = lots.merge(sub_lots)
-            except:
-                log(f'Failed at ({px}, {py}).', group)
-            sleep(SPACING)
-
-    log(f'Completed collecting {len(lots.lots)} parking lots.', group)
+                    log(f'Collecting... [{count}/{len(coords)}]', group)
+                try:
+                    sub_lots = future.result()
+                except Exception as ex:
+                    log(f'Failed at ({px}, {py}) and requeued it: {ex}', group)
+                    failed.append((px, py))
+                    continue
+                lots.merge(sub_lots, inplace=True)
+                if (scheduler is not None):
+                    scheduler.observe((px, py), sub_lots)
+                if (attempt == 0):
+                    lots.stats.succeeded += 1
+                else:
+                    lots.stats.recovered += 1
+            pending = failed
+            if (not pending):
+                break
+
+    lots.stats.abandoned = len(pending)
+    lots.missed = pending
+    if (pending):
+        log(f'Abandoned {len(pending)} probes: {", ".join(f"({px}, {py})" for px, py in pending[:10])}{" ..." if len(pending) > 10 else ""}', group, logging.WARNING)
+    elapsed = perf_counter() - start
+    metrics.observe_sweep(group, started, elapsed, len(coords), len(lots.lots), lots.stats)
+    if (scheduler is not None):
+        lots.stale = scheduler.get_stale(lots.timestamp)
+        if (lots.stale):
+            ages = lots.stale.values()
+            log(f'{len(lots.stale)} parking lots are stale (mean {sum(ages) / len(ages) / 60:.0f} min, max {max(ages) / 60:.0f} min).', group)
+    log(f'Covered {lots.stats.coverage:.1%} of {len(coords)} probes: {lots.stats.succeeded} succeeded, {lots.stats.recovered} recovered, {lots.stats.abandoned} abandoned.', group)
+    log(f'Collected {lots.stats.hits} lots from {len(coords)} probes: {lots.stats.unique} unique, {lots.stats.duplicates} duplicates ({lots.stats.overlap_ratio:.1%} overlap).', group)
+    log(f'Completed collecting {len(lots.lots)} parking lots in {elapsed:.1f} seconds ({elapsed / SLOT:.0%} of the {SLOT // 60}-minute slot).', group)
+    if (elapsed > SLOT):
+        log(f'The sweep overran the slot by {elapsed - SLOT:.1f} seconds.', group, logging.WARNING)
     return lots
 
-def get_parking_status_at(s: requests.Session, lon: float, lat: float, **kwargs) -> LotCollection:
-    retry = 0
+def get_parking_status_at(s: requests.Session, lon: float, lat: float, group: int = 0, attempt: int = 0) -> LotCollection:
+    '''
+    Retrieve the parking lot status around a coordinate with a single attempt.
 
-    if 'retry' in kwargs:
-        retry_param = kwargs.get('retry')
-        if (not isinstance(retry_param, int)):
-            pass
-        elif (retry_param <= 0):
-            pass
-        else:
-            retry = retry_param
+    Parameter
+    -------
+    attempt: int, default 0
+        The retry round of the sweep, for the metrics.
 
-    raw = get_response(s, URL.format(long=lon, lat=lat))
-    if (raw is None):
-        raise ConnectionError(f'The parking status is not retrievable at ({lon}, {lat}).')
+    Raises
+    -------
+    ProbeError
+        If there was no response, or it was not a JSON list even after refreshing a rejected token.
+    '''
+    probe = metrics.begin_probe(lon, lat, group, attempt)
+    ok = False
+    try:
+        url = URL.format(long=lon, lat=lat)
+        generation = 0 if session_pool is None else session_pool.generation
+        raw = get_response(s, url, group)
+        if (raw is not None) and (session_pool is not None) and (SessionPool.is_rejected(raw)):
+            if (session_pool.refresh(generation, group)):
+                raw = get_response(s, url, group)
+        if (raw is None):
+            raise ProbeError(f'The parking status is not retrievable at ({lon}, {lat}).')
+        if (not raw.ok):
+            raise ProbeError(f'Failed to fetch the API. ({raw.status_code}, {raw.reason})')
 
-    if (not raw.ok):
-        log(f'Failed to fetch the API [Attempt {retry + 1}]. ({raw.status_code}, {raw.reason})')
-        if (not retry_api_call(s, lon, lat, retry)):
-            return LotCollection()
-    
-    json = raw.json()
-    if (not isinstance(json, list)):
-        log(f'Failed to get a valid JSON [Attempt {retry + 1}].')
-        if (not retry_api_call(s, lon, lat, retry)):
-            return LotCollection()
-    
-    dt = datetime.now()
-    lots = LotCollection(dt)
-    for lot in json:
-        if (isinstance(lot, dict)):
-            lots.append(parse_lot_info(lot, dt))
+        start = perf_counter()
+        try:
+            json = raw.json()
+        except ValueError:
+            json = None
+        decoded = perf_counter() - start
+        if (not isinstance(json, list)):
+            raise ProbeError('Failed to get a valid JSON.')
 
-    return lots
+        start = perf_counter()
+        dt = datetime.now()
+        lots = LotCollection(dt)
+        geometry_cache.parse(json)
+        for lot in json:
+            if (isinstance(lot, dict)):
+                lots.append(parse_lot_info(lot, dt, geometry_cache))
+        metrics.observe_parse(probe, decoded + perf_counter() - start, len(lots.lots))
+
+        ok = True
+        return lots
+    finally:
+        metrics.end_probe(probe, ok)
+
+def get_group_coords(groups: list[int]) -> list[tuple[float, float]]:
+    '''
+    Get the probes of several groups, taking one from each group in turn, so that every region is sampled
+    evenly even if the sweep is cut short by its deadline. In the adaptive mode, each group keeps the order
+    of the scheduler.
+    '''
+    shards = [get_probe_coords(group) for group in groups]
+    if (scheduler is not None):
+        total = sum(len(shard) for shard in shards)
+        ranks = {coord: i for i, coord in enumerate(scheduler.select([coord for shard in shards for coord in shard]))}
+        shards = [sorted((coord for coord in shard if coord in ranks), key=ranks.__getitem__) for shard in shards]
+        log(f'Scheduled {len(ranks)}/{total} probes in cycle {scheduler.cycle}.')
+    coords: list[tuple[float, float]] = []
+    for i in range(max((len(shard) for shard in shards), default=0)):
+        coords.extend(shard[i] for shard in shards if i < len(shard))
+    return coords
+
+def get_probe_coords(group: int = 0) -> list[tuple[float, float]]:
+    '''
+    Get the probe coordinates of the predefined region.
+
+    Parameter
+    -------
+    group: int, default 0
+        The code of predefined region. `0` covers the whole city.
+
+    Returns
+    -------
+    coords: list[tuple[float, float]]
+        The (longitude, latitude) pairs to probe.
+    '''
+    if (probe_plan is not None):
+        if (group == 0):
+            return [coord for shard in probe_plan for coord in shard]
+        elif (1 <= group <= len(probe_plan)):
+            return probe_plan[group - 1]
+        else:
+            return []
+
+    # Fall back to the lattice inside `SEARCH_BOUND` and the hand-picked groups.
+    match group:
+        case 0:
+            x0, y0, x_step_count, y_step_count = get_bbox_info()
+            coords = []
+            for dx in range(x_step_count + 1):
+                for dy in range(y_step_count + 1):
+                    point = shapely.Point(x0 + dx * XSTEP, y0 + dy * YSTEP)
+                    if (search_geometry.contains(point)):
+                        coords.append((point.x, point.y))
+            return coords
+        case 1:
+            return GROUP_1
+        case 2:
+            return GROUP_2
+        case 3:
+            return GROUP_3
+        case 4:
+            return GROUP_4
+        case _:
+            return []
 
 def get_response(s: requests.Session, url: str, group: int = 0, headers: Optional[dict[str, str]] = None, retry: int = 0) -> requests.Response | None:
-    def _send_request() -> tuple[requests.Response, bool]:
+    '''
+    Send a GET request through the circuit breaker of the host.
+
+    Parameter
+    -------
+    retry: int, default 0
+        The number of times to send the request again, after a jittered exponential backoff,
+        if it fails or the server answers 429 or 5xx.
+
+    Returns
+    -------
+    response: requests.Response | None
+        The last response, or `None` if no request got one.
+    '''
+    def _send_request() -> requests.Response | None:
+        limiter.acquire()
+        start = perf_counter()
         try:
-            res = s.get(url, headers=headers)
-            return (res, True)
-        except ConnectionError:
-            log(f'Failed to retrieve the url `{url}`.', group)
-            return (requests.Response(), False)
+            res = s.get(url, headers=headers, timeout=TIMEOUT)
+            metrics.observe_request(group, perf_counter() - start, res.status_code, len(res.content))
+            return res
         except Exception as ex:
-            log(f'An error occured: {ex}', group)
-            return (requests.Response(), False)
+            metrics.observe_request(group, perf_counter() - start, None)
+            log(f'Failed to retrieve the url `{url}`: {ex}', group, logging.WARNING)
+            return None
 
-    response, status = _send_request()
-    if (status):
-        return response
-    else:
-        if (retry == 0):
-            connected = False
-            while (not connected):
-                sleep(10)
-                response, status = _send_request()
-                if (status):
-                    return response
-
-        else:
-            for i in range(retry):
-                sleep(10)
-                response, status = _send_request()
-                if (status):
-                    return response
-        
-        return response
+    breaker = get_breaker(url)
+    response = None
+    for attempt in range(retry + 1):
+        if (attempt > 0):
+            sleep(max(get_backoff(attempt - 1), breaker.remaining))
+            metrics.observe_retry(group)
+        if (not breaker.allow()):
+            response = None
+            continue
+        response = _send_request()
+        failed = (response is None) or (response.status_code == 429) or (response.status_code >= 500)
+        if (breaker.record(not failed)):
+            metrics.observe_breaker(group)
+            log(f'The circuit breaker of `{urlparse(url).netloc}` opened after {breaker.failures} failures in a row. Pausing for {breaker.cooldown} seconds.', group, logging.WARNING)
+        if (not failed):
+            break
+    return response
 
 def handshake(s: requests.Session, group: int = 0, verbose: bool = False) -> bool:
     '''
@@ -333,7 +1567,7 @@ def handshake(s: requests.Session, group: int = 0, verbose: bool = False) -> boo
     if (verbose):
         log('Start the handshake...', group)
     
-    raw = get_response(s, BASEURL, group, BASEHEADER)
+    raw = get_response(s, BASEURL, group, BASEHEADER, retry=RETRY_ROUNDS)
     if (raw is None):
         log(f'Failed test 1-0: Error when setting up connection.')
         return False
@@ -362,7 +1596,7 @@ def handshake(s: requests.Session, group: int = 0, verbose: bool = False) -> boo
     
     s.headers.update(HEADER)
     s.headers.update({'X-CSRF-TOKEN': token})
-    raw = get_response(s, URL.format(long=121.54, lat=25.04), group)
+    raw = get_response(s, URL.format(long=121.54, lat=25.04), group, retry=RETRY_ROUNDS)
     if (raw is None):
         log(f'Failed test 2-0: Error when setting up connection.')
         return False
@@ -377,17 +1611,51 @@ def handshake(s: requests.Session, group: int = 0, verbose: bool = False) -> boo
         return False
     return True
 
+def flush_log(group: int = 0) -> None:
+    '''
+    Write the buffered messages of the group to its log file.
+    '''
+    for handler in get_logger(group).handlers:
+        handler.flush()
+
+def get_logger(group: int = 0) -> logging.Logger:
+    '''
+    Get the logger of the group. It prints every message at once, but buffers the writes to the log file
+    until `LOG_BUFFER` messages are pending, a warning is logged or `flush_log` is called.
+    '''
+    logger = logging.getLogger('crawler' if group == 0 else f'crawler.g{group}')
+    if (not logger.handlers):
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        formatter = logging.Formatter('[%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S')
+        os.makedirs(LOG_DIR, exist_ok=True)
+        file_handler = logging.FileHandler(get_log_path(group), encoding='utf-8', delay=True)
+        file_handler.setFormatter(formatter)
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(formatter)
+        logger.addHandler(MemoryHandler(LOG_BUFFER, logging.WARNING, file_handler))
+        logger.addHandler(console_handler)
+    return logger
+
+def get_log_path(group: int = 0, previous: bool = False) -> str:
+    name = 'crawler' if group == 0 else f'crawler_g{group}'
+    return os.path.join(LOG_DIR, f'{name}_prev.txt' if previous else f'{name}.txt')
+
+def get_session_path(group: int = 0) -> str:
+    return SESSION_CACHE if group == 0 else SESSION_CACHE.replace('.json', f'_g{group}.json')
+
 def init_log(group: Optional[int]) -> None:
-    log_dir = './script/log'
-    os.makedirs(log_dir, exist_ok=True)
+    g = 0 if group is None else group
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = get_log_path(g)
+    prev_path = get_log_path(g, previous=True)
+
+    # Close the log file before it's rotated.
+    logger = get_logger(g)
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
 
-    if (group is None) or (group == 0):
-        log_path = os.path.join(log_dir, 'crawler.txt')
-        prev_path = os.path.join(log_dir, 'crawler_prev.txt')
-    else:
-        log_path = os.path.join(log_dir, f'crawler_g{group}.txt')
-        prev_path = os.path.join(log_dir, f'crawler_g{group}_prev.txt')
-    
     if os.path.exists(log_path):
         if os.path.exists(prev_path):
             os.remove(prev_path)
@@ -396,56 +1664,135 @@ def init_log(group: Optional[int]) -> None:
     with open(log_path, 'w', encoding='utf-8') as f:
         f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Initiated the new log.\n")
 
-def log(msg: Any, group: int = 0) -> None:
+def load_probe_plan(path: str = PROBE_PLAN) -> Optional[list[list[tuple[float, float]]]]:
     '''
-    Log the message with a timestamp.
+    Load the probe groups from the plan produced by `planner.py`.
+
+    Returns
+    -------
+    plan: list[list[tuple[float, float]]] | None
+        The probe coordinates of each group, or `None` if there's no plan file.
     '''
-    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
-    print(msg_str)
+    if (not os.path.exists(path)):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        plan = load(f)
+    return [[(float(x), float(y)) for x, y in shard] for shard in plan['groups']]
 
-    log_dir = './script/log'
-    os.makedirs(log_dir, exist_ok=True)
+def log(msg: Any, group: int = 0, level: int = logging.INFO) -> None:
+    '''
+    Log the message with a timestamp, through the buffered logger of the group.
+    '''
+    get_logger(group).log(level, str(msg))
 
-    if (group == 0):
-        log_path = os.path.join(log_dir, 'crawler.txt')
-    else:
-        log_path = os.path.join(log_dir, f'crawler_g{group}.txt')
-    with open(log_path, 'a', encoding='utf-8') as f:
-        f.write(msg_str + '\n')
+def main(max_runs: Optional[int] = None, groups: Optional[list[int]] = None, concurrency: int = 1, metrics_dir: str = METRICS_DIR):
+    '''
+    Crawl the groups. A single group runs as it always has: each snapshot is named and timestamped by the time
+    it's saved, and the next cycle starts at the next 10-minute boundary after the sweep ends.
 
-def main(max_runs: Optional[int] = None, group: Optional[int] = 0):
-    g = 0 if group is None else group
+    Several groups are crawled together in every slot, through one session and one rate limiter. The first cycle starts
+    at once with a full slot of time, and the others at the start of the next slot. A cycle that runs into the next slot is recorded
+    as an overrun, and the next cycle starts late but keeps the deadline of its own slot, so the snapshots
+    stay aligned to the slots and are named by the slot start.
+    '''
+    groups = groups or [0]
+    g = groups[0] if len(groups) == 1 else 0
+    scheduled = len(groups) > 1
     try:
         count = 0
+        slot = get_slot(datetime.now())
+        deadline = datetime.now() + timedelta(seconds=SLOT)
         while True:
-            log(f'Running group {g} now...', g)
-            save_data(g)
+            if (scheduled):
+                log(f'Running group {", ".join(map(str, groups))} for the slot at {slot:%H:%M} now...', g)
+                save_data(groups, concurrency, metrics_dir, slot, deadline)
+            else:
+                log(f'Running group {g} now...', g)
+                save_data(groups, concurrency, metrics_dir)
             count += 1
             if max_runs and count >= max_runs:
                 log('Reached maximum runs. Exiting...', g)
                 break
-            wait()
+            if (scheduled):
+                # The first cycle is off the schedule, so the schedule starts from the slot it ended in.
+                slot = wait_for_slot(slot if count > 1 else get_slot(datetime.now()), g)
+                deadline = slot + timedelta(seconds=SLOT)
+            else:
+                wait()
     except KeyboardInterrupt:
         log('Terminated by user (Ctrl+C). Exiting gracefully...', g)
+    finally:
+        flush_log(g)
 
-def save_data(group: int = 0) -> None:
+def new_session(concurrency: int = 1) -> requests.Session:
     '''
-    Open a session and save the data.
+    Create a session whose connection pool keeps enough keep-alive connections for every probe in flight.
     '''
     s = requests.Session()
-    if (not handshake(s, verbose=True)):
-        log('The handshake failed. Terminating the process...', group)
-        return
-    lots = get_parking_status_around_taipei(s, group, verbose=True)
-    time_str = datetime.now().strftime('%u-%H-%M-%S (%Y-%m-%d)')
-    if (group == 0):
-        lots.to_geojson_file(f'./data/{time_str}.geojson')
-        log(f'The result was saved to {time_str}.geojson.', group)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, concurrency))
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+def save_data(groups: Optional[list[int]] = None, concurrency: int = 1, metrics_dir: str = METRICS_DIR,
+              slot: Optional[datetime] = None, deadline: Optional[datetime] = None) -> None:
+    '''
+    Crawl the groups through the shared session and save them as one snapshot, then write the metrics
+    and the buffered log.
+
+    Parameter
+    -------
+    groups: list[int], optional
+        The codes of the predefined regions. Defaults to the whole city.
+
+    slot: datetime, optional
+        The start of the slot, which names the snapshot. Defaults to the time it's saved.
+
+    deadline: datetime, optional
+        The time to stop starting probes.
+    '''
+    global session_pool
+    groups = groups or [0]
+    group = groups[0] if len(groups) == 1 else 0
+    try:
+        if (session_pool is None):
+            session_pool = SessionPool(concurrency, get_session_path(group))
+            session_pool.load()
+        if (not session_pool.ensure(group)):
+            log('The handshake failed. Terminating the process...', group, logging.ERROR)
+            return
+        coords = get_group_coords(groups) if len(groups) > 1 else None
+        lots = get_parking_status_around_taipei(session_pool.session, group, verbose=True, concurrency=concurrency, coords=coords, deadline=deadline)
+        if (len(groups) > 1):
+            missed = set(lots.missed)
+            log('Sampled ' + ', '.join(f'{sum(coord not in missed for coord in shard)}/{len(shard)} probes of group {g}'
+                                       for g, shard in zip(groups, map(get_probe_coords, groups))) + '.', group)
+        session_pool.save()
+        geometry_cache.save()
+        if (scheduler is not None):
+            scheduler.save()
+        save_lots(lots, group, slot)
+    finally:
+        metrics.write(metrics_dir, group)
+        flush_log(group)
+
+def save_lots(lots: LotCollection, group: int = 0, slot: Optional[datetime] = None) -> None:
+    '''
+    Save the collection as a snapshot named after the slot, or the current time if there's no slot,
+    in the format chosen by `lot_catalog`.
+    '''
+    if (slot is not None):
+        lots.timestamp = slot
+    time_str = (slot or datetime.now()).strftime('%u-%H-%M-%S (%Y-%m-%d)')
+    file_name = time_str if group == 0 else f'{time_str}({group})'
+    if (lot_catalog is None):
+        lots.to_geojson_file(f'./data/{file_name}.geojson')
+        log(f'The result was saved to {file_name}.geojson.', group)
     else:
-        lots.to_geojson_file(f'./data/{time_str}({group}).geojson')
-        log(f'The result was saved to {time_str}({group}).geojson.', group)
+        lots.to_snapshot_file(f'./data/{file_name}.snap', lot_catalog)
+        log(f'The result was saved to {file_name}.snap (catalog {lot_catalog.version}).', group)
 
-def parse_lot_info(text: dict[str, Any], timestamp: Optional[datetime] = None) -> Lot:
+def parse_lot_info(text: dict[str, Any], timestamp: Optional[datetime] = None, cache: Optional[GeometryCache] = None) -> Lot:
     '''
     Parse the dictionary to the parking lot information.
 
@@ -453,6 +1800,12 @@ def parse_lot_info(text: dict[str, Any], timestamp: Optional[datetime] = None) -
     --------
     text: dict[str, Any]
         The JSON dictionary.
+
+    timestamp: datetime, optional
+        The time when the result was obtained. Defaults to now.
+
+    cache: GeometryCache, optional
+        The cache to look the shape up in, instead of parsing the WKT again.
     
     Returns
     --------
@@ -494,26 +1847,18 @@ def parse_lot_info(text: dict[str, Any], timestamp: Optional[datetime] = None) -
     
     if ('wkt' in text.keys()):
         wkt = str(text['wkt'])
-        geometry = shapely.from_wkt(wkt, on_invalid='ignore')
-        if (isinstance(geometry, shapely.Polygon)):
-            shape = geometry
+        if (cache is not None) and ('parkId' in text.keys()):
+            shape = cache.get(text['parkId'], wkt)
+        else:
+            geometry = shapely.from_wkt(wkt, on_invalid='ignore')
+            if (isinstance(geometry, shapely.Polygon)):
+                shape = geometry
     
     if (timestamp is None):
         timestamp = datetime.now()
     
     return Lot(id, name, not vacancy, hour, shape, timestamp, toll)
 
-def retry_api_call(s: requests.Session, lon: float, lat: float, retry: int) -> bool:
-    if (retry < 2):
-        log(f'Retry in 10 seconds...')
-        sleep(10)
-        get_parking_status_at(s, lon, lat, retry=retry+1)
-        return True
-
-    else:
-        log(f'The retry attempt has reached the limit. Aborting the process...')
-        return False
-
 def wait():
     now = datetime.now()
     minutes = (now.minute // 10 + 1) * 10
@@ -524,6 +1869,29 @@ def wait():
     wait_seconds = (next_run - now).total_seconds()
     sleep(wait_seconds)
 
+def wait_for_slot(slot: datetime, group: int = 0) -> datetime:
+    '''
+    Wait for the slot after the given one. If it has already begun, record the overrun and return at once,
+    skipping the slots that are already over instead of shifting the schedule.
+
+    Returns
+    -------
+    slot: datetime
+        The start of the slot to crawl next.
+    '''
+    next_slot = slot + timedelta(seconds=SLOT)
+    now = datetime.now()
+    overrun = max(0.0, (now - next_slot).total_seconds())
+    skipped = int(overrun // SLOT)
+    next_slot += timedelta(seconds=skipped * SLOT)
+    metrics.observe_slot(group, slot, overrun, skipped)
+    if (overrun > 0):
+        log(f'The cycle of the slot at {slot:%H:%M} ran {overrun:.1f} seconds into the next slot'
+            + (f', skipping {skipped} slots' if skipped else '') + f'. The slot at {next_slot:%H:%M} starts late.', group, logging.WARNING)
+    else:
+        sleep((next_slot - now).total_seconds())
+    return next_slot
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Access Taipei City\'s roadside parking vacancy API and save them as GeoJSON.')
     parser.add_argument(
@@ -535,9 +1903,59 @@ if __name__ == '__main__':
     parser.add_argument(
         '--group', '-g',
         type=int,
-        default=0,
-        help='The code of predefined region. (1 = North, 2 = West, 3 = South, 4 = East)'
+        nargs='+',
+        default=[0],
+        help='The codes of predefined regions. (1 = North, 2 = West, 3 = South, 4 = East, or the shard number of the probe plan) '
+             'Several groups are crawled together in one process and saved as one snapshot.'
+    )
+    parser.add_argument(
+        '--plan', '-p',
+        type=str,
+        default=PROBE_PLAN,
+        help='The probe plan produced by planner.py. The predefined regions are used if the file does not exist.'
+    )
+    parser.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=4,
+        help='The number of requests in flight at once. Request starts are still spaced by the politeness floor.'
+    )
+    parser.add_argument(
+        '--adaptive', '-a',
+        action='store_true',
+        help='Poll volatile probes every cycle and stable ones less often.'
+    )
+    parser.add_argument(
+        '--budget', '-b',
+        type=int,
+        default=200,
+        help='The maximum number of probes per cycle in the adaptive mode. Leave it 0 to poll every probe.'
+    )
+    parser.add_argument(
+        '--max-age',
+        type=int,
+        default=6,
+        help='The maximum number of cycles a probe can go unpolled in the adaptive mode.'
+    )
+    parser.add_argument(
+        '--format', '-f',
+        choices=['geojson', 'snapshot'],
+        default='geojson',
+        help='The output format. `snapshot` writes only the occupancy and keeps the static attributes in a versioned catalog.'
+    )
+    parser.add_argument(
+        '--metrics-dir', '-m',
+        type=str,
+        default=METRICS_DIR,
+        help='The directory of the Prometheus textfile and the JSON lines of every probe and sweep.'
     )
     args = parser.parse_args()
-    init_log(group=args.group)
-    main(max_runs=args.run, group=args.group)
\ No newline at end of file
+    init_log(group=args.group[0] if len(args.group) == 1 else 0)
+    geometry_cache.load()
+    probe_plan = load_probe_plan(args.plan)
+    if (args.format == 'snapshot'):
+        lot_catalog = LotCatalog.load(os.path.join('./data', CATALOG_DIR))
+    if (args.adaptive):
+        scheduler = ProbeScheduler(args.budget, args.max_age)
+        scheduler.load(history_path=HISTORY_BINARY if os.path.exists(HISTORY_BINARY) else HISTORY)
+    main(max_runs=args.run, groups=args.group, concurrency=args.concurrency, metrics_dir=args.metrics_dir)
\ No newline at end of file
@@ -1,8 +1,12 @@
+from aggregate import get_snapshot_time
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import geopandas as gpd
 import os
 import pandas as pd
+import shapely
+from snapshot import CATALOG_DIR, LotCatalog
 from typing import Any, Optional
 
 # Constants
@@ -10,23 +14,45 @@ DATA_DIR = './data'
 LOG_DIR = './script/log'
 
 # Methods
-def get_static_data(verbose: bool = False) -> gpd.GeoDataFrame:
-    paths = [f for f in os.listdir(DATA_DIR) if f.endswith('.geojson')]
-    gdfs = []
-    
-    for i, path in enumerate(paths, 1):
-        gdf = gpd.read_file(os.path.join(DATA_DIR, path))
-        gdfs.append(gdf[['id', 'name', 'service', 'toll', 'geometry']])
-        
-        if verbose:
-            log(f'{i}/{len(paths)} ({path})')
-    
-    if not gdfs:
+def get_static_data(verbose: bool = False, workers: int = 1) -> gpd.GeoDataFrame:
+    '''
+    Collect the static properties of every lot. When a lot appears in several files, the newest snapshot wins.
+
+    Parameters
+    ----------
+    verbose : bool, default False
+        Whether to log every file.
+    workers : int, default 1
+        The number of processes reading the files. Each reads a contiguous run of files into a catalog,
+        and the catalogs are merged in order.
+    '''
+    paths = sorted([f for f in os.listdir(DATA_DIR) if f.endswith('.geojson')],
+                   key=lambda f: (get_snapshot_time(f) or datetime.min, f))
+    catalog: dict[str, tuple[Any, Any, Any, bytes]] = {}
+
+    if (workers <= 1) or (len(paths) <= 1):
+        catalog = read_catalog(paths, verbose)
+    else:
+        chunk_count = min(len(paths), workers * 4)
+        chunks = [paths[len(paths) * i // chunk_count:len(paths) * (i + 1) // chunk_count] for i in range(chunk_count)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for partial in executor.map(read_catalog, chunks, [verbose] * chunk_count):
+                catalog.update(partial)
+
+    # The catalog of the compact snapshots holds the latest attributes, so it's applied last.
+    lot_catalog = LotCatalog.load(os.path.join(DATA_DIR, CATALOG_DIR))
+    if (len(lot_catalog) > 0):
+        lots = [lot for lot in lot_catalog.lots if lot['geometry'] is not None]
+        shapes = shapely.to_wkb(shapely.from_wkt([lot['geometry'] for lot in lots]))
+        catalog.update((lot['id'], (lot['name'], lot['service'], lot['toll'], shape)) for lot, shape in zip(lots, shapes))
+        log(f'Applied the lot catalog {lot_catalog.version}.')
+
+    if not catalog:
         return gpd.GeoDataFrame(columns=['id', 'name', 'service', 'toll'], geometry='geometry')
-    
-    result_gdf = gpd.GeoDataFrame(
-        pd.concat(gdfs, ignore_index=True)
-    ).drop_duplicates(subset='id', keep='first')
+
+    names, services, tolls, shapes = zip(*catalog.values())
+    result_gdf = gpd.GeoDataFrame({'id': list(catalog.keys()), 'name': names, 'service': services, 'toll': tolls},
+                                  geometry=gpd.GeoSeries.from_wkb(shapes, crs='EPSG:4326'))
 
     log(f'Successfully processed {len(paths)} file(s).')
     return result_gdf
@@ -38,6 +64,22 @@ def load_data(path: str) -> gpd.GeoDataFrame:
     else:
         return gpd.GeoDataFrame(columns=['id', 'name', 'service', 'toll'], geometry='geometry')
 
+def read_catalog(paths: list[str], verbose: bool = False) -> dict[str, tuple[Any, Any, Any, bytes]]:
+    '''
+    Read the files in order into a dictionary of lot id to name, service, toll and WKB shape.
+    Later files overwrite earlier ones.
+    '''
+    catalog: dict[str, tuple[Any, Any, Any, bytes]] = {}
+    for path in paths:
+        gdf = gpd.read_file(os.path.join(DATA_DIR, path))
+        if (('id' in gdf.columns) & ('name' in gdf.columns) & ('service' in gdf.columns) & ('toll' in gdf.columns)):
+            gdf = gdf[gdf['id'].notna() & gdf.geometry.notna()]
+            catalog.update(zip(gdf['id'], zip(gdf['name'], gdf['service'], gdf['toll'], gdf.geometry.to_wkb())))
+
+        if verbose:
+            log(f'{path}')
+    return catalog
+
 def log(msg: Any) -> None:
     msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
     print(msg_str)
@@ -47,15 +89,15 @@ def log(msg: Any) -> None:
     with open(log_path, 'a', encoding='utf-8') as f:
         f.write(msg_str + '\n')
 
-def main(load_path: Optional[str] = None, verbose: bool = False):
+def main(load_path: Optional[str] = None, verbose: bool = False, workers: int = 1):
     if load_path is None:
-        get_static_data(verbose).to_file(os.path.join(DATA_DIR, 'realtime-lot.geojson'))
+        get_static_data(verbose, workers).to_file(os.path.join(DATA_DIR, 'realtime-lot.geojson'))
     else:
         old_data = load_data(load_path)
-        new_data = get_static_data(verbose)
+        new_data = get_static_data(verbose, workers)
         result_gdf = gpd.GeoDataFrame(
-            pd.concat([old_data, new_data], ignore_index=True).sort_values('id')
-        ).drop_duplicates(subset='id', keep='first')
+            pd.concat([old_data, new_data], ignore_index=True).drop_duplicates(subset='id', keep='last').sort_values('id')
+        )
         result_gdf.to_file(os.path.join(DATA_DIR, 'realtime-lot.geojson'))
 
 if __name__ == '__main__':
@@ -71,5 +113,11 @@ if __name__ == '__main__':
         action='store_true',
         help='Enable verbose logging.'
     )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=1,
+        help='The number of processes reading the files.'
+    )
     args = parser.parse_args()
-    main(args.load_file, args.verbose)
\ No newline at end of file
+    main(args.load_file, args.verbose, args.workers)
\ No newline at end of file
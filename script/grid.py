@@ -0,0 +1,393 @@
+import argparse
+from crawler import search_geometry
+from datetime import datetime
+import hashlib
+from history import HistoryFile, is_history_file
+import json
+import numpy as np
+import os
+import pyproj
+import shapely
+from typing import Any
+
+# Constants
+CACHE = './data/cache/grid.npz'
+CAR_PER_HOUR = 1
+CATEGORIES = ('批發', '郵政', '零售', '餐飲')
+CELL_SIZE = 200
+CRS = 3826
+HISTORY = './data/history.json'
+LOG_DIR = './script/log'
+MAX_NULLS = 150
+PERIODS = {'早': ((24, 72),), '中': ((72, 120),), '晚': ((120, 144), (0, 24))}
+RADIUS = 50
+SERVER_DATA = './server/htdocs/parking/data'
+SLOTS = 144
+
+# Variables
+to_metric = pyproj.Transformer.from_crs(4326, CRS, always_xy=True)
+to_degree = pyproj.Transformer.from_crs(CRS, 4326, always_xy=True)
+
+# Classes
+class GridIndex:
+    '''
+    The spatial join between the grid and the POIs and lots, which only changes when the inputs do.
+    '''
+
+    cells: np.ndarray
+    '''
+    The cells in EPSG:3826, in the order of their `Index`.
+    '''
+
+    poi_cells: np.ndarray
+    poi_categories: np.ndarray
+    poi_coverage: np.ndarray
+    '''
+    The cell, category index and demand coverage of each (POI, cell) pair.
+    '''
+
+    lot_ids: list[str]
+    '''
+    The id of each lot, as used in `history.json`.
+    '''
+
+    lot_pairs: np.ndarray
+    lot_cells: np.ndarray
+    lot_fractions: np.ndarray
+    '''
+    The lot, cell and share of the lot buffer inside the cell of each (lot, cell) pair.
+    '''
+
+    key: str
+    '''
+    The digest of the inputs the join was computed from.
+    '''
+
+    def get_demand(self: 'GridIndex') -> np.ndarray:
+        '''
+        Get the (cells, categories) demand, summing the coverage of every POI reaching each cell.
+        '''
+        keys = self.poi_cells * len(CATEGORIES) + self.poi_categories
+        demand = np.bincount(keys, weights=self.poi_coverage, minlength=len(self.cells) * len(CATEGORIES))
+        return np.round(demand.reshape(len(self.cells), len(CATEGORIES)), 1)
+
+    def get_supply(self: 'GridIndex', car_per_hour: float = CAR_PER_HOUR) -> np.ndarray:
+        '''
+        Get the supply of each cell: the share of every lot buffer inside it × 8 hours × `car_per_hour`.
+        '''
+        supply = np.round(self.lot_fractions * 8 * car_per_hour, 1)
+        return np.round(np.bincount(self.lot_cells, weights=supply, minlength=len(self.cells)), 1)
+
+    def get_vacancy(self: 'GridIndex', rates: np.ndarray) -> np.ndarray:
+        '''
+        Get the (cells, periods) vacancy rate, averaging the lots whose buffers reach each cell. Cells without data are NaN.
+
+        Parameter
+        -------
+        rates: np.ndarray
+            The (lots, periods) vacancy rate of each lot, with NaN for lots without enough data.
+        '''
+        values = rates[self.lot_pairs]
+        known = ~np.isnan(values)
+        vacancy = np.full((len(self.cells), rates.shape[1]), np.nan)
+        for p in range(rates.shape[1]):
+            total = np.bincount(self.lot_cells, weights=np.where(known[:, p], values[:, p], 0), minlength=len(self.cells))
+            count = np.bincount(self.lot_cells, weights=known[:, p], minlength=len(self.cells))
+            np.divide(total, count, out=vacancy[:, p], where=count > 0)
+        return np.round(vacancy, 4)
+
+    def save(self: 'GridIndex', path: str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        _, coords, (rings, polygons) = shapely.to_ragged_array(self.cells)
+        np.savez_compressed(path,
+                            key=np.array(self.key),
+                            cell_coords=coords,
+                            cell_rings=rings,
+                            cell_polygons=polygons,
+                            poi_cells=self.poi_cells,
+                            poi_categories=self.poi_categories,
+                            poi_coverage=self.poi_coverage,
+                            lot_ids=np.array(self.lot_ids, dtype=str),
+                            lot_pairs=self.lot_pairs,
+                            lot_cells=self.lot_cells,
+                            lot_fractions=self.lot_fractions)
+
+    @classmethod
+    def build(cls, key: str, cells: np.ndarray, pois: np.ndarray, categories: np.ndarray, lot_ids: list[str], lots: np.ndarray, radius: float = RADIUS) -> 'GridIndex':
+        '''
+        Join the POI and lot buffers to the cells with one bulk STRtree query each, and measure the overlaps at once.
+
+        Parameter
+        -------
+        cells: np.ndarray
+            The cells in EPSG:3826.
+
+        pois: np.ndarray
+            The POI points in EPSG:3826.
+
+        categories: np.ndarray
+            The category index of each POI.
+
+        lots: np.ndarray
+            The lot centroids in EPSG:3826.
+        '''
+        obj = cls()
+        obj.key = key
+        obj.cells = cells
+        obj.lot_ids = lot_ids
+        tree = shapely.STRtree(cells)
+
+        # Demand: each POI spreads half of its buffer share, rounded per cell as in the original notebook.
+        poi_buffers = shapely.buffer(pois, radius, quad_segs=16)
+        poi_idx, cell_idx = tree.query(poi_buffers, predicate='intersects')
+        areas = shapely.area(shapely.intersection(poi_buffers[poi_idx], cells[cell_idx]))
+        coverage = np.round(areas / shapely.area(poi_buffers)[poi_idx] * 0.5, 1)
+        keep = coverage > 0
+        obj.poi_cells = cell_idx[keep]
+        obj.poi_categories = categories[poi_idx[keep]]
+        obj.poi_coverage = coverage[keep]
+
+        # Supply and vacancy: every lot buffer touching the cell.
+        lot_buffers = shapely.buffer(lots, radius, quad_segs=16)
+        lot_idx, cell_idx = tree.query(lot_buffers, predicate='intersects')
+        areas = shapely.area(shapely.intersection(lot_buffers[lot_idx], cells[cell_idx]))
+        obj.lot_pairs = lot_idx
+        obj.lot_cells = cell_idx
+        obj.lot_fractions = areas / shapely.area(lot_buffers)[lot_idx]
+        return obj
+
+    @classmethod
+    def load(cls, path: str, key: str) -> 'GridIndex | None':
+        '''
+        Load the cached join, or `None` if there is none or it was computed from other inputs.
+        '''
+        if (not os.path.exists(path)):
+            return None
+        with np.load(path) as data:
+            if (str(data['key']) != key):
+                return None
+            obj = cls()
+            obj.key = key
+            obj.cells = shapely.from_ragged_array(shapely.GeometryType.POLYGON, data['cell_coords'], (data['cell_rings'], data['cell_polygons']))
+            obj.poi_cells = data['poi_cells']
+            obj.poi_categories = data['poi_categories']
+            obj.poi_coverage = data['poi_coverage']
+            obj.lot_ids = data['lot_ids'].tolist()
+            obj.lot_pairs = data['lot_pairs']
+            obj.lot_cells = data['lot_cells']
+            obj.lot_fractions = data['lot_fractions']
+        return obj
+
+# Methods
+def get_cells(base: str | None = None, size: float = CELL_SIZE) -> np.ndarray:
+    '''
+    Get the cells in EPSG:3826: either the cells of an existing grid file, or a lattice of `size` meters
+    over `SEARCH_BOUND`, numbered column by column from the north-west and keeping the cells that touch it.
+    '''
+    if (base is not None):
+        with open(base, 'r', encoding='utf-8') as f:
+            features = sorted(json.load(f)['features'], key=lambda x: x['properties']['Index'])
+        return project(shapely.from_geojson([json.dumps(f['geometry']) for f in features]), to_metric)
+
+    bound = project(np.array([search_geometry]), to_metric)[0]
+    minx, miny, maxx, maxy = bound.bounds
+    xs = minx + size * np.arange(int(np.ceil((maxx - minx) / size)))
+    ys = maxy - size * np.arange(1, int(np.ceil((maxy - miny) / size)) + 1)
+    x, y = np.meshgrid(xs, ys, indexing='ij')
+    cells = shapely.box(x.ravel(), y.ravel(), x.ravel() + size, y.ravel() + size, ccw=False)
+    return cells[shapely.intersects(cells, bound)]
+
+def get_key(*paths: str | None, size: float = CELL_SIZE, radius: float = RADIUS) -> str:
+    '''
+    Get the digest of the inputs of the spatial join.
+    '''
+    digest = hashlib.sha256(f'{size}|{radius}|{search_geometry.wkt}'.encode())
+    for path in paths:
+        if (path is not None):
+            with open(path, 'rb') as f:
+                digest.update(hashlib.file_digest(f, 'sha256').digest())
+    return digest.hexdigest()
+
+def get_vacancy_rates(lot_ids: list[str], history: str) -> np.ndarray:
+    '''
+    Get the (lots, periods) vacancy rate of each lot from `history.json`, `history.bin` or `history-stats.json`.
+    Lots missing from the history or with more than `MAX_NULLS` empty slots in the week are NaN.
+    '''
+    observed = np.zeros((len(lot_ids), 7 * SLOTS))
+    occupied = np.zeros((len(lot_ids), 7 * SLOTS))
+    if (is_history_file(history)):
+        # Only the rows of the requested lots are read from the mapped file.
+        binary = HistoryFile(history)
+        found = [(row, binary.index[id]) for row, id in enumerate(lot_ids) if id in binary.index]
+        if (found):
+            rows, lots = map(list, zip(*found))
+            cube = binary.get_rows(lots).reshape(len(lots), -1)
+            observed[rows] = cube >= 0
+            occupied[rows] = cube == 1
+    else:
+        with open(history, 'r', encoding='utf-8') as f:
+            data: dict[str, dict[str, Any]] = json.load(f)
+        for row, id in enumerate(lot_ids):
+            days = data.get(id)
+            if (days is None):
+                continue
+            for d, v in days.items():
+                start = (int(d) - 1) * SLOTS
+                if (isinstance(v, dict)):
+                    # Multi-week statistics from `aggregate.py --stats`.
+                    observed[row, start:start + len(v['n'])] = v['n']
+                    occupied[row, start:start + len(v['occupied'])] = v['occupied']
+                else:
+                    values = np.asarray(v, dtype=float)
+                    observed[row, start:start + len(values)] = ~np.isnan(values)
+                    occupied[row, start:start + len(values)] = np.nan_to_num(values)
+
+    observed = observed.reshape(-1, 7, SLOTS)
+    occupied = occupied.reshape(-1, 7, SLOTS)
+    rates = np.full((len(lot_ids), len(PERIODS)), np.nan)
+    for p, ranges in enumerate(PERIODS.values()):
+        n = sum(observed[:, :, a:b].sum(axis=(1, 2)) for a, b in ranges)
+        k = sum(occupied[:, :, a:b].sum(axis=(1, 2)) for a, b in ranges)
+        np.divide(k, n, out=rates[:, p], where=n > 0)
+    rates = np.round(1 - rates, 4)
+    rates[(observed == 0).sum(axis=(1, 2)) > MAX_NULLS] = np.nan
+    return rates
+
+def load_lots(path: str) -> tuple[list[str], np.ndarray]:
+    '''
+    Load the loading-zone lots. Their ids are `<Road>_<Number>`, as the crawler names them.
+
+    Returns
+    -------
+    ids: list[str]
+        The id of every lot.
+
+    lots: np.ndarray
+        The lot centroids in EPSG:3826.
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        features = [x for x in json.load(f)['features'] if x.get('geometry') is not None]
+    ids = [f'{x["properties"]["Road"]}_{x["properties"]["Number"]}' for x in features]
+    geometries = shapely.from_geojson([json.dumps(x['geometry']) for x in features])
+    return ids, project(shapely.centroid(geometries), to_metric)
+
+def load_pois(path: str) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Load the POIs and explode them into single points.
+
+    Returns
+    -------
+    pois: np.ndarray
+        The POI points in EPSG:3826.
+
+    categories: np.ndarray
+        The index of each POI in `CATEGORIES`.
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        features = [x for x in json.load(f)['features'] if x['properties'].get('Category') in CATEGORIES]
+    geometries = shapely.from_geojson([json.dumps(x['geometry']) for x in features])
+    parts, index = shapely.get_parts(geometries, return_index=True)
+    categories = np.array([CATEGORIES.index(x['properties']['Category']) for x in features], dtype=np.int64)
+    return project(parts, to_metric), categories[index]
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'grid.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def main(poi: str, lots: str, history: str, output: str, base: str | None = None, cache: str = CACHE, size: float = CELL_SIZE) -> None:
+    key = get_key(poi, lots, base, size=size)
+    index = GridIndex.load(cache, key)
+    if (index is None):
+        cells = get_cells(base, size)
+        pois, categories = load_pois(poi)
+        lot_ids, lot_points = load_lots(lots)
+        index = GridIndex.build(key, cells, pois, categories, lot_ids, lot_points)
+        index.save(cache)
+        log(f'Joined {len(pois)} POIs and {len(lot_ids)} lots to {len(cells)} cells. The join was cached to `{cache}`.')
+    else:
+        log(f'Loaded the join of {len(index.cells)} cells from `{cache}`.')
+
+    demand = index.get_demand()
+    supply = index.get_supply()
+    vacancy = index.get_vacancy(get_vacancy_rates(index.lot_ids, history)) if os.path.exists(history) else np.full((len(index.cells), len(PERIODS)), np.nan)
+    to_file(output, index.cells, supply, demand, vacancy)
+    log(f'The grid ({np.count_nonzero(~np.isnan(vacancy[:, 0]))}/{len(index.cells)} cells with vacancy data) was saved to `{output}`.')
+
+def project(geometries: np.ndarray, transformer: pyproj.Transformer) -> np.ndarray:
+    '''
+    Transform the geometries with the transformer.
+    '''
+    return shapely.transform(geometries, lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1])))
+
+def to_file(path: str, cells: np.ndarray, supply: np.ndarray, demand: np.ndarray, vacancy: np.ndarray) -> None:
+    '''
+    Write the grid as GeoJSON with the fields the viewer reads.
+    '''
+    geometries = [json.loads(x) for x in shapely.to_geojson(project(cells, to_degree))]
+    vacancy_values = vacancy.astype(object)
+    vacancy_values[np.isnan(vacancy)] = None
+    features = []
+    for i, geometry in enumerate(geometries):
+        properties: dict[str, Any] = {'Index': i + 1, '供給': float(supply[i])}
+        properties.update(zip(CATEGORIES, demand[i].tolist()))
+        properties.update(zip(PERIODS, vacancy_values[i].tolist()))
+        features.append({'type': 'Feature', 'properties': properties, 'geometry': geometry})
+    collection = {'type': 'FeatureCollection',
+                  'name': 'grid',
+                  'crs': {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:OGC:1.3:CRS84'}},
+                  'features': features}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(collection, f, ensure_ascii=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the grid of supply, demand and vacancy rates for the viewer.')
+    parser.add_argument(
+        '--poi', '-p',
+        type=str,
+        default=f'{SERVER_DATA}/poi.geojson',
+        help='The POIs by category.'
+    )
+    parser.add_argument(
+        '--lots', '-l',
+        type=str,
+        default=f'{SERVER_DATA}/lot.geojson',
+        help='The loading-zone lots.'
+    )
+    parser.add_argument(
+        '--history', '-H',
+        type=str,
+        default=HISTORY,
+        help='The history.json, history.bin or history-stats.json produced by aggregate.py.'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=f'{SERVER_DATA}/grid.geojson',
+        help='The path to the grid.'
+    )
+    parser.add_argument(
+        '--grid', '-g',
+        type=str,
+        default=None,
+        help='Reuse the cells of an existing grid instead of generating them over the search bound.'
+    )
+    parser.add_argument(
+        '--cache', '-c',
+        type=str,
+        default=CACHE,
+        help='The cache of the spatial join.'
+    )
+    parser.add_argument(
+        '--size',
+        type=float,
+        default=CELL_SIZE,
+        help='The cell size in meters.'
+    )
+    args = parser.parse_args()
+    main(args.poi, args.lots, args.history, args.output, args.grid, args.cache, args.size)
@@ -0,0 +1,200 @@
+import argparse
+import numpy as np
+import os
+import struct
+from typing import Optional, Sequence
+
+# Constants
+DAYS = 7
+HISTORY_BINARY = './data/history.bin'
+HISTORY_MAGIC = b'TPKHIST\x00'
+HISTORY_VERSION = 1
+HEADER = struct.Struct('<8sHHHHIQQQ20x')
+'''
+The 64-byte header: the magic, the version, the days, the slots per day, the bits per slot, the number of lots,
+the offset and size of the id table, and the offset of the state array.
+'''
+ALIGNMENT = 64
+BITS = 2
+SLOTS = 144
+ROW_BYTES = (DAYS * SLOTS * BITS + 7) // 8
+NULL, FREE, OCCUPIED = 0, 1, 2
+'''
+The 2-bit codes of the states. A zero-filled row has no data.
+'''
+
+# Classes
+class HistoryFormatError(ValueError):
+    '''
+    Raised when a file is not a binary history.
+    '''
+
+class HistoryFile:
+    '''
+    The binary history opened with `numpy.memmap`. Only the id table is read when it's opened,
+    and the states of a lot are read from its own row on demand.
+
+    The file is a 64-byte header, an id table (the `uint32` end offset of each id, then the UTF-8 ids),
+    and a lots × `ROW_BYTES` array packing 7 × 144 2-bit states per lot, four to a byte with the first slot
+    in the lowest bits. The state array starts at a multiple of 64 bytes.
+    '''
+
+    path: str
+    '''
+    The path to the file.
+    '''
+
+    ids: list[str]
+    '''
+    The id of the lot in each row.
+    '''
+
+    index: dict[str, int]
+    '''
+    The dictionary of lot id to row.
+    '''
+
+    states: np.ndarray
+    '''
+    The packed states, memory-mapped.
+    '''
+
+    def __init__(self: 'HistoryFile', path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if (len(header) < HEADER.size):
+                raise HistoryFormatError(f'`{path}` is not a binary history.')
+            magic, version, days, slots, bits, count, ids_offset, ids_size, states_offset = HEADER.unpack(header)
+            if (magic != HISTORY_MAGIC):
+                raise HistoryFormatError(f'`{path}` is not a binary history.')
+            if (version != HISTORY_VERSION) or ((days, slots, bits) != (DAYS, SLOTS, BITS)):
+                raise HistoryFormatError(f'`{path}` is a binary history of an unsupported version or shape.')
+            f.seek(ids_offset)
+            table = f.read(ids_size)
+        ends = np.frombuffer(table, dtype='<u4', count=count).tolist()
+        blob = table[4 * count:]
+        self.ids = [blob[a:b].decode('utf-8') for a, b in zip([0] + ends[:-1], ends)]
+        self.index = {id: row for row, id in enumerate(self.ids)}
+        if (count > 0):
+            self.states = np.memmap(path, dtype=np.uint8, mode='r', offset=states_offset, shape=(count, ROW_BYTES))
+        else:
+            self.states = np.zeros((0, ROW_BYTES), dtype=np.uint8)
+
+    def get(self: 'HistoryFile', id: str) -> Optional[np.ndarray]:
+        '''
+        Get the 7 × 144 states of a lot, with `1` occupied, `0` vacant and `-1` no data, or `None` if the lot is unknown.
+        '''
+        row = self.index.get(id)
+        return None if row is None else unpack_states(self.states[row:row + 1])[0]
+
+    def get_rows(self: 'HistoryFile', rows: Sequence[int] | np.ndarray) -> np.ndarray:
+        '''
+        Get the states of the rows as a rows × 7 × 144 cube, reading only those rows.
+        '''
+        return unpack_states(self.states[np.asarray(rows, dtype=np.int64)])
+
+    def to_cube(self: 'HistoryFile') -> np.ndarray:
+        return unpack_states(self.states)
+
+    def __len__(self: 'HistoryFile') -> int:
+        return len(self.ids)
+
+# Methods
+def is_history_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(HISTORY_MAGIC)) == HISTORY_MAGIC
+
+def pack_states(cube: np.ndarray) -> np.ndarray:
+    '''
+    Pack a lots × 7 × 144 cube of `1` occupied, `0` vacant and negative no data into lots × `ROW_BYTES` bytes.
+    '''
+    codes = np.where(cube < 0, NULL, np.where(cube > 0, OCCUPIED, FREE)).astype(np.uint8).reshape(len(cube), DAYS * SLOTS)
+    codes = np.pad(codes, ((0, 0), (0, ROW_BYTES * 4 - codes.shape[1]))).reshape(len(cube), ROW_BYTES, 4)
+    return codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) | (codes[:, :, 3] << 6)
+
+def to_json(path: str, output: Optional[str] = None) -> str:
+    '''
+    Export a binary history to the `history.json` format written by `aggregate.py`.
+
+    Returns
+    -------
+    output: str
+        The path to the JSON file.
+    '''
+    from aggregate import LotsHistory
+    output = output or os.path.splitext(path)[0] + '.json'
+    LotsHistory.load_file(path).to_file(output)
+    return output
+
+def from_json(path: str, output: Optional[str] = None) -> str:
+    '''
+    Convert a `history.json` written by `aggregate.py` to the binary history.
+
+    Returns
+    -------
+    output: str
+        The path to the binary file.
+    '''
+    from aggregate import LotsHistory
+    output = output or os.path.splitext(path)[0] + '.bin'
+    LotsHistory.load_file(path).to_file(output)
+    return output
+
+def unpack_states(packed: np.ndarray) -> np.ndarray:
+    '''
+    Unpack rows of `ROW_BYTES` bytes into a rows × 7 × 144 int8 cube, with `-1` for no data.
+    '''
+    codes = (np.asarray(packed)[:, :, None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+    codes = codes.reshape(len(packed), ROW_BYTES * 4)[:, :DAYS * SLOTS].astype(np.int8)
+    return (codes - 1).reshape(len(packed), DAYS, SLOTS)
+
+def write_history(path: str, ids: Sequence[str], cube: np.ndarray) -> None:
+    '''
+    Write the binary history atomically, so a reader never maps a half-written file.
+
+    Parameter
+    -------
+    ids: Sequence[str]
+        The id of each lot.
+
+    cube: np.ndarray
+        The lots × 7 × 144 states, with `1` occupied, `0` vacant and negative values for no data.
+    '''
+    encoded = [id.encode('utf-8') for id in ids]
+    ends = np.cumsum([len(x) for x in encoded], dtype=np.int64).astype('<u4')
+    table = ends.tobytes() + b''.join(encoded)
+    ids_offset = HEADER.size
+    states_offset = -(-(ids_offset + len(table)) // ALIGNMENT) * ALIGNMENT
+    header = HEADER.pack(HISTORY_MAGIC, HISTORY_VERSION, DAYS, SLOTS, BITS, len(encoded), ids_offset, len(table), states_offset)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(header)
+        f.write(table)
+        f.write(b'\x00' * (states_offset - ids_offset - len(table)))
+        f.write(pack_states(np.asarray(cube)[:len(encoded)]).tobytes())
+    os.replace(f'{path}.tmp', path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the occupancy history between history.json and the binary format.')
+    parser.add_argument(
+        'direction',
+        choices=['to-json', 'from-json'],
+        help='`to-json` exports binary histories to history.json, and `from-json` the other way round.'
+    )
+    parser.add_argument(
+        'paths',
+        nargs='+',
+        help='The histories to convert.'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=None,
+        help='The output path. Only valid with a single input.'
+    )
+    args = parser.parse_args()
+    if (args.output is not None) and (len(args.paths) > 1):
+        parser.error('--output only works with a single input.')
+    for path in args.paths:
+        converted = to_json(path, args.output) if args.direction == 'to-json' else from_json(path, args.output)
+        print(f'{path} -> {converted}')
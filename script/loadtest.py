@@ -0,0 +1,221 @@
+import argparse
+import crawler
+from crawler import CrawlerMetrics, GeometryCache, SessionPool, TokenBucket, get_parking_status_around_taipei, get_probe_coords
+from datetime import datetime
+import json
+import logging
+import numpy as np
+import os
+import requests
+import socket
+import subprocess
+import sys
+from time import perf_counter, sleep
+import tracemalloc
+from typing import Any, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Constants
+LOG_DIR = './script/log'
+OUTPUT = './data/loadtest.json'
+STARTUP_TIMEOUT = 30
+
+# Methods
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def get_peak_rss() -> Optional[float]:
+    '''
+    Get the peak resident memory of this process in MiB, where the platform reports it.
+    '''
+    if (resource is None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def get_stats(base: str, reset: bool = True) -> dict[str, Any]:
+    '''
+    Get the counters of the stand-in API, resetting them by default so the next run starts from zero.
+    '''
+    return requests.get(f'{base}/_stats', params={'reset': '1'} if reset else None, timeout=10).json()
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'loadtest.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def log_crawler(msg: Any, group: int = 0, level: int = logging.INFO) -> None:
+    '''
+    Keep the crawler's own messages in `loadtest_crawler.txt`, away from the logs of the real crawls.
+    '''
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with open(os.path.join(LOG_DIR, 'loadtest_crawler.txt'), 'a', encoding='utf-8') as f:
+        f.write(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg) + '\n')
+
+def main(base: Optional[str], concurrencies: list[int], group: int = 0, sweeps: int = 2, spacing: float = 0, trace: bool = False,
+         output: Optional[str] = OUTPUT, server_args: Optional[list[str]] = None) -> None:
+    process = None
+    if (base is None):
+        port = get_free_port()
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'replay.py'), '--port', str(port), *(server_args or [])],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base = f'http://127.0.0.1:{port}'
+        wait_ready(base, process)
+    log(f'Load testing the stand-in API at {base} ({" ".join(server_args or []) or "default settings"}).')
+
+    crawler.BASEURL = f'{base}/'
+    crawler.URL = f'{base}/w1/GetParks/{{long}}/{{lat}}/car/5'
+    crawler.log = log_crawler
+    coords = get_probe_coords(group)
+    results: list[dict[str, Any]] = []
+    try:
+        for concurrency in concurrencies:
+            crawler.geometry_cache = GeometryCache()
+            crawler.limiter = TokenBucket(1 / spacing) if spacing > 0 else TokenBucket(1e9, 1e9)
+            crawler.session_pool = SessionPool(concurrency, path=None)
+            for sweep in range(1, sweeps + 1):
+                result = run(base, crawler.session_pool, concurrency, group, len(coords), trace)
+                result['sweep'] = sweep
+                results.append(result)
+                log(f'c={concurrency:<3} sweep {sweep}: {result["probes_per_second"]:7.1f} probes/s, {result["sweep_seconds"]:6.2f} s for {result["probes"]} probes, '
+                    f'p50/p95 {result["probe_p50_seconds"]}/{result["probe_p95_seconds"]} s, handshake {result["handshake_seconds"]:.2f} s, {result["refreshes"]} token refreshes, {result["lots"]} lots, {result["recovered"]} recovered/{result["abandoned"]} abandoned probes, {result["retries"]} retries, status {result["status"]}'
+                    + (f', peak {result["traced_mib"]} MiB traced' if trace else '')
+                    + (f', {result["rss_mib"]} MiB RSS' if result['rss_mib'] is not None else '') + '.')
+            crawler.session_pool.session.close()
+    finally:
+        if (process is not None):
+            process.terminate()
+            process.wait()
+
+    if (output is not None):
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({'created': datetime.now().isoformat(), 'base': base, 'group': group, 'spacing': spacing, 'server': server_args or [], 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        log(f'The results were saved to `{output}`.')
+
+def run(base: str, pool: SessionPool, concurrency: int, group: int, probe_count: int, trace: bool = False) -> dict[str, Any]:
+    '''
+    Make sure the pool has a token, then run one sweep against the stand-in API, and measure them.
+    Only the first sweep of a pool pays for the handshake, unless the token expires.
+
+    Returns
+    -------
+    result: dict[str, Any]
+        The timings, the counters of the stand-in API, and the memory of the sweep.
+    '''
+    get_stats(base)
+    start = perf_counter()
+    connected = pool.ensure(group)
+    handshake_seconds = perf_counter() - start
+    handshake_stats = get_stats(base)
+
+    crawler.metrics = CrawlerMetrics()
+    if (trace):
+        tracemalloc.start()
+    start = perf_counter()
+    lots = get_parking_status_around_taipei(pool.session, group, verbose=False, concurrency=concurrency) if connected else None
+    elapsed = perf_counter() - start
+    traced = tracemalloc.get_traced_memory()[1] if trace else None
+    if (trace):
+        tracemalloc.stop()
+    stats = get_stats(base)
+    latencies = [r['seconds'] for r in crawler.metrics.records if r['type'] == 'probe']
+
+    return {'concurrency': concurrency,
+            'handshake': connected,
+            'handshake_seconds': round(handshake_seconds, 4),
+            'handshake_requests': handshake_stats['homepages'] + handshake_stats['requests'],
+            'probes': probe_count,
+            'sweep_seconds': round(elapsed, 4),
+            'probes_per_second': round(probe_count / elapsed, 2) if elapsed > 0 else 0,
+            'probe_p50_seconds': round(float(np.percentile(latencies, 50)), 4) if latencies else None,
+            'probe_p95_seconds': round(float(np.percentile(latencies, 95)), 4) if latencies else None,
+            'lots': 0 if lots is None else len(lots.lots),
+            'succeeded': 0 if lots is None else lots.stats.succeeded,
+            'recovered': 0 if lots is None else lots.stats.recovered,
+            'abandoned': probe_count if lots is None else lots.stats.abandoned,
+            'requests': stats['requests'],
+            'retries': stats['requests'] - stats['probes'],
+            'status': stats['status'],
+            'resets': stats['resets'],
+            'rejected': stats['rejected'],
+            'refreshes': stats['homepages'],
+            'peak_in_flight': stats['peak_in_flight'],
+            'bytes': stats['bytes'],
+            'traced_mib': None if traced is None else round(traced / 1024 / 1024, 1),
+            'rss_mib': get_peak_rss()}
+
+def wait_ready(base: str, process: subprocess.Popen) -> None:
+    '''
+    Wait until the stand-in API answers, or fail if it exits or takes longer than `STARTUP_TIMEOUT` seconds.
+    '''
+    start = perf_counter()
+    while (perf_counter() - start < STARTUP_TIMEOUT):
+        if (process.poll() is not None):
+            raise RuntimeError(f'The stand-in API exited with code {process.returncode}.')
+        try:
+            get_stats(base)
+            return
+        except requests.ConnectionError:
+            sleep(0.2)
+    process.terminate()
+    raise TimeoutError(f'The stand-in API did not start within {STARTUP_TIMEOUT} seconds.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the crawler against a local stand-in of the iTaipeiParking API.',
+                                     epilog='Any other arguments, e.g. `--latency 0.3 --error-rate 0.02 --token-ttl 300`, are passed to replay.py.')
+    parser.add_argument(
+        '--url', '-u',
+        type=str,
+        default=None,
+        help='The base URL of a running replay.py. A new one is started on a free port if omitted.'
+    )
+    parser.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4, 8, 16],
+        help='The concurrency levels to measure.'
+    )
+    parser.add_argument(
+        '--group', '-g',
+        type=int,
+        default=0,
+        help='The probe group to sweep, as in crawler.py.'
+    )
+    parser.add_argument(
+        '--sweeps', '-n',
+        type=int,
+        default=2,
+        help='The number of sweeps per concurrency level. The first one starts with an empty geometry cache.'
+    )
+    parser.add_argument(
+        '--spacing', '-s',
+        type=float,
+        default=0,
+        help='The seconds between request starts. Leave it 0 for no floor, or use 0.5 as in production.'
+    )
+    parser.add_argument(
+        '--trace-memory', '-m',
+        action='store_true',
+        help='Trace the peak Python allocations of each sweep. This slows the sweep down.'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=OUTPUT,
+        help='The path to the results.'
+    )
+    args, server_args = parser.parse_known_args()
+    main(args.url, args.concurrency, args.group, args.sweeps, args.spacing, args.trace_memory, args.output, server_args)
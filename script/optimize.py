@@ -0,0 +1,180 @@
+import argparse
+from crawler import search_geometry
+from datetime import datetime
+from grid import CATEGORIES, RADIUS, project, to_degree, to_metric
+import heapq
+import json
+import numpy as np
+import os
+from publish import SERVER_DATA
+import shapely
+from typing import Any
+from whatif import HOURS, SupplyModel
+
+# Constants
+LOG_DIR = './script/log'
+OUTPUT = './data/optimize.json'
+STEP = 50
+WEIGHTS = {'m': {'批發': 1.0, '郵政': 0.8, '零售': 0.5, '餐飲': 0.9},
+           'a': {'批發': 0.6, '郵政': 1.0, '零售': 1.0, '餐飲': 1.0},
+           'e': {'批發': 0.3, '郵政': 0.7, '零售': 0.6, '餐飲': 0.8}}
+'''
+The default demand weights of each category in the morning, afternoon and evening, as in the viewer.
+'''
+
+# Methods
+def get_candidates(path: str | None = None, step: float = STEP) -> np.ndarray:
+    '''
+    Get the candidate points in EPSG:3826: every vertex of the geometries in a GeoJSON file (e.g. road segments),
+    or a lattice of `step` meters inside `SEARCH_BOUND`.
+    '''
+    if (path is not None):
+        with open(path, 'r', encoding='utf-8') as f:
+            features = [x for x in json.load(f)['features'] if x.get('geometry') is not None]
+        coords = shapely.get_coordinates(shapely.from_geojson([json.dumps(x['geometry']) for x in features]))
+        return project(shapely.points(np.unique(coords, axis=0)), to_metric)
+
+    bound = project(np.array([search_geometry]), to_metric)[0]
+    minx, miny, maxx, maxy = bound.bounds
+    xs, ys = np.meshgrid(np.arange(minx, maxx, step), np.arange(miny, maxy, step))
+    inside = shapely.contains_xy(bound, xs.ravel(), ys.ravel())
+    return shapely.points(xs.ravel()[inside], ys.ravel()[inside])
+
+def get_deficits(collection: dict[str, Any], period: str = 'm', supply_weight: float = 1) -> np.ndarray:
+    '''
+    Get how much the weighted demand of each cell exceeds its weighted supply, as the viewer computes them.
+    '''
+    demand = np.array([sum((f['properties'].get(c) or 0) * WEIGHTS[period][c] for c in CATEGORIES) for f in collection['features']])
+    supply = np.array([f['properties'].get('供給') or 0 for f in collection['features']]) * supply_weight
+    return np.maximum(demand - supply, 0)
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'optimize.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def main(grid: str, output: str, count: int, candidates_path: str | None = None, step: float = STEP, period: str = 'm', supply_weight: float = 1, radius: float = RADIUS) -> None:
+    with open(grid, 'r', encoding='utf-8') as f:
+        collection = json.load(f)
+    model = SupplyModel.from_collection(collection, radius)
+    deficits = get_deficits(collection, period, supply_weight)
+    before = float(deficits.sum())
+    candidates = get_candidates(candidates_path, step)
+    log(f'Scoring {len(candidates)} candidates over {len(model.cells)} cells with a total gap of {before:.1f}.')
+
+    lots, cells, fractions = model.get_overlaps(candidates)
+    chosen, gains = select(lots, cells, fractions * HOURS * supply_weight, deficits, len(candidates), count)
+    coords = shapely.get_coordinates(project(candidates[chosen], to_degree)) if len(chosen) > 0 else np.zeros((0, 2))
+    bounds = np.searchsorted(lots, np.arange(len(candidates) + 1))
+    result = {'created': datetime.now().isoformat(),
+              'period': period,
+              'supply_weight': supply_weight,
+              'gap': {'before': round(before, 4), 'after': round(float(deficits.sum()), 4)},
+              'lots': [{'lng': round(x, 6),
+                        'lat': round(y, 6),
+                        'gain': round(float(g), 4),
+                        'cells': model.indices[cells[bounds[j]:bounds[j + 1]]].tolist()} for j, (x, y), g in zip(chosen.tolist(), coords.tolist(), gains)]}
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    log(f'Selected {len(chosen)} lots, reducing the gap from {result["gap"]["before"]} to {result["gap"]["after"]}. The result was saved to `{output}`.')
+
+def select(lots: np.ndarray, cells: np.ndarray, supply: np.ndarray, deficits: np.ndarray, candidate_count: int, count: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Greedily pick the candidates that close the most of the remaining gap. A pick only shrinks the deficits,
+    so gains never grow, and stale heap entries are re-scored lazily from the candidate's own cells.
+
+    Parameter
+    -------
+    lots: np.ndarray
+        The candidate of each overlap, in ascending order.
+
+    cells: np.ndarray
+        The cell of each overlap.
+
+    supply: np.ndarray
+        The supply the candidate adds to the cell.
+
+    deficits: np.ndarray
+        The gap of each cell, which is updated in place.
+
+    Returns
+    -------
+    chosen: np.ndarray
+        The indices of the chosen candidates, best first.
+
+    gains: np.ndarray
+        The gap each pick closed.
+    '''
+    bounds = np.searchsorted(lots, np.arange(candidate_count + 1))
+    initial = np.bincount(lots, weights=np.minimum(deficits[cells], supply), minlength=candidate_count)
+    heap = [(-g, j) for j, g in enumerate(initial.tolist()) if g > 0]
+    heapq.heapify(heap)
+    chosen: list[int] = []
+    gains: list[float] = []
+    while (heap) and (len(chosen) < count):
+        _, j = heapq.heappop(heap)
+        span = slice(bounds[j], bounds[j + 1])
+        closed = np.minimum(deficits[cells[span]], supply[span])
+        gain = float(closed.sum())
+        if (gain <= 0):
+            continue
+        if (heap) and (gain < -heap[0][0]):
+            heapq.heappush(heap, (-gain, j))
+            continue
+        deficits[cells[span]] -= closed
+        chosen.append(j)
+        gains.append(gain)
+    return np.array(chosen, dtype=np.int64), np.array(gains)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rank candidate locations for new loading lots by how much of the demand–supply gap they close.')
+    parser.add_argument(
+        '--count', '-k',
+        type=int,
+        default=20,
+        help='The number of lots to place.'
+    )
+    parser.add_argument(
+        '--candidates', '-c',
+        type=str,
+        default=None,
+        help='A GeoJSON file whose vertices are the candidates, e.g. road segments. Defaults to a lattice inside the search bound.'
+    )
+    parser.add_argument(
+        '--step',
+        type=float,
+        default=STEP,
+        help='The spacing of the candidate lattice in meters.'
+    )
+    parser.add_argument(
+        '--period', '-t',
+        type=str,
+        choices=list(WEIGHTS),
+        default='m',
+        help='The period whose demand weights to use: morning (m), afternoon (a) or evening (e).'
+    )
+    parser.add_argument(
+        '--supply-weight', '-s',
+        type=float,
+        default=1,
+        help='The vehicles each lot serves per hour.'
+    )
+    parser.add_argument(
+        '--grid', '-g',
+        type=str,
+        default=f'{SERVER_DATA}/grid.geojson',
+        help='The grid.'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=OUTPUT,
+        help='The path to the result.'
+    )
+    args = parser.parse_args()
+    main(args.grid, args.output, args.count, args.candidates, args.step, args.period, args.supply_weight)
@@ -0,0 +1,249 @@
+import argparse
+from crawler import CATALOG, PROBE_PLAN, XSTEP, YSTEP, search_geometry
+from datetime import datetime
+import heapq
+import json
+import numpy as np
+import os
+import shapely
+from typing import Any
+
+# Constants
+LIMIT = 0
+LOG_DIR = './script/log'
+METER_PER_DEGREE = 111320
+RADIUS = 300
+
+# Methods
+def get_candidates(lots: np.ndarray, step: float) -> np.ndarray:
+    '''
+    Get the candidate probe points: a lattice inside `SEARCH_BOUND` plus every lot itself.
+
+    Parameter
+    -------
+    lots: np.ndarray
+        The (n, 2) array of lot coordinates.
+
+    step: float
+        The lattice spacing as a fraction of `XSTEP`/`YSTEP`.
+
+    Returns
+    -------
+    candidates: np.ndarray
+        The (m, 2) array of candidate coordinates.
+    '''
+    minx, miny, maxx, maxy = search_geometry.bounds
+    xs, ys = np.meshgrid(np.arange(minx, maxx + XSTEP * step, XSTEP * step),
+                         np.arange(miny, maxy + YSTEP * step, YSTEP * step))
+    lattice = np.column_stack([xs.ravel(), ys.ravel()])
+    lattice = lattice[shapely.contains_xy(search_geometry, lattice[:, 0], lattice[:, 1])]
+    return np.vstack([lattice, lots])
+
+def get_coverage(lots: np.ndarray, candidates: np.ndarray, radius: float, limit: int) -> list[np.ndarray]:
+    '''
+    Get the lots each candidate reaches, using one bulk STRtree query.
+
+    Parameter
+    -------
+    lots: np.ndarray
+        The (n, 2) array of lot coordinates.
+
+    candidates: np.ndarray
+        The (m, 2) array of candidate coordinates.
+
+    radius: float
+        The search radius of the API in meters.
+
+    limit: int
+        The maximum number of lots the API returns per probe. `0` means unlimited.
+
+    Returns
+    -------
+    coverage: list[np.ndarray]
+        The indices of the lots reached by each candidate.
+    '''
+    lot_points = shapely.points(project(lots))
+    candidate_points = shapely.points(project(candidates))
+    tree = shapely.STRtree(lot_points)
+    cand_idx, lot_idx = tree.query(candidate_points, predicate='dwithin', distance=radius)
+
+    if (limit > 0) and (len(cand_idx) > 0):
+        # Keep only the nearest `limit` lots of each candidate, as the API would.
+        distance = shapely.distance(candidate_points[cand_idx], lot_points[lot_idx])
+        order = np.lexsort((distance, cand_idx))
+        cand_idx, lot_idx = cand_idx[order], lot_idx[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(cand_idx)) + 1]
+        rank = np.arange(len(cand_idx)) - np.repeat(starts, np.diff(np.r_[starts, len(cand_idx)]))
+        cand_idx, lot_idx = cand_idx[rank < limit], lot_idx[rank < limit]
+    else:
+        order = np.argsort(cand_idx, kind='stable')
+        cand_idx, lot_idx = cand_idx[order], lot_idx[order]
+
+    bounds = np.searchsorted(cand_idx, np.arange(len(candidates) + 1))
+    return [lot_idx[bounds[i]:bounds[i + 1]] for i in range(len(candidates))]
+
+def get_hilbert_order(coords: np.ndarray, order: int = 16) -> np.ndarray:
+    '''
+    Get the indices that sort the coordinates along a Hilbert curve, so neighbouring probes stay together.
+    '''
+    if (len(coords) == 0):
+        return np.zeros(0, dtype=np.int64)
+    side = (1 << order) - 1
+    span = np.maximum(coords.max(axis=0) - coords.min(axis=0), 1e-12)
+    cells = ((coords - coords.min(axis=0)) / span * side).astype(np.int64)
+    x, y = cells[:, 0].copy(), cells[:, 1].copy()
+    d = np.zeros(len(coords), dtype=np.int64)
+    s = 1 << (order - 1)
+    while (s > 0):
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant.
+        flip = ~ry & rx
+        x = np.where(flip, side - x, x)
+        y = np.where(flip, side - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return np.argsort(d, kind='stable')
+
+def load_lots(path: str) -> tuple[list[str], np.ndarray]:
+    '''
+    Load the lot catalog and get the centroid of every lot.
+
+    Returns
+    -------
+    ids: list[str]
+        The id of every lot.
+
+    coords: np.ndarray
+        The (n, 2) array of lot centroids.
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        catalog = json.load(f)
+    ids: list[str] = []
+    geometries = []
+    for feature in catalog.get('features', []):
+        lot_id = (feature.get('properties') or {}).get('id')
+        if (lot_id is None) or (feature.get('geometry') is None):
+            continue
+        ids.append(str(lot_id))
+        geometries.append(json.dumps(feature['geometry']))
+    centroids = shapely.centroid(shapely.from_geojson(geometries))
+    return ids, shapely.get_coordinates(centroids)
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'planner.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def main(catalog: str = CATALOG, output: str = PROBE_PLAN, groups: int = 4, radius: float = RADIUS, limit: int = LIMIT, step: float = 0.25) -> None:
+    ids, lots = load_lots(catalog)
+    log(f'Loaded {len(ids)} parking lots from `{catalog}`.')
+    candidates = get_candidates(lots, step)
+    coverage = get_coverage(lots, candidates, radius, limit)
+    log(f'Computed the coverage of {len(candidates)} candidate probes.')
+
+    chosen, uncovered = solve_set_cover(coverage, len(lots))
+    probes = candidates[chosen]
+    log(f'Selected {len(probes)} probes covering {len(lots) - len(uncovered)}/{len(lots)} parking lots.')
+    if (len(uncovered) > 0):
+        log(f'Unreachable parking lots: {", ".join(ids[i] for i in uncovered[:20])}{"..." if len(uncovered) > 20 else ""}')
+
+    shards = split_shards(probes, groups)
+    plan = {'created': datetime.now().isoformat(),
+            'radius': radius,
+            'limit': limit,
+            'lots': len(lots),
+            'groups': [[[round(x, 6), round(y, 6)] for x, y in shard.tolist()] for shard in shards]}
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False)
+    log(f'The probe plan ({" / ".join(str(len(shard)) for shard in shards)} probes) was saved to `{output}`.')
+
+def project(coords: np.ndarray) -> np.ndarray:
+    '''
+    Project (longitude, latitude) pairs to meters with a local equirectangular approximation around Taipei.
+    '''
+    lat0 = np.radians(search_geometry.centroid.y)
+    return np.column_stack([coords[:, 0] * METER_PER_DEGREE * np.cos(lat0), coords[:, 1] * METER_PER_DEGREE])
+
+def solve_set_cover(coverage: list[np.ndarray], lot_count: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Greedily pick the candidate reaching the most uncovered lots until every reachable lot is covered.
+    Gains only shrink as lots get covered, so stale heap entries are re-scored lazily.
+
+    Returns
+    -------
+    chosen: np.ndarray
+        The indices of the chosen candidates.
+
+    uncovered: np.ndarray
+        The indices of the lots no candidate reaches.
+    '''
+    covered = np.zeros(lot_count, dtype=bool)
+    heap = [(-len(lots), i) for i, lots in enumerate(coverage) if len(lots) > 0]
+    heapq.heapify(heap)
+    chosen: list[int] = []
+    while (heap) and (not covered.all()):
+        _, i = heapq.heappop(heap)
+        gain = int(np.count_nonzero(~covered[coverage[i]]))
+        if (gain == 0):
+            continue
+        if (heap) and (gain < -heap[0][0]):
+            heapq.heappush(heap, (-gain, i))
+            continue
+        chosen.append(i)
+        covered[coverage[i]] = True
+    return np.array(chosen, dtype=np.int64), np.flatnonzero(~covered)
+
+def split_shards(probes: np.ndarray, groups: int) -> list[np.ndarray]:
+    '''
+    Split the probes into spatially compact shards of (almost) equal size.
+    '''
+    return np.array_split(probes[get_hilbert_order(probes)], max(1, groups))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan the fewest probe points that reach every known parking lot.')
+    parser.add_argument(
+        '--catalog', '-l',
+        type=str,
+        default=CATALOG,
+        help='The lot catalog produced by extract.py.'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=PROBE_PLAN,
+        help='The path to the probe plan.'
+    )
+    parser.add_argument(
+        '--groups', '-g',
+        type=int,
+        default=4,
+        help='The number of shards to split the probes into.'
+    )
+    parser.add_argument(
+        '--radius',
+        type=float,
+        default=RADIUS,
+        help='The search radius of the API in meters.'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=LIMIT,
+        help='The maximum number of lots the API returns per probe. Leave it 0 for unlimited.'
+    )
+    parser.add_argument(
+        '--step',
+        type=float,
+        default=0.25,
+        help='The spacing of the candidate lattice, as a fraction of the crawler\'s lattice spacing.'
+    )
+    args = parser.parse_args()
+    main(args.catalog, args.output, args.groups, args.radius, args.limit, args.step)
@@ -0,0 +1,224 @@
+import argparse
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import os
+from typing import Any
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Constants
+DIST_DIR = 'dist'
+FEATURES = ('grid', 'lot', 'poi')
+LOG_DIR = './script/log'
+MANIFEST = 'manifest.json'
+PRECISION = 6
+SERVER_DATA = './server/htdocs/parking/data'
+TYPES = {'geojson': 'application/geo+json', 'topojson': 'application/json'}
+
+# Methods
+def compress(path: str, data: bytes) -> dict[str, dict[str, Any]]:
+    '''
+    Write the precompressed `.gz` and, if Brotli is installed, `.br` siblings of the file.
+
+    Returns
+    -------
+    encodings: dict[str, dict[str, Any]]
+        The file name and size of each content encoding.
+    '''
+    encodings: dict[str, dict[str, Any]] = {}
+    variants = [('gzip', '.gz', lambda x: gzip.compress(x, compresslevel=9, mtime=0))]
+    if (brotli is not None):
+        variants.insert(0, ('br', '.br', lambda x: brotli.compress(x, quality=11)))
+    for encoding, suffix, function in variants:
+        compressed = function(data)
+        write_file(path + suffix, compressed)
+        encodings[encoding] = {'file': os.path.basename(path) + suffix, 'size': len(compressed)}
+    return encodings
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'publish.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def main(source: str = SERVER_DATA, features: tuple[str, ...] = FEATURES, precision: int = PRECISION, topojson: bool = False) -> None:
+    output = os.path.join(source, DIST_DIR)
+    manifest: dict[str, Any] = {'created': datetime.now().isoformat(), 'precision': precision, 'features': {}}
+    for feature in features:
+        path = os.path.join(source, f'{feature}.geojson')
+        # Stat the source before reading it, so a rewrite during publishing shows up as a mismatch.
+        stat = os.stat(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            collection = json.load(f)
+        formats = {'geojson': quantize(collection, precision)}
+        if (topojson) and (feature == 'grid'):
+            formats['topojson'] = to_topojson(collection, feature, precision)
+
+        manifest['features'][feature] = {}
+        for format, content in formats.items():
+            data = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            target = os.path.join(output, f'{feature}.{format}')
+            write_file(target, data)
+            manifest['features'][feature][format] = {'file': os.path.basename(target),
+                                                     'type': TYPES[format],
+                                                     'hash': hashlib.sha256(data).hexdigest(),
+                                                     'size': len(data),
+                                                     'encodings': compress(target, data),
+                                                     'source': {'size': stat.st_size, 'mtime': int(stat.st_mtime)}}
+            sizes = ' / '.join(f'{k} {v["size"]:,}' for k, v in manifest['features'][feature][format]['encodings'].items())
+            log(f'Published `{target}`: {os.path.getsize(path):,} → {len(data):,} bytes ({sizes}).')
+
+    if (brotli is None):
+        log('Brotli is not installed, so no `.br` files were written.')
+    write_file(os.path.join(output, MANIFEST), json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+    log(f'The manifest was saved to `{os.path.join(output, MANIFEST)}`.')
+
+def quantize(obj: Any, precision: int = PRECISION) -> Any:
+    '''
+    Round every coordinate of the GeoJSON object to `precision` decimals (1e-6° is about 0.1 m).
+    '''
+    if (isinstance(obj, dict)):
+        return {k: (quantize_coordinates(v, precision) if k in ('coordinates', 'bbox') else quantize(v, precision)) for k, v in obj.items()}
+    elif (isinstance(obj, list)):
+        return [quantize(x, precision) for x in obj]
+    else:
+        return obj
+
+def quantize_coordinates(coords: Any, precision: int) -> Any:
+    if (isinstance(coords, list)):
+        return [quantize_coordinates(x, precision) for x in coords]
+    elif (isinstance(coords, float)):
+        return round(coords, precision)
+    else:
+        return coords
+
+def to_topojson(collection: dict[str, Any], name: str, precision: int = PRECISION) -> dict[str, Any]:
+    '''
+    Convert a collection of (multi)polygons to a quantized TopoJSON topology. Rings are cut at the points
+    where they meet other rings, so an edge shared by two neighbouring cells is stored once.
+    '''
+    scale = 10 ** -precision
+    features = collection['features']
+    polygons: list[list[list[list[float]]]] = []
+    for feature in features:
+        geometry = feature['geometry']
+        match geometry['type']:
+            case 'Polygon':
+                polygons.append(geometry['coordinates'])
+            case 'MultiPolygon':
+                polygons.extend(geometry['coordinates'])
+            case _:
+                raise ValueError(f'TopoJSON output only supports polygons, not {geometry["type"]}.')
+    x0 = min(x for polygon in polygons for ring in polygon for x, *_ in ring)
+    y0 = min(y for polygon in polygons for ring in polygon for _, y, *_ in ring)
+
+    # Quantize every ring, dropping the repeated points rounding can produce.
+    def to_ring(ring: list[list[float]]) -> list[tuple[int, int]]:
+        points: list[tuple[int, int]] = []
+        for x, y, *_ in ring[:-1]:
+            point = (round((x - x0) / scale), round((y - y0) / scale))
+            if (not points) or (points[-1] != point):
+                points.append(point)
+        if (len(points) > 1) and (points[0] == points[-1]):
+            points.pop()
+        return points
+
+    # A point is a junction where its neighbours differ between rings.
+    rings_by_feature: list[list[list[list[tuple[int, int]]]]] = []
+    neighbours: dict[tuple[int, int], set[tuple[int, int]]] = {}
+    for feature in features:
+        geometry = feature['geometry']
+        parts = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        rings = [[to_ring(ring) for ring in polygon] for polygon in parts]
+        rings_by_feature.append(rings)
+        for polygon in rings:
+            for ring in polygon:
+                for i, point in enumerate(ring):
+                    neighbours.setdefault(point, set()).update((ring[i - 1], ring[(i + 1) % len(ring)]))
+    junctions = {point for point, adjacent in neighbours.items() if len(adjacent) > 2}
+
+    arcs: list[list[tuple[int, int]]] = []
+    arc_index: dict[tuple[tuple[int, int], ...], int] = {}
+
+    def add_arc(points: list[tuple[int, int]]) -> int:
+        key = tuple(points)
+        if (key in arc_index):
+            return arc_index[key]
+        reverse = key[::-1]
+        if (reverse in arc_index):
+            return ~arc_index[reverse]
+        arc_index[key] = len(arcs)
+        arcs.append(points)
+        return arc_index[key]
+
+    def to_arcs(ring: list[tuple[int, int]]) -> list[int]:
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if (not cuts):
+            return [add_arc(ring + ring[:1])]
+        rotated = ring[cuts[0]:] + ring[:cuts[0]]
+        cuts = [i - cuts[0] for i in cuts] + [len(ring)]
+        closed = rotated + rotated[:1]
+        return [add_arc(closed[a:b + 1]) for a, b in zip(cuts, cuts[1:])]
+
+    geometries = []
+    for feature, rings in zip(features, rings_by_feature):
+        arcs_of = [[to_arcs(ring) for ring in polygon] for polygon in rings]
+        geometry: dict[str, Any] = {'type': feature['geometry']['type'],
+                                    'arcs': arcs_of[0] if feature['geometry']['type'] == 'Polygon' else arcs_of,
+                                    'properties': feature.get('properties') or {}}
+        geometries.append(geometry)
+
+    # Delta-encode the arcs.
+    encoded = [[list(arc[0])] + [[b[0] - a[0], b[1] - a[1]] for a, b in zip(arc, arc[1:])] for arc in arcs]
+    return {'type': 'Topology',
+            'transform': {'scale': [scale, scale], 'translate': [x0, y0]},
+            'objects': {name: {'type': 'GeometryCollection', 'geometries': geometries}},
+            'arcs': encoded}
+
+def write_file(path: str, data: bytes) -> None:
+    '''
+    Write the file atomically, so the server never reads a half-written payload.
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp = f'{path}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish minified, quantized and precompressed layers for the viewer.')
+    parser.add_argument(
+        '--source', '-s',
+        type=str,
+        default=SERVER_DATA,
+        help='The directory of the layers. The output goes to its `dist` directory.'
+    )
+    parser.add_argument(
+        '--features', '-f',
+        type=str,
+        nargs='+',
+        choices=FEATURES,
+        default=list(FEATURES),
+        help='The layers to publish.'
+    )
+    parser.add_argument(
+        '--precision', '-p',
+        type=int,
+        default=PRECISION,
+        help='The number of decimals kept in coordinates.'
+    )
+    parser.add_argument(
+        '--topojson', '-t',
+        action='store_true',
+        help='Also publish the grid as TopoJSON.'
+    )
+    args = parser.parse_args()
+    main(args.source, tuple(args.features), args.precision, args.topojson)
@@ -0,0 +1,331 @@
+from aiohttp import web
+import argparse
+import asyncio
+from crawler import CATALOG
+from datetime import datetime
+import json
+import numpy as np
+import os
+from planner import LIMIT, RADIUS, project
+from publish import SERVER_DATA
+import random
+import secrets
+import shapely
+from time import monotonic
+from typing import Any, Optional
+
+# Constants
+LOG_DIR = './script/log'
+LOT_SIZE = 2e-5
+TITLE = '北市好停車'
+TOKEN_NAME = '__RequestVerificationToken'
+
+# Classes
+class ParkingAPI:
+    '''
+    The local stand-in of the iTaipeiParking API. The homepage hands out CSRF tokens, and `/w1/GetParks` answers
+    with the lots of the catalog within `radius` of the probe, in the same JSON as the real API.
+    '''
+
+    ids: list[str]
+    '''
+    The `parkId` of each lot.
+    '''
+
+    records: list[tuple[bytes, bytes]]
+    '''
+    The minified JSON of each lot when vacant and when occupied.
+    '''
+
+    occupied: Optional[np.ndarray]
+    '''
+    The replayed occupancy of each lot, or `None` to draw it on every request with probability `occupancy`.
+    '''
+
+    points: np.ndarray
+    tree: shapely.STRtree
+    '''
+    The centroids of the lots in meters and the index over them.
+    '''
+
+    tokens: dict[str, float]
+    '''
+    The issued tokens and the monotonic time each was issued.
+    '''
+
+    stats: dict[str, Any]
+    '''
+    The counters since the last reset, served at `/_stats`.
+    '''
+
+    def __init__(self: 'ParkingAPI', features: list[dict[str, Any]], radius: float = RADIUS, limit: int = LIMIT,
+                 latency: float = 0, jitter: float = 0, error_rate: float = 0, reset_rate: float = 0,
+                 token_ttl: float = 0, occupancy: float = 0.5, seed: Optional[int] = None) -> None:
+        self.radius = radius
+        self.limit = limit
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.token_ttl = token_ttl
+        self.occupancy = occupancy
+        self.random = random.Random(seed)
+        self.tokens = {}
+
+        self.ids = []
+        self.records = []
+        replayed: list[Optional[bool]] = []
+        shapes = []
+        for i, feature in enumerate(features):
+            properties = feature.get('properties') or {}
+            if (feature.get('geometry') is None):
+                continue
+            shape = shapely.from_geojson(json.dumps(feature['geometry']))
+            if (isinstance(shape, shapely.Point)):
+                # The published lots are points, so they're given a small square like the real lot shapes.
+                shape = shapely.box(shape.x - LOT_SIZE, shape.y - LOT_SIZE, shape.x + LOT_SIZE, shape.y + LOT_SIZE)
+            if (not isinstance(shape, shapely.Polygon)):
+                continue
+
+            if (properties.get('id') is not None) and ('_' in str(properties['id'])):
+                name, park_id = str(properties['id']).rsplit('_', 1)
+            else:
+                name, park_id = str(properties.get('Road') or properties.get('name') or 'Unknown'), str(properties.get('Number') or i)
+            toll = properties.get('toll')
+            record = {'parkId': park_id,
+                      'parkName': name,
+                      'servicetime': properties.get('service') or '週一至週六 08:00~20:00',
+                      'payex': f'{30 if toll is None else int(toll)}元',
+                      'wkt': shapely.to_wkt(shape, rounding_precision=8)}
+            self.ids.append(park_id)
+            self.records.append((dumps({**record, 'remark': '空格'}), dumps({**record, 'remark': '有車'})))
+            replayed.append(properties.get('occupied'))
+            shapes.append(shape)
+
+        self.occupied = np.array(replayed, dtype=bool) if all(x is not None for x in replayed) and replayed else None
+        centroids = shapely.get_coordinates(shapely.centroid(np.array(shapes, dtype=object))) if shapes else np.zeros((0, 2))
+        self.points = project(centroids)
+        self.tree = shapely.STRtree(shapely.points(self.points))
+        self.reset()
+
+    def get_lots(self: 'ParkingAPI', lon: float, lat: float) -> np.ndarray:
+        '''
+        Get the lots within `radius` of the probe, nearest first and at most `limit` of them.
+        '''
+        center = project(np.array([[lon, lat]]))[0]
+        found = self.tree.query(shapely.Point(*center), predicate='dwithin', distance=self.radius)
+        distance = np.hypot(*(self.points[found] - center).T)
+        found = found[np.argsort(distance, kind='stable')]
+        return found[:self.limit] if self.limit > 0 else found
+
+    def check_token(self: 'ParkingAPI', request: web.Request) -> Optional[str]:
+        '''
+        Check the `X-CSRF-TOKEN` header.
+
+        Returns
+        -------
+        error: str | None
+            The reason the token was rejected, or `None` if it's valid.
+        '''
+        token = request.headers.get('X-CSRF-TOKEN')
+        if (token is None):
+            return 'missing'
+        issued = self.tokens.get(token)
+        if (issued is None):
+            return 'invalid'
+        if (self.token_ttl > 0) and (monotonic() - issued > self.token_ttl):
+            return 'expired'
+        return None
+
+    async def delay(self: 'ParkingAPI') -> None:
+        if (self.latency > 0):
+            await asyncio.sleep(self.latency * self.random.lognormvariate(0, self.jitter))
+
+    async def handle_home(self: 'ParkingAPI', request: web.Request) -> web.Response:
+        '''
+        Serve the homepage with a new token in the hidden input, as the real site does.
+        '''
+        await self.delay()
+        token = secrets.token_urlsafe(64)
+        self.tokens[token] = monotonic()
+        self.stats['homepages'] += 1
+        body = (f'<!DOCTYPE html><html lang="zh-Hant"><head><meta charset="utf-8"><title>{TITLE}</title></head><body>'
+                f'<form id="antiforgery"><input name="{TOKEN_NAME}" type="hidden" value="{token}"></form></body></html>')
+        return web.Response(text=body, content_type='text/html', charset='utf-8')
+
+    async def handle_parks(self: 'ParkingAPI', request: web.Request) -> web.StreamResponse:
+        '''
+        Answer a probe, after the configured latency, with the injected errors and the token check.
+        '''
+        stats = self.stats
+        stats['requests'] += 1
+        stats['in_flight'] += 1
+        stats['peak_in_flight'] = max(stats['peak_in_flight'], stats['in_flight'])
+        try:
+            await self.delay()
+            try:
+                lon, lat = float(request.match_info['lon']), float(request.match_info['lat'])
+            except ValueError:
+                return self.count(web.json_response({'error': 'Invalid coordinates.'}, status=400))
+            key = f'{lon:.6f},{lat:.6f}'
+            stats['probes'][key] = stats['probes'].get(key, 0) + 1
+
+            draw = self.random.random()
+            if (draw < self.reset_rate):
+                stats['resets'] += 1
+                assert request.transport is not None
+                request.transport.abort()
+                raise asyncio.CancelledError()
+            elif (draw < self.reset_rate + self.error_rate):
+                return self.count(web.json_response({'error': 'The service is unavailable.'}, status=503))
+
+            rejected = self.check_token(request)
+            if (rejected is not None):
+                stats['rejected'][rejected] = stats['rejected'].get(rejected, 0) + 1
+                return self.count(web.json_response({'error': 'The antiforgery token is not valid.'}, status=400))
+
+            found = self.get_lots(lon, lat)
+            if (self.occupied is not None):
+                states = self.occupied[found]
+            else:
+                states = [self.random.random() < self.occupancy for _ in range(len(found))]
+            body = b'[' + b','.join([self.records[i][int(s)] for i, s in zip(found.tolist(), states)]) + b']'
+            stats['lots'] += len(found)
+            response = web.Response(body=body, content_type='application/json', charset='utf-8')
+            if ('gzip' in request.headers.get('Accept-Encoding', '')):
+                response.enable_compression(web.ContentCoding.gzip)
+            return self.count(response, len(body))
+        finally:
+            stats['in_flight'] -= 1
+
+    async def handle_stats(self: 'ParkingAPI', request: web.Request) -> web.Response:
+        '''
+        Send the counters. `?reset=1` resets them afterwards.
+        '''
+        stats = {**self.stats, 'probes': len(self.stats['probes']), 'repeats': sum(self.stats['probes'].values()) - len(self.stats['probes'])}
+        if (request.query.get('reset') == '1'):
+            self.reset()
+        return web.json_response(stats)
+
+    def count(self: 'ParkingAPI', response: web.Response, size: int = 0) -> web.Response:
+        self.stats['status'][str(response.status)] = self.stats['status'].get(str(response.status), 0) + 1
+        self.stats['bytes'] += size
+        return response
+
+    def reset(self: 'ParkingAPI') -> None:
+        self.stats = {'homepages': 0, 'requests': 0, 'lots': 0, 'bytes': 0, 'resets': 0, 'in_flight': 0, 'peak_in_flight': 0,
+                      'status': {}, 'rejected': {}, 'probes': {}}
+
+    @classmethod
+    def load_file(cls, path: str, **kwargs) -> 'ParkingAPI':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f).get('features', []), **kwargs)
+
+# Methods
+def dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def get_app(api: ParkingAPI) -> web.Application:
+    '''
+    Create the application with the routes the crawler uses, plus `/_stats`.
+    '''
+    app = web.Application()
+    app.router.add_get('/', api.handle_home)
+    app.router.add_get('/w1/GetParks/{lon}/{lat}/car/{radius}', api.handle_parks)
+    app.router.add_get('/_stats', api.handle_stats)
+    return app
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'replay.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def main(catalog: str, host: str, port: int, **kwargs) -> None:
+    if (not os.path.exists(catalog)):
+        log(f'`{catalog}` does not exist, so the published lots are served instead.')
+        catalog = f'{SERVER_DATA}/lot.geojson'
+    api = ParkingAPI.load_file(catalog, **kwargs)
+    log(f'Loaded {len(api.ids)} parking lots from `{catalog}` ({"replayed" if api.occupied is not None else "random"} occupancy).')
+    web.run_app(get_app(api), host=host, port=port, access_log=None, print=lambda x: log(x.strip()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stand-in of the iTaipeiParking API for load tests.')
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='127.0.0.1',
+        help='The host to listen on.'
+    )
+    parser.add_argument(
+        '--port', '-p',
+        type=int,
+        default=8081,
+        help='The port to listen on.'
+    )
+    parser.add_argument(
+        '--catalog', '-l',
+        type=str,
+        default=CATALOG,
+        help='The lots to serve: the catalog produced by extract.py, or a crawler GeoJSON to replay its occupancy.'
+    )
+    parser.add_argument(
+        '--radius',
+        type=float,
+        default=RADIUS,
+        help='The search radius of the API in meters.'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=LIMIT,
+        help='The maximum number of lots returned per probe. Leave it 0 for unlimited.'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.2,
+        help='The median seconds before each response.'
+    )
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=0.5,
+        help='The sigma of the log-normal spread around the median latency. Leave it 0 for a fixed latency.'
+    )
+    parser.add_argument(
+        '--error-rate', '-e',
+        type=float,
+        default=0,
+        help='The share of probes answered with 503.'
+    )
+    parser.add_argument(
+        '--reset-rate',
+        type=float,
+        default=0,
+        help='The share of probes whose connection is dropped without a response.'
+    )
+    parser.add_argument(
+        '--token-ttl', '-t',
+        type=float,
+        default=0,
+        help='The seconds a token stays valid. Leave it 0 to never expire.'
+    )
+    parser.add_argument(
+        '--occupancy',
+        type=float,
+        default=0.5,
+        help='The chance a lot is occupied, if the catalog has no occupancy to replay.'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='The seed of the injected latency, errors and occupancy.'
+    )
+    args = parser.parse_args()
+    main(args.catalog, args.host, args.port, radius=args.radius, limit=args.limit, latency=args.latency, jitter=args.jitter,
+         error_rate=args.error_rate, reset_rate=args.reset_rate, token_ttl=args.token_ttl, occupancy=args.occupancy, seed=args.seed)
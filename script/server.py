@@ -0,0 +1,355 @@
+from aiohttp import web
+import argparse
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import numpy as np
+import os
+from publish import FEATURES, PRECISION, SERVER_DATA, quantize
+import shapely
+import threading
+from typing import Any
+from whatif import SupplyModel
+
+# Constants
+CACHE_SIZE = 64
+FILTER_HEADER = 'X-Feature-Filter'
+'''
+Set to `bbox` on responses filtered to the viewport, so the viewer only refetches on map moves from servers that filter.
+'''
+HTDOCS = './server/htdocs/parking'
+INTERVAL = 2
+LOG_DIR = './script/log'
+MIN_GZIP_SIZE = 1024
+PIXELS = 2
+
+# Classes
+class Layer:
+    '''
+    A layer held in memory: the minified features, a whole-layer response, and an STRtree over the parts
+    of every feature, so a multi-point feature can be clipped to the viewport.
+    '''
+
+    name: str
+    path: str
+    mtime: float
+
+    header: dict[str, Any]
+    '''
+    The members of the feature collection other than `features`.
+    '''
+
+    features: list[dict[str, Any]]
+    '''
+    The features with quantized coordinates.
+    '''
+
+    encoded: list[bytes]
+    '''
+    The minified JSON of each feature.
+    '''
+
+    templates: dict[int, tuple[bytes, bytes]]
+    '''
+    The minified JSON of each multi-part feature before and after its coordinates.
+    '''
+
+    encoded_parts: list[bytes]
+    '''
+    The minified coordinates of each part of the multi-part features.
+    '''
+
+    parts: np.ndarray
+    parents: np.ndarray
+    counts: np.ndarray
+    tree: shapely.STRtree
+    '''
+    The single-part geometries, the feature each belongs to, the number of parts of each feature, and the index over the parts.
+    '''
+
+    body: bytes
+    compressed: bytes
+    etag: str
+    '''
+    The whole layer, gzipped, and its content hash.
+    '''
+
+    cache: OrderedDict[str, tuple[bytes, bytes]]
+    '''
+    The recent query responses and their gzipped bodies by ETag, least recently used first.
+    '''
+
+    def __init__(self: 'Layer', name: str, path: str) -> None:
+        self.name = name
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            collection = quantize(json.load(f), PRECISION)
+        self.features = collection.pop('features')
+        self.header = collection
+        self.encoded = [dumps(x) for x in self.features]
+
+        geometries = shapely.from_geojson([None if x.get('geometry') is None else json.dumps(x['geometry']) for x in self.features])
+        self.parts, self.parents = shapely.get_parts(geometries, return_index=True)
+        self.counts = np.bincount(self.parents, minlength=len(self.features))
+        self.tree = shapely.STRtree(self.parts)
+
+        self.templates = {}
+        self.encoded_parts = [b''] * len(self.parts)
+        for i, feature in enumerate(self.features):
+            geometry = feature.get('geometry')
+            if (geometry is not None) and (geometry['type'].startswith('Multi')):
+                before, after = dumps({**feature, 'geometry': {'type': geometry['type'], 'coordinates': []}}).split(b'"coordinates":[]', 1)
+                self.templates[i] = (before + b'"coordinates":[', b']' + after)
+                first = int(np.searchsorted(self.parents, i))
+                for j, coordinates in enumerate(geometry['coordinates']):
+                    self.encoded_parts[first + j] = dumps(coordinates)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.body = self.join(self.encoded)
+        self.compressed = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()
+
+    def get_response(self: 'Layer', etag: str, parts: np.ndarray) -> tuple[bytes, bytes]:
+        '''
+        Get the body of a query and its gzipped version, from the cache if another viewer asked for it recently.
+        '''
+        with self.lock:
+            cached = self.cache.get(etag)
+            if (cached is not None):
+                self.cache.move_to_end(etag)
+                return cached
+        body = self.to_bytes(parts)
+        cached = (body, gzip.compress(body, compresslevel=5, mtime=0))
+        with self.lock:
+            self.cache[etag] = cached
+            while (len(self.cache) > CACHE_SIZE):
+                self.cache.popitem(last=False)
+        return cached
+
+    def join(self: 'Layer', features: list[bytes]) -> bytes:
+        return dumps(self.header)[:-1] + b',"features":[' + b','.join(features) + b']}'
+
+    def query(self: 'Layer', bbox: tuple[float, float, float, float], zoom: int | None = None) -> tuple[str, np.ndarray]:
+        '''
+        Find the parts inside the bounding box. At a given zoom level, points closer than `PIXELS` screen pixels
+        are thinned to one per feature, since they would be drawn on top of each other anyway.
+
+        Returns
+        -------
+        etag: str
+            The tag of the response, derived from the layer and the parts selected.
+
+        parts: np.ndarray
+            The sorted indices of the parts selected.
+        '''
+        parts = np.sort(self.tree.query(shapely.box(*bbox)))
+        if (zoom is not None) and (len(parts) > 0):
+            points = shapely.get_type_id(self.parts[parts]) == shapely.GeometryType.POINT
+            if (points.any()):
+                size = 360 / (256 * 2 ** zoom) * PIXELS
+                coords = shapely.get_coordinates(self.parts[parts[points]])
+                keys = np.column_stack([self.parents[parts[points]], np.floor(coords / size).astype(np.int64)])
+                _, first = np.unique(keys, axis=0, return_index=True)
+                parts = np.sort(np.concatenate([parts[~points], parts[points][first]]))
+        digest = hashlib.blake2b(self.etag.encode(), digest_size=16)
+        digest.update(parts.astype(np.int64).tobytes())
+        return digest.hexdigest(), parts
+
+    def to_bytes(self: 'Layer', parts: np.ndarray) -> bytes:
+        '''
+        Serialize the features of the parts. A multi-part feature keeps only the parts selected.
+        '''
+        features: list[bytes] = []
+        if (len(parts) == 0):
+            return self.join(features)
+        parents = self.parents[parts]
+        bounds = np.flatnonzero(np.r_[True, np.diff(parents) != 0, True])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            parent = int(parents[start])
+            if (parent not in self.templates) or (end - start == self.counts[parent]):
+                features.append(self.encoded[parent])
+            else:
+                before, after = self.templates[parent]
+                features.append(before + b','.join([self.encoded_parts[i] for i in parts[start:end]]) + after)
+        return self.join(features)
+
+class FeatureServer:
+    '''
+    The asynchronous drop-in for `api/feature.php`, serving the layers from memory.
+    '''
+
+    directory: str
+    layers: dict[str, Layer]
+
+    supply: SupplyModel | None
+    '''
+    The what-if supply model over the grid cells, rebuilt when the grid reloads.
+    '''
+
+    def __init__(self: 'FeatureServer', directory: str = SERVER_DATA) -> None:
+        self.directory = directory
+        self.layers = {}
+        self.supply = None
+        for name in FEATURES:
+            self.load(name)
+
+    def load(self: 'FeatureServer', name: str) -> None:
+        path = os.path.join(self.directory, f'{name}.geojson')
+        if (os.path.exists(path)):
+            layer = Layer(name, path)
+            if (name == 'grid'):
+                self.supply = SupplyModel.from_collection({'features': layer.features})
+            self.layers[name] = layer
+            log(f'Loaded {len(layer.features)} features ({len(layer.parts)} parts) of `{path}`.')
+
+    async def handle(self: 'FeatureServer', request: web.Request) -> web.Response:
+        params = await request.post() if request.method == 'POST' else request.query
+        feature = params.get('feature')
+        if (feature is None):
+            return web.json_response({'error': 'The feature type is not specified.'}, status=400)
+        layer = self.layers.get(str(feature))
+        if (layer is None):
+            return web.json_response({'error': 'Invalid feature type.'}, status=400)
+
+        if (params.get('bbox') is None):
+            return respond(request, layer.etag, layer.body, layer.compressed)
+        try:
+            bbox = tuple(float(x) for x in str(params['bbox']).split(','))
+            zoom = None if params.get('zoom') is None else int(str(params['zoom']))
+            assert len(bbox) == 4
+        except (AssertionError, ValueError):
+            return web.json_response({'error': 'Invalid bbox or zoom.'}, status=400)
+        etag, parts = layer.query(bbox, zoom)  # type: ignore[arg-type]
+        if (is_not_modified(request, etag)):
+            return web.Response(status=304, headers={'ETag': f'"{etag}"', FILTER_HEADER: 'bbox'})
+        body, compressed = await asyncio.to_thread(layer.get_response, etag, parts)
+        return respond(request, etag, body, compressed, filtered=True)
+
+    async def handle_supply(self: 'FeatureServer', request: web.Request) -> web.Response:
+        '''
+        Compute the supply user-placed lots add to the grid. The body is `{"points": [[longitude, latitude], ...]}`.
+        '''
+        if (self.supply is None):
+            return web.json_response({'error': 'The grid is not loaded.'}, status=503)
+        try:
+            points = (await request.json())['points']
+            assert all(len(p) >= 2 for p in points)
+        except (AssertionError, KeyError, TypeError, ValueError):
+            return web.json_response({'error': 'Invalid points.'}, status=400)
+        return web.json_response(await asyncio.to_thread(self.supply.get_supply, points))
+
+    async def watch(self: 'FeatureServer', interval: float = INTERVAL) -> None:
+        '''
+        Reload the layers whose files changed, checking every `interval` seconds.
+        '''
+        while (True):
+            await asyncio.sleep(interval)
+            for name in FEATURES:
+                path = os.path.join(self.directory, f'{name}.geojson')
+                layer = self.layers.get(name)
+                try:
+                    if (os.path.exists(path)) and ((layer is None) or (os.path.getmtime(path) != layer.mtime)):
+                        await asyncio.to_thread(self.load, name)
+                except Exception as ex:
+                    # Keep serving the old layer if the file is still being written.
+                    log(f'An error occured when reloading `{path}`...')
+                    log(ex)
+
+# Methods
+def dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def get_app(directory: str = SERVER_DATA, htdocs: str | None = HTDOCS, interval: float = INTERVAL) -> web.Application:
+    '''
+    Create the application serving `api/feature.php` and, if `htdocs` is given, the viewer itself.
+    '''
+    server = FeatureServer(directory)
+    app = web.Application()
+    for path in ('/api/feature.php', '/api/feature'):
+        app.router.add_route('GET', path, server.handle)
+        app.router.add_route('POST', path, server.handle)
+    app.router.add_post('/api/supply', server.handle_supply)
+    if (htdocs is not None):
+        app.router.add_get('/', lambda _: web.FileResponse(os.path.join(htdocs, 'index.html')))
+        app.router.add_static('/', htdocs)
+
+    async def start_watching(app: web.Application):
+        task = asyncio.create_task(server.watch(interval))
+        yield
+        task.cancel()
+    app.cleanup_ctx.append(start_watching)
+    return app
+
+def is_not_modified(request: web.Request, etag: str) -> bool:
+    '''
+    Check whether the client already has this version, ignoring weak prefixes and encoding suffixes.
+    '''
+    for tag in request.headers.get('If-None-Match', '').split(','):
+        tag = tag.strip().removeprefix('W/').strip('"')
+        if (tag == '*') or (tag.removesuffix('-gzip') == etag):
+            return True
+    return False
+
+def log(msg: Any) -> None:
+    msg_str = f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] ' + str(msg)
+    print(msg_str)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, 'server.txt')
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(msg_str + '\n')
+
+def respond(request: web.Request, etag: str, body: bytes, compressed: bytes | None = None, filtered: bool = False) -> web.Response:
+    '''
+    Send the GeoJSON with its ETag, gzipped if the client accepts it, or `304` if the client already has it.
+    Responses filtered to a bbox are marked with `FILTER_HEADER`.
+    '''
+    headers = {'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding', 'ETag': f'"{etag}"'}
+    if (filtered):
+        headers[FILTER_HEADER] = 'bbox'
+    if (is_not_modified(request, etag)):
+        return web.Response(status=304, headers=headers)
+    if ('gzip' in request.headers.get('Accept-Encoding', '')) and (len(body) >= MIN_GZIP_SIZE):
+        headers['Content-Encoding'] = 'gzip'
+        headers['ETag'] = f'"{etag}-gzip"'
+        body = compressed if compressed is not None else gzip.compress(body, compresslevel=5)
+    return web.Response(body=body, content_type='application/geo+json', headers=headers)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the layers of the viewer from memory.')
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='127.0.0.1',
+        help='The host to listen on.'
+    )
+    parser.add_argument(
+        '--port', '-p',
+        type=int,
+        default=8080,
+        help='The port to listen on.'
+    )
+    parser.add_argument(
+        '--data', '-d',
+        type=str,
+        default=SERVER_DATA,
+        help='The directory of grid.geojson, lot.geojson and poi.geojson.'
+    )
+    parser.add_argument(
+        '--interval', '-i',
+        type=float,
+        default=INTERVAL,
+        help='The seconds between checks for changed layers.'
+    )
+    parser.add_argument(
+        '--api-only',
+        action='store_true',
+        help='Only serve the API, not the viewer.'
+    )
+    args = parser.parse_args()
+    web.run_app(get_app(args.data, None if args.api_only else HTDOCS, args.interval), host=args.host, port=args.port)
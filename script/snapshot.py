@@ -0,0 +1,356 @@
+import argparse
+import base64
+from datetime import datetime
+from hashlib import blake2b
+import json
+import numpy as np
+import os
+import shapely
+from typing import Any, Iterable, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Constants
+CATALOG_DIR = 'catalog'
+LATEST = 'LATEST'
+SNAPSHOT_FORMAT = 'taipei-parking/snapshot'
+STATIC_FIELDS = ('id', 'name', 'service', 'toll', 'geometry')
+
+# Classes
+class LotCatalog:
+    '''
+    The versioned catalog of the static attributes of the parking lots.
+    A lot keeps its index once added, so snapshots can refer to lots by index.
+    '''
+
+    lots: list[dict[str, Any]]
+    '''
+    The static attributes of each lot: id, name, service, toll and the shape as WKT.
+    '''
+
+    index: dict[str, int]
+    '''
+    The dictionary of lot id to index.
+    '''
+
+    version: str
+    '''
+    The digest of the catalog content. An empty catalog has an empty version.
+    '''
+
+    def __init__(self: 'LotCatalog', lots: Optional[list[dict[str, Any]]] = None) -> None:
+        self.lots = [] if lots is None else lots
+        self.index = {lot['id']: i for i, lot in enumerate(self.lots)}
+        self.version = self.get_version()
+
+    def get_version(self: 'LotCatalog') -> str:
+        if (not self.lots):
+            return ''
+        content = json.dumps(self.lots, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return blake2b(content.encode('utf-8'), digest_size=8).hexdigest()
+
+    def save(self: 'LotCatalog', directory: str) -> str:
+        '''
+        Write the catalog unless this version already exists, and point `LATEST` to it.
+
+        Returns
+        -------
+        path: str
+            The path to the catalog file.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.version}.json')
+        if (not os.path.exists(path)):
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'version': self.version, 'created': datetime.now().isoformat(), 'lots': self.lots}, f, ensure_ascii=False)
+            os.replace(f'{path}.tmp', path)
+        with open(os.path.join(directory, LATEST), 'w', encoding='utf-8') as f:
+            f.write(self.version)
+        return path
+
+    def update(self: 'LotCatalog', records: Iterable[dict[str, Any]]) -> bool:
+        '''
+        Add the new lots and replace the attributes of the changed ones.
+
+        Returns
+        -------
+        changed: bool
+            Whether the catalog changed, in which case it has a new version.
+        '''
+        changed = False
+        for record in records:
+            lot = {k: record.get(k) for k in STATIC_FIELDS}
+            i = self.index.get(lot['id'])
+            if (i is None):
+                self.index[lot['id']] = len(self.lots)
+                self.lots.append(lot)
+                changed = True
+            elif (self.lots[i] != lot):
+                self.lots[i] = lot
+                changed = True
+        if (changed):
+            self.version = self.get_version()
+        return changed
+
+    def __len__(self: 'LotCatalog') -> int:
+        return len(self.lots)
+
+    @classmethod
+    def load(cls, directory: str, version: Optional[str] = None, copy: bool = True) -> 'LotCatalog':
+        '''
+        Load the given version of the catalog, or the latest one. An empty catalog is returned if there's none.
+        Loaded versions are cached, so reading many snapshots parses each catalog once.
+        Pass `copy=False` to get the cached object itself, which must not be updated.
+        '''
+        if (version is None):
+            pointer = os.path.join(directory, LATEST)
+            if (not os.path.exists(pointer)):
+                return cls()
+            with open(pointer, 'r', encoding='utf-8') as f:
+                version = f.read().strip()
+        if (not version):
+            return cls()
+        key = (os.path.abspath(directory), version)
+        if (key not in _catalogs):
+            with open(os.path.join(directory, f'{version}.json'), 'rb') as f:
+                _catalogs[key] = cls(loads(f.read())['lots'])
+        cached = _catalogs[key]
+        return cls([dict(lot) for lot in cached.lots]) if copy else cached
+
+class SnapshotFormatError(ValueError):
+    '''
+    Raised when a file is not in the format written by `crawler.py`.
+    '''
+
+# Variables
+_catalogs: dict[tuple[str, str], LotCatalog] = {}
+
+# Methods
+def from_geojson(path: str, output: Optional[str] = None) -> str:
+    '''
+    Convert a GeoJSON snapshot to the compact format, updating the catalog next to the output.
+
+    Returns
+    -------
+    output: str
+        The path to the compact snapshot.
+    '''
+    with open(path, 'rb') as f:
+        data = loads(f.read())
+    if (not is_crawler_snapshot(data)):
+        raise SnapshotFormatError(f'`{path}` is not a crawler snapshot.')
+    output = output or os.path.splitext(path)[0] + '.snap'
+    directory = os.path.join(os.path.dirname(output), CATALOG_DIR)
+    records = []
+    for feature in data['features']:
+        properties = feature.get('properties') or {}
+        shape = None if feature.get('geometry') is None else shapely.geometry.shape(feature['geometry']).wkt
+        records.append({**properties, 'geometry': shape})
+    catalog = LotCatalog.load(directory)
+    catalog.update(records)
+    catalog.save(directory)
+    write_snapshot(output, catalog, [r.get('id') for r in records], [r.get('occupied') for r in records],
+                   datetime.fromisoformat(data['timestamp']), data.get('stale'))
+    return output
+
+def is_crawler_snapshot(data: Any) -> bool:
+    '''
+    Check whether the parsed JSON is a FeatureCollection written by `LotCollection.to_geojson_file`.
+    Files exported by GDAL and other tools carry `name`/`crs` members and no top-level `timestamp`.
+    '''
+    return (isinstance(data, dict)
+            and (data.get('type') == 'FeatureCollection')
+            and ('timestamp' in data)
+            and ('crs' not in data)
+            and isinstance(data.get('features'), list))
+
+def loads(raw: bytes) -> Any:
+    '''
+    Parse the JSON with orjson if it is installed, or with the standard library otherwise.
+    '''
+    if (orjson is not None):
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def pack_bits(values: np.ndarray) -> str:
+    return base64.b64encode(np.packbits(values.astype(bool), bitorder='little').tobytes()).decode('ascii')
+
+def read_compact(path: str) -> tuple[dict[str, Any], LotCatalog, np.ndarray, np.ndarray]:
+    '''
+    Read a compact snapshot and the catalog version it refers to.
+
+    Returns
+    -------
+    header: dict[str, Any]
+        The snapshot without the bitsets.
+
+    catalog: LotCatalog
+        The catalog of the snapshot.
+
+    indices: np.ndarray
+        The catalog indices of the lots observed in the snapshot.
+
+    occupied: np.ndarray
+        Whether each observed lot is occupied.
+    '''
+    with open(path, 'rb') as f:
+        data = loads(f.read())
+    if (not isinstance(data, dict)) or (data.get('format') != SNAPSHOT_FORMAT):
+        raise SnapshotFormatError(f'`{path}` is not a compact snapshot.')
+    catalog = LotCatalog.load(os.path.join(os.path.dirname(path), CATALOG_DIR), data['catalog'], copy=False)
+    count = data['count']
+    observed = unpack_bits(data.pop('observed'), count)
+    occupied = unpack_bits(data.pop('occupied'), count)
+    indices = np.flatnonzero(observed)
+    return data, catalog, indices, occupied[indices]
+
+def read_snapshot(path: str, columns: Iterable[str] = ('id', 'occupied'), geometry: bool = False) -> dict[str, np.ndarray]:
+    '''
+    Read the property columns of a crawler snapshot, either GeoJSON or compact, without building a GeoDataFrame.
+
+    Parameter
+    -------
+    path: str
+        The path to the snapshot.
+
+    columns: Iterable[str], default ('id', 'occupied')
+        The properties to read. A property missing from a feature is read as `None`.
+
+    geometry: bool, default False
+        Whether to also parse the shapes into the `geometry` column.
+
+    Returns
+    -------
+    result: dict[str, np.ndarray]
+        The object array of each requested column.
+
+    Raises
+    -------
+    SnapshotFormatError
+        If the file is not a snapshot written by `crawler.py`.
+    '''
+    if (path.endswith('.snap')):
+        header, catalog, indices, occupied = read_compact(path)
+        result: dict[str, np.ndarray] = {}
+        for column in columns:
+            values = np.empty(len(indices), dtype=object)
+            if (column == 'occupied'):
+                values[:] = occupied.tolist()
+            elif (column == 'timestamp'):
+                values[:] = header['timestamp']
+            else:
+                values[:] = [catalog.lots[i].get(column) for i in indices]
+            result[column] = values
+        if (geometry):
+            wkts = [catalog.lots[i]['geometry'] for i in indices]
+            shapes = np.empty(len(indices), dtype=object)
+            shapes[:] = list(shapely.from_wkt(wkts, on_invalid='ignore')) if wkts else []
+            result['geometry'] = shapes
+        return result
+
+    with open(path, 'rb') as f:
+        data = loads(f.read())
+    if (not is_crawler_snapshot(data)):
+        raise SnapshotFormatError(f'`{path}` is not a crawler snapshot.')
+
+    properties = [feature.get('properties') or {} for feature in data['features']]
+    result = {}
+    for column in columns:
+        values = np.empty(len(properties), dtype=object)
+        values[:] = [p.get(column) for p in properties]
+        result[column] = values
+    if (geometry):
+        shapes = np.empty(len(properties), dtype=object)
+        shapes[:] = [None if feature.get('geometry') is None else shapely.geometry.shape(feature['geometry'])
+                     for feature in data['features']]
+        result['geometry'] = shapes
+    return result
+
+def to_geojson(path: str, output: Optional[str] = None) -> str:
+    '''
+    Convert a compact snapshot back to the GeoJSON written by `LotCollection.to_geojson_file`.
+    The lots take the snapshot's timestamp, since the compact format doesn't keep one per lot.
+
+    Returns
+    -------
+    output: str
+        The path to the GeoJSON snapshot.
+    '''
+    header, catalog, indices, occupied = read_compact(path)
+    output = output or os.path.splitext(path)[0] + '.geojson'
+    wkts = [catalog.lots[i]['geometry'] for i in indices]
+    shapes = shapely.from_wkt(wkts, on_invalid='ignore') if wkts else []
+    features = []
+    for i, shape, is_occupied in zip(indices, shapes, occupied.tolist()):
+        lot = catalog.lots[i]
+        features.append({'type': 'Feature',
+                         'geometry': shapely.geometry.mapping(shape),
+                         'properties': {'id': lot['id'],
+                                        'name': lot['name'],
+                                        'service': lot['service'],
+                                        'timestamp': header['timestamp'],
+                                        'toll': lot['toll'],
+                                        'occupied': is_occupied}})
+    geojson: dict[str, Any] = {'type': 'FeatureCollection', 'features': features, 'timestamp': header['timestamp']}
+    if (header.get('stale')):
+        geojson['stale'] = header['stale']
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(geojson, f, ensure_ascii=False, indent=2)
+    return output
+
+def unpack_bits(text: str, count: int) -> np.ndarray:
+    return np.unpackbits(np.frombuffer(base64.b64decode(text), dtype=np.uint8), count=count, bitorder='little').astype(bool)
+
+def write_snapshot(path: str, catalog: LotCatalog, ids: Iterable[Any], occupied: Iterable[Any], timestamp: datetime, stale: Optional[dict[str, float]] = None) -> None:
+    '''
+    Write a compact snapshot: the catalog version, the timestamp, and two bitsets over the catalog
+    telling which lots were observed and which of them are occupied.
+    Every id must already be in the catalog.
+    '''
+    observed = np.zeros(len(catalog), dtype=bool)
+    occupied_bits = np.zeros(len(catalog), dtype=bool)
+    for id, is_occupied in zip(ids, occupied):
+        i = catalog.index.get(id)
+        if (i is None):
+            continue
+        observed[i] = True
+        occupied_bits[i] = bool(is_occupied)
+    data: dict[str, Any] = {'format': SNAPSHOT_FORMAT,
+                            'catalog': catalog.version,
+                            'timestamp': timestamp.isoformat(),
+                            'count': len(catalog),
+                            'observed': pack_bits(observed),
+                            'occupied': pack_bits(occupied_bits)}
+    if (stale):
+        data['stale'] = stale
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(f'{path}.tmp', path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert crawler snapshots between GeoJSON and the compact format.')
+    parser.add_argument(
+        'direction',
+        choices=['to-geojson', 'from-geojson'],
+        help='`to-geojson` converts compact snapshots to GeoJSON, and `from-geojson` the other way round.'
+    )
+    parser.add_argument(
+        'paths',
+        nargs='+',
+        help='The snapshots to convert.'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=None,
+        help='The output path. Only valid with a single input.'
+    )
+    args = parser.parse_args()
+    if (args.output is not None) and (len(args.paths) > 1):
+        parser.error('--output only works with a single input.')
+    for path in args.paths:
+        converted = to_geojson(path, args.output) if args.direction == 'to-geojson' else from_geojson(path, args.output)
+        print(f'{path} -> {converted}')
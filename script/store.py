@@ -0,0 +1,167 @@
+import numpy as np
+import sqlite3
+from typing import Any, Iterable, Optional, Sequence
+
+# Constants
+DAY = 86400
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS lot (
+    idx INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS observation (
+    day INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    lot INTEGER NOT NULL,
+    state INTEGER,
+    PRIMARY KEY (day, ts, lot)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS observation_lot ON observation (lot, ts);
+'''
+
+# Classes
+class ObservationStore:
+    '''
+    The append-only store of every occupancy reading, backed by SQLite.
+
+    Each row is one observation: the day partition, the timestamp in seconds (local time, stored as if UTC),
+    the lot index and the state (`0` vacant, `1` occupied, `NULL` unknown). Rows are clustered by day and
+    timestamp for range scans by time, and indexed by lot and timestamp for scans by lot.
+    '''
+
+    path: str
+    '''
+    The path to the SQLite database.
+    '''
+
+    def __init__(self: 'ObservationStore', path: str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self._lots: dict[str, int] = {}
+
+    def append(self: 'ObservationStore', ids: Sequence[Any], states: Sequence[Any], timestamps: Sequence[Any]) -> int:
+        '''
+        Append the observations of a snapshot. Observations already stored are ignored, so ingesting a file twice is harmless.
+
+        Parameter
+        -------
+        ids: Sequence[Any]
+            The id of each lot. Lots without an id are skipped.
+
+        states: Sequence[Any]
+            Whether each lot is occupied. `None` or NaN is stored as `NULL`.
+
+        timestamps: Sequence[Any]
+            The ISO 8601 time of each observation.
+
+        Returns
+        -------
+        count: int
+            The number of new observations.
+        '''
+        values = np.asarray(states, dtype=float)
+        seconds = to_seconds(timestamps)
+        with self.connection:
+            lots = self.get_lot_indices(ids)
+            valid = lots >= 0
+            rows = zip((seconds[valid] // DAY).tolist(),
+                       seconds[valid].tolist(),
+                       lots[valid].tolist(),
+                       [None if np.isnan(v) else int(v) for v in values[valid]])
+            before = self.connection.total_changes
+            self.connection.executemany('INSERT OR IGNORE INTO observation VALUES (?, ?, ?, ?)', rows)
+            return self.connection.total_changes - before
+
+    def close(self: 'ObservationStore') -> None:
+        self.connection.close()
+
+    def get_ids(self: 'ObservationStore') -> list[Optional[str]]:
+        '''
+        Get the id of every lot, so that `ids[idx]` is the id of the lot index `idx`. Unused indices are `None`.
+        '''
+        ids: list[Optional[str]] = []
+        for idx, id in self.connection.execute('SELECT idx, id FROM lot ORDER BY idx'):
+            ids.extend([None] * (idx - len(ids)))
+            ids.append(id)
+        return ids
+
+    def get_lot_indices(self: 'ObservationStore', ids: Sequence[Any], add: bool = True) -> np.ndarray:
+        '''
+        Get the index of each lot. Missing ids get `-1`.
+
+        Parameter
+        -------
+        ids: Sequence[Any]
+            The ids of the lots.
+
+        add: bool, default True
+            Whether to add the new lots to the lot table. This must run inside a transaction.
+        '''
+        new = {id for id in ids if isinstance(id, str) and id not in self._lots}
+        if (new):
+            if (add):
+                self.connection.executemany('INSERT OR IGNORE INTO lot (id) VALUES (?)', ((id,) for id in new))
+            self._lots.update(self.connection.execute('SELECT id, idx FROM lot'))
+        return np.fromiter((self._lots.get(id, -1) if isinstance(id, str) else -1 for id in ids), dtype=np.int64, count=len(ids))
+
+    def scan(self: 'ObservationStore', start: Optional[int] = None, end: Optional[int] = None, lots: Optional[Iterable[str]] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Scan the observations in a time range, optionally only of some lots, ordered by time.
+
+        Parameter
+        -------
+        start: int, optional
+            The first second to include.
+
+        end: int, optional
+            The first second to exclude.
+
+        lots: Iterable[str], optional
+            The ids of the lots to include.
+
+        Returns
+        -------
+        timestamps: np.ndarray
+            The time of each observation in seconds.
+
+        lots: np.ndarray
+            The lot index of each observation.
+
+        states: np.ndarray
+            The state of each observation, with `-1` for unknown.
+        '''
+        clauses: list[str] = []
+        params: list[Any] = []
+        if (start is not None):
+            clauses.append('day >= ? AND ts >= ?')
+            params.extend([start // DAY, start])
+        if (end is not None):
+            clauses.append('day <= ? AND ts < ?')
+            params.extend([end // DAY, end])
+        if (lots is not None):
+            indices = self.get_lot_indices(list(lots), add=False)
+            clauses.append(f'lot IN ({", ".join("?" * len(indices))})')
+            params.extend(indices.tolist())
+        where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+        rows = self.connection.execute(f'SELECT ts, lot, IFNULL(state, -1) FROM observation {where} ORDER BY ts', params).fetchall()
+        data = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        return data[:, 0], data[:, 1], data[:, 2]
+
+    def __enter__(self: 'ObservationStore') -> 'ObservationStore':
+        return self
+
+    def __exit__(self: 'ObservationStore', *args: Any) -> None:
+        self.close()
+
+    def __len__(self: 'ObservationStore') -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM observation').fetchone()[0]
+
+# Methods
+def to_seconds(timestamps: Sequence[Any]) -> np.ndarray:
+    '''
+    Convert ISO 8601 times to seconds since the epoch, treating the local time as UTC.
+    '''
+    return np.array(timestamps, dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
@@ -0,0 +1,222 @@
+import argparse
+from collections import OrderedDict
+from grid import RADIUS, project, to_metric
+import json
+import numpy as np
+from publish import SERVER_DATA
+import shapely
+import threading
+from typing import Any, Sequence
+
+# Constants
+CACHE_SIZE = 4096
+HOURS = 8
+PRECISION = 7
+
+# Classes
+class SupplyModel:
+    '''
+    The supply that user-placed lots would add to each grid cell, as `updateUserSupplyFromPoints` in the viewer
+    computes it: the share of each lot's buffer inside a cell, summed over the lots and multiplied by `HOURS`.
+    '''
+
+    cells: np.ndarray
+    '''
+    The cells in EPSG:3826.
+    '''
+
+    indices: np.ndarray
+    '''
+    The `Index` of each cell.
+    '''
+
+    cache: OrderedDict[tuple[float, float], tuple[np.ndarray, np.ndarray]]
+    '''
+    The cells and buffer shares of recent lot positions, least recently used first. Lots that didn't move hit the cache.
+    '''
+
+    def __init__(self: 'SupplyModel', cells: np.ndarray, indices: np.ndarray, radius: float = RADIUS, cache_size: int = CACHE_SIZE) -> None:
+        self.cells = cells
+        self.indices = indices
+        self.radius = radius
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.tree = shapely.STRtree(cells)
+        self.bounds = shapely.bounds(cells)
+        self.rectangular = np.isclose(shapely.area(cells), shapely.area(shapely.envelope(cells)), rtol=1e-9, atol=0)
+
+    def get_fractions(self: 'SupplyModel', points: Sequence[Sequence[float]]) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Get the buffer share each cell receives from the lots, buffering only the lots not in the cache.
+
+        Parameter
+        -------
+        points: Sequence[Sequence[float]]
+            The (longitude, latitude) of each lot.
+
+        Returns
+        -------
+        fractions: np.ndarray
+            The summed buffer share of each cell.
+
+        counts: np.ndarray
+            The number of lots reaching each cell.
+        '''
+        keys = [(round(float(x), PRECISION), round(float(y), PRECISION)) for x, y, *_ in points]
+        with self.lock:
+            found = {k: self.cache.get(k) for k in keys}
+        missing = [k for k, v in found.items() if v is None]
+        if (missing):
+            found.update(self.add(missing))
+        with self.lock:
+            for k in found:
+                if (k in self.cache):
+                    self.cache.move_to_end(k)
+            while (len(self.cache) > self.cache_size):
+                self.cache.popitem(last=False)
+
+        fractions = np.zeros(len(self.cells))
+        counts = np.zeros(len(self.cells), dtype=np.int64)
+        entries = [found[k] for k in keys]
+        if (entries):
+            cells = np.concatenate([e[0] for e in entries])
+            np.add.at(fractions, cells, np.concatenate([e[1] for e in entries]))
+            np.add.at(counts, cells, 1)
+        return fractions, counts
+
+    def add(self: 'SupplyModel', keys: list[tuple[float, float]]) -> dict[tuple[float, float], tuple[np.ndarray, np.ndarray]]:
+        '''
+        Buffer the lots in EPSG:3826 and measure their overlaps with the cells, all in one pass.
+
+        Returns
+        -------
+        entries: dict[tuple[float, float], tuple[np.ndarray, np.ndarray]]
+            The cells and buffer shares of each lot position, which are also cached.
+        '''
+        lot_idx, cell_idx, fractions = self.get_overlaps(project(shapely.points(np.array(keys)), to_metric))
+        bounds = np.searchsorted(lot_idx, np.arange(len(keys) + 1))
+        entries = {key: (cell_idx[bounds[i]:bounds[i + 1]], fractions[bounds[i]:bounds[i + 1]]) for i, key in enumerate(keys)}
+        with self.lock:
+            self.cache.update(entries)
+        return entries
+
+    def get_overlaps(self: 'SupplyModel', points: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Buffer the points and measure their overlaps with the cells, with one STRtree query and one vectorized intersection.
+
+        Parameter
+        -------
+        points: np.ndarray
+            The points in EPSG:3826.
+
+        Returns
+        -------
+        lots: np.ndarray
+            The point of each overlap, in ascending order.
+
+        cells: np.ndarray
+            The cell of each overlap.
+
+        fractions: np.ndarray
+            The share of the point's buffer inside the cell.
+        '''
+        lot_idx, cell_idx = self.tree.query(points, predicate='dwithin', distance=self.radius)
+        fractions = np.empty(len(lot_idx))
+        rectangular = self.rectangular[cell_idx]
+        fractions[rectangular] = get_disk_fractions(shapely.get_coordinates(points[lot_idx[rectangular]]), self.bounds[cell_idx[rectangular]], self.radius)
+        if (not rectangular.all()):
+            buffers = shapely.buffer(points[lot_idx[~rectangular]], self.radius, quad_segs=16)
+            fractions[~rectangular] = shapely.area(shapely.intersection(buffers, self.cells[cell_idx[~rectangular]])) / shapely.area(buffers)
+        keep = fractions > 0
+        return lot_idx[keep], cell_idx[keep], fractions[keep]
+
+    def get_supply(self: 'SupplyModel', points: Sequence[Sequence[float]]) -> dict[str, list[Any]]:
+        '''
+        Get the supply added to the cells the lots reach.
+
+        Returns
+        -------
+        supply: dict[str, list[Any]]
+            The `Index`, summed buffer share (`frac`), number of lots (`count`) and added supply (`supply`, `frac × 8`)
+            of every cell reached.
+        '''
+        fractions, counts = self.get_fractions(points)
+        reached = np.flatnonzero(counts)
+        return {'Index': self.indices[reached].tolist(),
+                'frac': fractions[reached].tolist(),
+                'count': counts[reached].tolist(),
+                'supply': (fractions[reached] * HOURS).tolist()}
+
+    @classmethod
+    def from_collection(cls, collection: dict[str, Any], radius: float = RADIUS) -> 'SupplyModel':
+        '''
+        Create the model from the grid GeoJSON.
+        '''
+        features = collection['features']
+        cells = project(shapely.from_geojson([json.dumps(f['geometry']) for f in features]), to_metric)
+        indices = np.array([f['properties'].get('Index', i + 1) for i, f in enumerate(features)])
+        return cls(cells, indices, radius)
+
+    @classmethod
+    def load_file(cls, path: str, radius: float = RADIUS) -> 'SupplyModel':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_collection(json.load(f), radius)
+
+# Methods
+def get_disk_fractions(centers: np.ndarray, bounds: np.ndarray, radius: float) -> np.ndarray:
+    '''
+    Get the share of each disk inside its axis-aligned rectangle in closed form, which is much faster than
+    intersecting buffer polygons. The area is combined from the areas of the disk below and left of each corner.
+
+    Parameter
+    -------
+    centers: np.ndarray
+        The (n, 2) centers of the disks.
+
+    bounds: np.ndarray
+        The (n, 4) bounds of the rectangles.
+    '''
+    r = radius
+
+    def below_left(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        # The area of the disk centered at the origin with x ≤ a and y ≤ b.
+        a = np.clip(a, -r, r)
+        b = np.clip(b, -r, r)
+        w = np.sqrt(r * r - b * b)
+        integral = lambda x: 0.5 * (x * np.sqrt(np.maximum(r * r - x * x, 0)) + r * r * np.arcsin(np.clip(x / r, -1, 1))) + np.pi * r * r / 4
+        inner = np.clip(a, -w, w)
+        # Where the chord is shorter than |b|, the column is either all in (b ≥ 0) or all out (b < 0).
+        area = np.where(a > -w, b * (inner + w) + integral(inner) - integral(-w), 0)
+        outer = 2 * integral(np.minimum(a, -w)) + np.where(a > w, 2 * (integral(a) - integral(w)), 0)
+        return area + np.where(b >= 0, outer, 0)
+
+    x = centers[:, 0]
+    y = centers[:, 1]
+    x1, y1, x2, y2 = bounds[:, 0] - x, bounds[:, 1] - y, bounds[:, 2] - x, bounds[:, 3] - y
+    area = below_left(x2, y2) - below_left(x1, y2) - below_left(x2, y1) + below_left(x1, y1)
+    return np.clip(area / (np.pi * r * r), 0, 1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the supply user-placed lots would add to the grid.')
+    parser.add_argument(
+        'points',
+        type=str,
+        help='The JSON file of [longitude, latitude] pairs.'
+    )
+    parser.add_argument(
+        '--grid', '-g',
+        type=str,
+        default=f'{SERVER_DATA}/grid.geojson',
+        help='The grid.'
+    )
+    parser.add_argument(
+        '--radius',
+        type=float,
+        default=RADIUS,
+        help='The buffer radius of each lot in meters.'
+    )
+    args = parser.parse_args()
+    with open(args.points, 'r', encoding='utf-8') as f:
+        points = json.load(f)
+    print(json.dumps(SupplyModel.load_file(args.grid, args.radius).get_supply(points), ensure_ascii=False))
@@ -1,38 +1,131 @@
 <?php
-// Handle POST requests
-if ($_SERVER['REQUEST_METHOD'] === 'POST') {
-    $feature = $_POST['feature'] ?? null;
+// Constants
+define('DATA_DIR', '..' . DIRECTORY_SEPARATOR . 'data' . DIRECTORY_SEPARATOR);
+define('DIST_DIR', DATA_DIR . 'dist' . DIRECTORY_SEPARATOR);
+const FEATURES = ['grid', 'lot', 'poi'];
 
-    if (is_null($feature)) {
-        http_response_code(400);
-        echo json_encode(["error" => "The feature type is not specified."]);
-        exit;
+/**
+ * Get the quality of each content encoding the client accepts.
+ */
+function get_accepted_encodings(): array {
+    $accepted = [];
+    foreach (explode(',', $_SERVER['HTTP_ACCEPT_ENCODING'] ?? '') as $item) {
+        $parts = array_map('trim', explode(';', $item));
+        $quality = 1.0;
+        foreach (array_slice($parts, 1) as $param) {
+            if (str_starts_with($param, 'q=')) {
+                $quality = (float) substr($param, 2);
+            }
+        }
+        if ($parts[0] !== '') {
+            $accepted[strtolower($parts[0])] = $quality;
+        }
     }
+    return $accepted;
+}
 
-    switch ($feature) {
-        case 'grid':
-            header('Content-Type: application/geo+json');
-            echo file_get_contents('..' . DIRECTORY_SEPARATOR . 'data' . DIRECTORY_SEPARATOR . 'grid.geojson');
-            break;
+/**
+ * Check whether the client already has this version, ignoring weak prefixes and encoding suffixes.
+ */
+function is_not_modified(string $hash): bool {
+    $header = $_SERVER['HTTP_IF_NONE_MATCH'] ?? '';
+    foreach (explode(',', $header) as $tag) {
+        $tag = trim(preg_replace('/^W\//', '', trim($tag)), '"');
+        if ($tag === '*' || preg_replace('/-(br|gzip)$/', '', $tag) === $hash) {
+            return true;
+        }
+    }
+    return false;
+}
 
-        case 'lot':
-            header('Content-Type: application/geo+json');
-            echo file_get_contents('..' . DIRECTORY_SEPARATOR . 'data' . DIRECTORY_SEPARATOR . 'lot.geojson');
-            break;
+/**
+ * Check whether the published entry was built from the current source GeoJSON, by its size and modification time.
+ */
+function is_current(array $entry, string $feature): bool {
+    $source = DATA_DIR . $feature . '.geojson';
+    clearstatcache(true, $source);
+    return isset($entry['source'])
+        && is_file($source)
+        && filesize($source) === $entry['source']['size']
+        && filemtime($source) === $entry['source']['mtime'];
+}
 
-        case 'poi':
-            header('Content-Type: application/geo+json');
-            echo file_get_contents('..' . DIRECTORY_SEPARATOR . 'data' . DIRECTORY_SEPARATOR . 'poi.geojson');
-            break;
-        
-        default:
+/**
+ * Send the published layer from `data/dist` (see `script/publish.py`), or the source GeoJSON if it wasn't published
+ * or has changed since it was published.
+ */
+function send_feature(string $feature, string $format): void {
+    $manifest_path = DIST_DIR . 'manifest.json';
+    $manifest = is_file($manifest_path) ? json_decode(file_get_contents($manifest_path), true) : null;
+    $entry = $manifest['features'][$feature][$format] ?? null;
+    if (!is_null($entry) && !is_current($entry, $feature)) {
+        $entry = null;
+    }
+
+    if (is_null($entry)) {
+        if ($format !== 'geojson') {
             header('Content-Type: application/json');
-            http_response_code(400);
-            echo json_encode(["error" => "Invalid feature type."]);
+            http_response_code(404);
+            echo json_encode(["error" => "The format is not published."]);
+            return;
+        }
+        header('Content-Type: application/geo+json');
+        readfile(DATA_DIR . $feature . '.geojson');
+        return;
+    }
+
+    header('Cache-Control: no-cache');
+    header('Vary: Accept-Encoding');
+    $path = DIST_DIR . $entry['file'];
+    $etag = $entry['hash'];
+    $content_encoding = null;
+    $accepted = get_accepted_encodings();
+    foreach (['br', 'gzip'] as $encoding) {
+        if (isset($entry['encodings'][$encoding]) && ($accepted[$encoding] ?? $accepted['*'] ?? 0) > 0) {
+            $content_encoding = $encoding;
+            $path = DIST_DIR . $entry['encodings'][$encoding]['file'];
+            $etag .= '-' . $encoding;
             break;
+        }
+    }
+
+    // Echo the ETag of the representation a 200 would send.
+    if (is_not_modified($entry['hash'])) {
+        header('ETag: "' . $etag . '"');
+        http_response_code(304);
+        return;
+    }
+
+    if (!is_null($content_encoding)) {
+        header('Content-Encoding: ' . $content_encoding);
+    }
+    header('Content-Type: ' . $entry['type']);
+    header('Content-Length: ' . filesize($path));
+    header('ETag: "' . $etag . '"');
+    readfile($path);
+}
+
+// Handle GET and POST requests. GET responses can be revalidated by the browser cache.
+if ($_SERVER['REQUEST_METHOD'] === 'POST' || $_SERVER['REQUEST_METHOD'] === 'GET') {
+    $params = $_SERVER['REQUEST_METHOD'] === 'POST' ? $_POST : $_GET;
+    $feature = $params['feature'] ?? null;
+    $format = $params['format'] ?? 'geojson';
+
+    if (is_null($feature)) {
+        http_response_code(400);
+        echo json_encode(["error" => "The feature type is not specified."]);
+        exit;
+    }
+
+    if (in_array($feature, FEATURES, true) && in_array($format, ['geojson', 'topojson'], true)) {
+        send_feature($feature, $format);
+    } else {
+        header('Content-Type: application/json');
+        http_response_code(400);
+        echo json_encode(["error" => "Invalid feature type."]);
     }
 
 } else {
     http_response_code(405);
-    echo json_encode(["error" => "Use POST method."]);
+    echo json_encode(["error" => "Use GET or POST method."]);
 }